@@ -1,98 +1,403 @@
-import json
 import logging
-import re
 import asyncio
-from llms.llms import async_call_llm
+from llms.llms import async_call_llm, async_call_llm_json_candidates, get_model_limits, warm_prefix
+from llms.rate_limiter import estimate_tokens
 from utils.wordCounter import count_words
-from json_repair import repair_json
+from utils.textTrimmer import trim_to_length
+from llms.telemetry import call_context
+from llms.calibration import calibration
+from CogWriter_model.Agents import OutputSchemas
+from CogWriter_model.Agents.PlanValidator import unit_number
+
+# Words per unit spent on its id, check and JSON syntax
+UNIT_OVERHEAD_WORDS = 45
+# Example key holding the plan entries (and, once generated, the units) per example type
+UNIT_KEYS = {"Week": "weekly_plan", "Floor": "floor_plan", "Menu Week": "weekly_plan", "Block": "block_plan"}
+
+
+class UnitGenerationError(Exception):
+    """A unit could not be generated; the example is retried from its checkpointed progress."""
+
 
 class GenerationAgent:
+    # Stream unit responses and stop reading once the JSON object closes
+    stream = False
+    # How much of the plan each unit prompt sees: "full" (the whole plan),
+    # "window" (the context_window plan entries on either side of the unit) or
+    # "summary" (a compact summary of the plan written once per example, plus the window)
+    context_strategy = "full"
+    context_window = 2
+    # Units generated per call: 1 is one call per unit, 0 picks k from the unit
+    # length and the model's context and output limits
+    units_per_call = 1
+    max_units_per_call = 10
+    batch_stats = {"calls": 0, "units": 0, "fallbacks": 0}
+    # Editor passes allowed to bring a unit within 10% of its length requirement
+    max_refinements = 3
+    refine_stats = {"units": 0, "in_range": 0, "trimmed": 0, "refinements": 0, "capped": 0}
+    # Candidates sampled per unit call (the n parameter); the one closest to the
+    # length requirement is kept, so fewer units need the serial refinement loop
+    best_of = 1
 
     @staticmethod
-    async def async_generate(model, example, semaphore):
+    async def async_generate(model, example, semaphore, reuse=None, on_unit=None):
+        """
+        Generate the units of a planned example. reuse, if given, lists an
+        already generated unit (or None) per plan entry; only the None entries
+        are generated. on_unit(index, unit), if given, is called as each
+        generated unit is finished (refined).
+        """
+        if reuse is not None and all(unit is not None for unit in reuse):
+            final_text = {
+                "Week": GenerationAgent.get_final_week_text,
+                "Floor": GenerationAgent.get_final_floor_text,
+                "Menu Week": GenerationAgent.get_final_menu_text,
+                "Block": GenerationAgent.get_final_block_text,
+            }[example["type"]]
+            example[UNIT_KEYS[example["type"]]] = list(reuse)
+            example["final_text"] = final_text(example[UNIT_KEYS[example["type"]]])
+            return example
         if example['type'] == 'Week':
-            example = await GenerationAgent.async_generate_week(model, example, semaphore)
+            example = await GenerationAgent.async_generate_week(model, example, semaphore, reuse, on_unit)
         elif example["type"] == "Floor":
-            example = await GenerationAgent.async_generate_floor(model, example, semaphore)
+            example = await GenerationAgent.async_generate_floor(model, example, semaphore, reuse, on_unit)
         elif example["type"] == "Menu Week":
-            example = await GenerationAgent.async_generate_menu(model, example, semaphore)
+            example = await GenerationAgent.async_generate_menu(model, example, semaphore, reuse, on_unit)
         elif example["type"] == "Block":
-            example = await GenerationAgent.async_generate_block(model, example, semaphore)
+            example = await GenerationAgent.async_generate_block(model, example, semaphore, reuse, on_unit)
         return example
 
     @staticmethod
-    async def async_generate_week(model, example, semaphore):
-        async def process_week(week):
-            prompt = f"""You are an expert writer. 
-Write a 200-word weekly diary entry for the week of {week['week_id']}.
-The events for this week are: {week['events']}
-You should consider the coherence of the diary entry referring to the plan of the whole year:
-{example['weekly_plan']}
-You should consider the user requirements: {example['prompt']}
-Check from the user requirements if there are any special events that should be included in the diary entry. If there are, include them in the diary entry. If there are no special events, write a general diary entry for the week.
-Return the diary entry in the following json format:
-{{
-    "week_id": "{week['week_id']}",
-    "check": "reason and check if the user requirements are met",
-    "diary_entry": "Your 200-word diary entry here" 
-}}
-"""
-            logging.info(f"Generating initial diary entry for week {week['week_id']}")
+    async def _generate_unit(model, prompt, semaphore, text_key, unit_id, schema, length, max_tokens=None, max_trials=5):
+        """
+        Request a unit matching schema and return its text_key. Raises
+        UnitGenerationError after max_trials failed attempts rather than
+        returning an empty unit for the editor to invent from nothing.
+        length is (required words, requested words); with best_of > 1 the
+        candidate closest to the requirement is returned.
+        """
+        for trial in range(max_trials):
+            async with semaphore:
+                with call_context(stage="unit", unit_id=unit_id):
+                    responses = await async_call_llm_json_candidates(model, prompt, GenerationAgent.best_of,
+                                                                     schema=schema, schema_name=text_key,
+                                                                     stream=GenerationAgent.stream, max_tokens=max_tokens)
+            logging.debug(responses)
+
+            texts = [response[text_key] for response in responses
+                     if response is not None and isinstance(response.get(text_key), str) and response[text_key].strip()]
+            if texts:
+                return GenerationAgent._pick_closest(model, texts, *length)
+            logging.error(f"Failed to parse response. Trying again.")
+
+        logging.error(f"Failed to generate {unit_id} after {max_trials} attempts.")
+        raise UnitGenerationError(f"Failed to generate {unit_id} after {max_trials} attempts")
 
-            while True:
-                async with semaphore:
-                    response = await async_call_llm(model, prompt)
-                
-                # repair the json string
-                response = repair_json(response)
+    @staticmethod
+    def _length_budget(model, target_words):
+        """
+        Return (words to ask for, max_tokens) for one unit of target_words words,
+        from the model's calibrated length bias and words per token.
+        """
+        words = calibration.length_hint(model, target_words)
+        return words, calibration.max_tokens(model, max(words, target_words) + UNIT_OVERHEAD_WORDS)
+
+    @staticmethod
+    def _pick_closest(model, texts, required_length, requested_length):
+        """
+        Return the candidate whose length is closest to required_length. Every
+        candidate's length calibrates the model's length bias, as requested_length
+        is the word count they were asked for.
+        """
+        lengths = [count_words(text) for text in texts]
+        for length in lengths:
+            calibration.observe_length(model, requested_length, length)
+        best = min(range(len(texts)), key=lambda i: abs(lengths[i] - required_length))
+        return texts[best]
 
-                print(response)
+    @staticmethod
+    async def _refine_length(model, semaphore, text, required_length, unit_id):
+        """
+        Have the editor shorten or lengthen a first draft until it is within 10%
+        of required_length, for at most max_refinements passes. Overlong text is
+        first cut locally at a sentence boundary; the editor is only asked to
+        shorten it when no boundary lands in range. An empty refinement (a
+        failed call) is discarded and the previous text kept.
+        """
+        current_length = count_words(text)
+        logging.info(f"{unit_id} word count: {current_length}")
+        word_diff = abs(required_length - current_length)
+
+        stats = GenerationAgent.refine_stats
+        stats["units"] += 1
+        stats["in_range"] += word_diff <= required_length * 0.1
+        passes = 0
+        while word_diff > (required_length * 0.1):
+            if current_length > required_length:
+                trimmed = trim_to_length(text, required_length)
+                if trimmed is not None:
+                    logging.info(f"Trimmed {unit_id} from {current_length} to {count_words(trimmed)} words")
+                    stats["trimmed"] += 1
+                    return trimmed
+            if passes == GenerationAgent.max_refinements:
+                logging.warning(f"{unit_id} still {current_length} words after {passes} refinements; keeping it")
+                stats["capped"] += 1
+                break
+            refinement_prompt = f"""You are an expert editor. The provided text need to be {"shorten" if current_length > required_length else "lengthen"} by {word_diff} words while maintaining the original meaning and coherence.
+                Text:
+                {text}
+                Return only the refined text."""
 
-                match = re.search(r"\{.*\}", response, re.DOTALL)
-                if match:
-                    response = match.group(0)
+            logging.info(f"Refining text for {unit_id}")
+            async with semaphore:
+                with call_context(stage="refine", unit_id=unit_id):
+                    refined = await async_call_llm(model, refinement_prompt,
+                                                   max_tokens=calibration.max_tokens(model, required_length))
+            logging.info(f"Refined text: {refined}")
+            passes += 1
+            stats["refinements"] += 1
+            if not refined or not refined.strip():
+                # A failed call comes back empty; never let the editor pad nothing into a unit
+                logging.warning(f"Refinement of {unit_id} came back empty; keeping the previous text")
+                continue
+
+            text = refined
+            current_length = count_words(text)
+            word_diff = abs(required_length - current_length)
+        return text
 
-                    try:
-                        diary_entry = dict(json.loads(response))
+    @staticmethod
+    def _units_per_call(model, shared_context, target_words, n_units):
+        """
+        How many consecutive units to request per call. Adaptive k fills the
+        output budget, i.e. the smaller of the model's output limit and the
+        context left after the shared prompt, with units of max_tokens each.
+        """
+        k = GenerationAgent.units_per_call
+        if k == 0:
+            context_tokens, max_output_tokens = get_model_limits(model)
+            unit_tokens = GenerationAgent._length_budget(model, target_words)[1]
+            budget = min(max_output_tokens, context_tokens - estimate_tokens(shared_context) - unit_tokens)
+            k = min(GenerationAgent.max_units_per_call, budget // unit_tokens)
+        return max(1, min(k, n_units))
 
-                        week['diary_entry'] = diary_entry['diary_entry']
-                        week['length_requirement'] = 200
-                        logging.info(f"Diary entry word count: {count_words(diary_entry['diary_entry'])}")
-                    except json.JSONDecodeError: 
-                        logging.error(f"Failed to parse response. Trying again.")
-                        continue
+    @staticmethod
+    async def _generate_batch(model, prompt, semaphore, unit_ids, id_key, text_key, unit_schema, length, max_tokens):
+        """
+        Request several units in one call. Returns their texts in unit_ids order,
+        with None for units that are missing or malformed in the response. With
+        best_of > 1 each unit takes the closest-length text among the candidates.
+        Units are matched by unit number, so a model that shortens or reformats
+        an id ("Week 3" for "Week 3 (January 15th - January 21st)", "Floor 07")
+        still delivers them.
+        """
+        def match_key(unit_id):
+            number = unit_number(unit_id)
+            return number if number is not None else unit_id
+
+        async with semaphore:
+            with call_context(stage="unit_batch", unit_id=f"{unit_ids[0]} - {unit_ids[-1]}"):
+                responses = await async_call_llm_json_candidates(model, prompt, GenerationAgent.best_of,
+                                                                 schema=OutputSchemas.units_of(unit_schema),
+                                                                 schema_name="units", stream=GenerationAgent.stream,
+                                                                 max_tokens=min(max_tokens, get_model_limits(model)[1]))
+        candidates = {}
+        for response in responses:
+            if response is None or not isinstance(response.get("units"), list):
+                continue
+            texts = {}
+            for entry in response["units"]:
+                if isinstance(entry, dict) and isinstance(entry.get(text_key), str) and entry[text_key].strip():
+                    texts.setdefault(match_key(entry.get(id_key)), entry[text_key])
+            for unit_id, text in texts.items():
+                candidates.setdefault(unit_id, []).append(text)
+        results = [GenerationAgent._pick_closest(model, candidates[match_key(unit_id)], *length)
+                   if match_key(unit_id) in candidates else None
+                   for unit_id in unit_ids]
+
+        GenerationAgent.batch_stats["calls"] += 1
+        GenerationAgent.batch_stats["units"] += len(unit_ids)
+        GenerationAgent.batch_stats["fallbacks"] += results.count(None)
+        if None in results:
+            logging.warning(f"{results.count(None)} of {len(unit_ids)} units missing from the batch; generating them one by one")
+        return results
 
-                    break
+    @staticmethod
+    async def _fan_out(units, process_unit, generate_batch, units_per_call, reuse=None, on_unit=None):
+        """
+        Run process_unit(index, unit, text) for every unit concurrently. With
+        units_per_call > 1 the texts come from generate_batch(start, chunk) first;
+        units it could not deliver get text None, i.e. their own call. Units with
+        an entry in reuse are taken from it instead. on_unit(index, unit) is
+        called as each processed unit finishes.
+        """
+        pending = [index for index in range(len(units)) if reuse is None or reuse[index] is None]
+        results = list(reuse) if reuse is not None else [None] * len(units)
+        if on_unit is not None:
+            process = process_unit
+
+            async def process_unit(index, unit, text=None):
+                unit = await process(index, unit, text)
+                on_unit(index, unit)
+                return unit
+        if units_per_call <= 1:
+            done = await GenerationAgent._gather_or_cancel(process_unit(index, units[index]) for index in pending)
+        else:
+            # Chunks of consecutive pending units, so a chunk never spans a reused one
+            chunks = []
+            for index in pending:
+                if chunks and chunks[-1][-1] == index - 1 and len(chunks[-1]) < units_per_call:
+                    chunks[-1].append(index)
                 else:
-                    logging.error(f"Failed to parse response. Trying again.")
+                    chunks.append([index])
 
-            # Refine the diary entry
-            current_length = count_words(week['diary_entry'])
-            required_length = week['length_requirement']
+            async def process_chunk(indices):
+                chunk = [units[index] for index in indices]
+                texts = await generate_batch(indices[0], chunk)
+                return await asyncio.gather(*(process_unit(index, unit, text)
+                                              for index, unit, text in zip(indices, chunk, texts)))
 
-            word_diff = abs(required_length - current_length)
+            done = [unit for chunk in await GenerationAgent._gather_or_cancel(process_chunk(indices) for indices in chunks)
+                    for unit in chunk]
+        for index, unit in zip(pending, done):
+            results[index] = unit
+        return results
 
-            while word_diff > (required_length * 0.1):
-                refinement_prompt = f"""You are an expert editor. The provided text need to be {"shorten" if current_length > required_length else "lengthen"} by {word_diff} words while maintaining the original meaning and coherence.
-                Text:
-                {week['diary_entry']}
-                Return only the refined text."""
+    @staticmethod
+    async def _gather_or_cancel(coroutines):
+        """
+        Like asyncio.gather, but a failing unit cancels its siblings, so they do
+        not keep calling the model while the example is retried.
+        """
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
 
-                logging.info(f"Refining text for week {week['week_id']}")
-                async with semaphore:
-                    week['diary_entry'] = await async_call_llm(model, refinement_prompt)
-                logging.info(f"Refined text: {week['diary_entry']}")
+    @staticmethod
+    async def _warm_prefix(model, shared_context, semaphore):
+        """
+        Prefill the context shared by all units once before the fan-out, so the
+        sibling calls hit the server's prefix cache instead of all prefilling it
+        concurrently. A no-op unless the backend enables warm_prefix.
+        """
+        async with semaphore:
+            with call_context(stage="warm"):
+                await warm_prefix(model, shared_context)
 
-                current_length = count_words(week['diary_entry'])
+    @staticmethod
+    async def _plan_context(model, plan, example, semaphore, coherence):
+        """
+        Return the plan part of the context shared by all units, for the
+        configured context_strategy. coherence is the sentence introducing the plan.
+        """
+        if GenerationAgent.context_strategy == "full":
+            return f"{coherence}:\n{plan}\n"
+        if GenerationAgent.context_strategy == "summary":
+            summary = await GenerationAgent._summarize_plan(model, plan, example, semaphore)
+            return f"{coherence} (summary):\n{summary}\n"
+        return ""
 
-                word_diff = abs(required_length - current_length)
+    @staticmethod
+    async def _summarize_plan(model, plan, example, semaphore):
+        """
+        Summarise the plan once per example for the "summary" strategy; falls back to the full plan.
+        """
+        prompt = f"""You are an expert planner. Summarise the following plan in at most 300 words.
+Keep every special event or requirement together with the ids of the units it applies to, and describe the overall progression. Leave out routine entries.
+Plan:
+{plan}
+User requirements: {example['prompt']}
+Return only the summary."""
+        async with semaphore:
+            with call_context(stage="summary"):
+                summary = await async_call_llm(model, prompt)
+        return summary or str(plan)
 
+    @staticmethod
+    def _neighbour_context(plan, start, end, unit_name):
+        """
+        Return the plan entries around plan[start:end] for the "window" and "summary" strategies.
+        """
+        if GenerationAgent.context_strategy == "full":
+            return ""
+        k = GenerationAgent.context_window
+        neighbours = plan[max(0, start - k):start] + plan[end:end + k]
+        if not neighbours:
+            return ""
+        return f"You should keep it coherent with the plan of the neighbouring {unit_name}:\n{neighbours}\n"
+
+    @staticmethod
+    async def async_generate_week(model, example, semaphore, reuse=None, on_unit=None):
+        # Snapshot the plan before the fan-out: units are written back into
+        # example['weekly_plan'] as they finish, which would change sibling prompts.
+        plan = [dict(entry) for entry in example['weekly_plan']]
+        plan_context = await GenerationAgent._plan_context(
+            model, plan, example, semaphore,
+            "You should consider the coherence of the diary entry referring to the plan of the whole year")
+        # Context shared by every week goes first and is byte-identical across
+        # the fan-out, so the server's prefix cache can reuse it; the week comes last.
+        shared_context = f"""You are an expert writer. 
+You are writing a diary for a whole year, one 200-word entry per week.
+{plan_context}You should consider the user requirements: {example['prompt']}
+Check from the user requirements if there are any special events that should be included in the diary entry. If there are, include them in the diary entry. If there are no special events, write a general diary entry for the week.
+"""
+        await GenerationAgent._warm_prefix(model, shared_context, semaphore)
+        words, max_tokens = GenerationAgent._length_budget(model, 200)
+
+        async def process_week(index, week, text=None):
+            if text is None:
+                neighbours = GenerationAgent._neighbour_context(plan, index, index + 1, "weeks")
+                prompt = shared_context + f"""
+{neighbours}Write a {words}-word weekly diary entry for the week of {week['week_id']}.
+The events for this week are: {week['events']}
+Return the diary entry in the following json format:
+{{
+    "week_id": "{week['week_id']}",
+    "check": "reason and check if the user requirements are met",
+    "diary_entry": "Your {words}-word diary entry here" 
+}}
+"""
+                logging.info(f"Generating initial diary entry for week {week['week_id']}")
+
+                text = await GenerationAgent._generate_unit(model, prompt, semaphore, 'diary_entry', week['week_id'], OutputSchemas.DIARY_ENTRY,
+                                                            (200, words), max_tokens=max_tokens)
+            week['diary_entry'] = text
+            week['length_requirement'] = 200
+            week['diary_entry'] = await GenerationAgent._refine_length(
+                model, semaphore, week['diary_entry'], week['length_requirement'], week['week_id'])
             logging.info(f"Final diary entry word count: {count_words(week['diary_entry'])}")
             return week
 
         # Process all weeks concurrently
-        tasks = [process_week(week) for week in example['weekly_plan']]
-        example['weekly_plan'] = await asyncio.gather(*tasks)
+        async def generate_weeks(start, chunk):
+            neighbours = GenerationAgent._neighbour_context(plan, start, start + len(chunk), "weeks")
+            listing = "\n".join(f"- {week['week_id']}: {week['events']}" for week in chunk)
+            prompt = shared_context + f"""
+{neighbours}Write a {words}-word weekly diary entry for each of the following {len(chunk)} weeks:
+{listing}
+Return the diary entries in the following json format, one entry per week in the same order:
+{{
+    "units": [
+        {{
+            "week_id": "{chunk[0]['week_id']}",
+            "check": "reason and check if the user requirements are met",
+            "diary_entry": "Your {words}-word diary entry here"
+        }},
+        ...
+    ]
+}}
+"""
+            logging.info(f"Generating {len(chunk)} weeks from {chunk[0]['week_id']}")
+            return await GenerationAgent._generate_batch(
+                model, prompt, semaphore, [week['week_id'] for week in chunk], 'week_id', 'diary_entry', OutputSchemas.DIARY_ENTRY,
+                (200, words), max_tokens * len(chunk))
+
+        units_per_call = GenerationAgent._units_per_call(model, shared_context, 200, len(plan))
+        example['weekly_plan'] = await GenerationAgent._fan_out(example['weekly_plan'], process_week, generate_weeks, units_per_call, reuse, on_unit)
         
         example['final_text'] = GenerationAgent.get_final_week_text(example['weekly_plan'])
         return example
@@ -112,78 +417,73 @@ Return the diary entry in the following json format:
         return text
 
     @staticmethod
-    async def async_generate_floor(model, example, semaphore):
-        async def process_floor(floor):
-            prompt = f"""You are an expert disigner. 
-Write a 150-word skyscraper floor plan for the floor of {floor['floor_id']}.
-The purpose for this floor is: {floor['purpose']}
-You should consider the coherence of the floor plan by referring to the plan of the whole skyscraper:
-{example['floor_plan']}
-
+    async def async_generate_floor(model, example, semaphore, reuse=None, on_unit=None):
+        # Snapshot the plan before the fan-out: units are written back into
+        # example['floor_plan'] as they finish, which would change sibling prompts.
+        plan = [dict(entry) for entry in example['floor_plan']]
+        plan_context = await GenerationAgent._plan_context(
+            model, plan, example, semaphore,
+            "You should consider the coherence of the floor plan by referring to the plan of the whole skyscraper")
+        # Shared context first (prefix-cacheable across floors), the floor last
+        shared_context = f"""You are an expert disigner. 
+You are designing a skyscraper, one 150-word plan per floor.
+{plan_context}
 You should consider the user requirements: {example['prompt']}
 Check from the user requirements if there are any special requirement that should be included in the floor plan. If there are, include them in the floor plan. If there are no special events, write a general floor plan.
+"""
+        await GenerationAgent._warm_prefix(model, shared_context, semaphore)
+        words, max_tokens = GenerationAgent._length_budget(model, 150)
+
+        async def process_floor(index, floor, text=None):
+            if text is None:
+                neighbours = GenerationAgent._neighbour_context(plan, index, index + 1, "floors")
+                prompt = shared_context + f"""
+{neighbours}Write a {words}-word skyscraper floor plan for the floor of {floor['floor_id']}.
+The purpose for this floor is: {floor['purpose']}
 Return the floor plan for the floor of {floor['floor_id']} in the following json format:
 {{
     "floor_id": "{floor['floor_id']}",
     "check": "reason and check if the user requirements are met",
-    "plan": "Your 150-word floor plan here" 
+    "plan": "Your {words}-word floor plan here" 
 }}
 """
-            logging.info(f"Generating initial floor plan for floor {floor['floor_id']}")
-
-            while True:
-                async with semaphore:
-                    response = await async_call_llm(model, prompt)
-
-                # repair the json string
-                response = repair_json(response)
-
-                print(response)
-
-                match = re.search(r"\{.*\}", response, re.DOTALL)
-                if match:
-                    response = match.group(0)
-
-                    try:
-                        floor_plan = dict(json.loads(response))
-
-                        floor['plan'] = floor_plan['plan']
-                        floor['length_requirement'] = 150
-                        logging.info(f"floor plan word count: {count_words(floor['plan'])}")
-                    except json.JSONDecodeError: 
-                        logging.error(f"Failed to parse response. Trying again.")
-                        continue
-
-                    break
-                else:
-                    logging.error(f"Failed to parse response. Trying again.")
-
-            # Refine the floor plan
-            current_length = count_words(floor['plan'])
-            required_length = floor['length_requirement']
-
-            word_diff = abs(required_length - current_length)
-
-            while word_diff > (required_length * 0.1):
-                refinement_prompt = f"""You are an expert editor. The provided text need to be {"shorten" if current_length > required_length else "lengthen"} by {word_diff} words while maintaining the original meaning and coherence.
-                Text:
-                {floor['plan']}
-                Return only the refined text."""
-
-                logging.info(f"Refining text for floor {floor['floor_id']}")
-                async with semaphore:
-                    floor['plan'] = await async_call_llm(model, refinement_prompt)
-                logging.info(f"Refined text: {floor['plan']}")
-
-                current_length = count_words(floor['plan'])
-                word_diff = abs(required_length - current_length)
-
+                logging.info(f"Generating initial floor plan for floor {floor['floor_id']}")
+
+                text = await GenerationAgent._generate_unit(model, prompt, semaphore, 'plan', floor['floor_id'], OutputSchemas.FLOOR_UNIT,
+                                                            (150, words), max_tokens=max_tokens)
+            floor['plan'] = text
+            floor['length_requirement'] = 150
+            floor['plan'] = await GenerationAgent._refine_length(
+                model, semaphore, floor['plan'], floor['length_requirement'], floor['floor_id'])
             logging.info(f"Final floor plan word count: {count_words(floor['plan'])}")
             return floor
 
         # Process all floors concurrently
-        tasks = [process_floor(floor) for floor in example['floor_plan']]
-        example['floor_plan'] = await asyncio.gather(*tasks)
+        async def generate_floors(start, chunk):
+            neighbours = GenerationAgent._neighbour_context(plan, start, start + len(chunk), "floors")
+            listing = "\n".join(f"- {floor['floor_id']}: {floor['purpose']}" for floor in chunk)
+            prompt = shared_context + f"""
+{neighbours}Write a {words}-word skyscraper floor plan for each of the following {len(chunk)} floors:
+{listing}
+Return the floor plans in the following json format, one entry per floor in the same order:
+{{
+    "units": [
+        {{
+            "floor_id": "{chunk[0]['floor_id']}",
+            "check": "reason and check if the user requirements are met",
+            "plan": "Your {words}-word floor plan here"
+        }},
+        ...
+    ]
+}}
+"""
+            logging.info(f"Generating {len(chunk)} floors from {chunk[0]['floor_id']}")
+            return await GenerationAgent._generate_batch(
+                model, prompt, semaphore, [floor['floor_id'] for floor in chunk], 'floor_id', 'plan', OutputSchemas.FLOOR_UNIT,
+                (150, words), max_tokens * len(chunk))
+
+        units_per_call = GenerationAgent._units_per_call(model, shared_context, 150, len(plan))
+        example['floor_plan'] = await GenerationAgent._fan_out(example['floor_plan'], process_floor, generate_floors, units_per_call, reuse, on_unit)
 
         example['final_text'] = GenerationAgent.get_final_floor_text(example['floor_plan'])
 
@@ -205,80 +505,74 @@ Return the floor plan for the floor of {floor['floor_id']} in the following json
         return text
     
     @staticmethod
-    async def async_generate_menu(model, example, semaphore):
-        async def process_menu(week):
-            prompt = f"""You are an expert chef. 
-Write a 200-word weekly menu plan for the week of {week['week_id']}.
-The dishes for this week are: {week['dishes']}
-You should consider the coherence of the menu plan referring to the plan of the whole year:
-{example['weekly_plan']}
-You should consider the user requirements: {example['prompt']}
+    async def async_generate_menu(model, example, semaphore, reuse=None, on_unit=None):
+        # Snapshot the plan before the fan-out: units are written back into
+        # example['weekly_plan'] as they finish, which would change sibling prompts.
+        plan = [dict(entry) for entry in example['weekly_plan']]
+        plan_context = await GenerationAgent._plan_context(
+            model, plan, example, semaphore,
+            "You should consider the coherence of the menu plan referring to the plan of the whole year")
+        # Shared context first (prefix-cacheable across weeks), the week last
+        shared_context = f"""You are an expert chef. 
+You are planning the menus for a whole year, one 200-word menu plan per week.
+{plan_context}You should consider the user requirements: {example['prompt']}
 Check from the user requirements if there are any special dishes that should be included in the menu plan. If there are, include them in the menu plan. If there are no special dishes, write a general menu plan for the week.
+"""
+        await GenerationAgent._warm_prefix(model, shared_context, semaphore)
+        words, max_tokens = GenerationAgent._length_budget(model, 200)
+
+        async def process_menu(index, week, text=None):
+            if text is None:
+                neighbours = GenerationAgent._neighbour_context(plan, index, index + 1, "weeks")
+                prompt = shared_context + f"""
+{neighbours}Write a {words}-word weekly menu plan for the week of {week['week_id']}.
+The dishes for this week are: {week['dishes']}
 Return the menu plan in the following json format:
 {{
     "week_id": "{week['week_id']}",
     "check": "reason and check if the user requirements are met",
-    "week_menu": "Your 200-word menu plan here"
+    "week_menu": "Your {words}-word menu plan here"
 }}
 """
-            logging.info(f"Generating initial menu plan for week {week['week_id']}")
+                logging.info(f"Generating initial menu plan for week {week['week_id']}")
 
-            print(f"Input Prompt: {prompt}")
-
-            while True:
-                async with semaphore:
-                    response = await async_call_llm(model, prompt)
-                
-                # repair the json string
-                response = repair_json(response)
-
-                print(response)
-
-                match = re.search(r"\{.*\}", response, re.DOTALL)
-                if match:
-                    response = match.group(0)
-
-                    try:
-                        week_menu = dict(json.loads(response))
-
-                        week['week_menu'] = week_menu['week_menu']
-                        week['length_requirement'] = 200
-                        logging.info(f"Diary entry word count: {count_words(week['week_menu'])}")
-                    except json.JSONDecodeError: 
-                        logging.error(f"Failed to parse response. Trying again.")
-                        continue
-
-                    break
-                else:
-                    logging.error(f"Failed to parse response. Trying again.")
-
-            # Refine the menu plan
-            current_length = count_words(week['week_menu'])
-            required_length = week['length_requirement']
-
-            word_diff = abs(required_length - current_length)
-
-            while word_diff > (required_length * 0.1):
-                refinement_prompt = f"""You are an expert editor. The provided text need to be {"shorten" if current_length > required_length else "lengthen"} by {word_diff} words while maintaining the original meaning and coherence.
-                Text:
-                {week['week_menu']}
-                Return only the refined text."""
-
-                logging.info(f"Refining text for week {week['week_id']}")
-                async with semaphore:
-                    week['week_menu'] = await async_call_llm(model, refinement_prompt)
-                logging.info(f"Refined text: {week['week_menu']}")
-
-                current_length = count_words(week['week_menu'])
-
-                word_diff = abs(required_length - current_length)
+                print(f"Input Prompt: {prompt}")
 
+                text = await GenerationAgent._generate_unit(model, prompt, semaphore, 'week_menu', week['week_id'], OutputSchemas.WEEK_MENU,
+                                                            (200, words), max_tokens=max_tokens)
+            week['week_menu'] = text
+            week['length_requirement'] = 200
+            week['week_menu'] = await GenerationAgent._refine_length(
+                model, semaphore, week['week_menu'], week['length_requirement'], week['week_id'])
             logging.info(f"Final menu plan word count: {count_words(week['week_menu'])}")
             return week
 
         # Process all weeks concurrently
-        tasks = [process_menu(week) for week in example['weekly_plan']]
-        example['weekly_plan'] = await asyncio.gather(*tasks)
+        async def generate_weeks(start, chunk):
+            neighbours = GenerationAgent._neighbour_context(plan, start, start + len(chunk), "weeks")
+            listing = "\n".join(f"- {week['week_id']}: {week['dishes']}" for week in chunk)
+            prompt = shared_context + f"""
+{neighbours}Write a {words}-word weekly menu plan for each of the following {len(chunk)} weeks:
+{listing}
+Return the menu plans in the following json format, one entry per week in the same order:
+{{
+    "units": [
+        {{
+            "week_id": "{chunk[0]['week_id']}",
+            "check": "reason and check if the user requirements are met",
+            "week_menu": "Your {words}-word menu plan here"
+        }},
+        ...
+    ]
+}}
+"""
+            logging.info(f"Generating {len(chunk)} weeks from {chunk[0]['week_id']}")
+            return await GenerationAgent._generate_batch(
+                model, prompt, semaphore, [week['week_id'] for week in chunk], 'week_id', 'week_menu', OutputSchemas.WEEK_MENU,
+                (200, words), max_tokens * len(chunk))
+
+        units_per_call = GenerationAgent._units_per_call(model, shared_context, 200, len(plan))
+        example['weekly_plan'] = await GenerationAgent._fan_out(example['weekly_plan'], process_menu, generate_weeks, units_per_call, reuse, on_unit)
         
         example['final_text'] = GenerationAgent.get_final_menu_text(example['weekly_plan'])
         return example
@@ -299,78 +593,73 @@ Return the menu plan in the following json format:
 
 
     @staticmethod
-    async def async_generate_block(model, example, semaphore):
-        async def process_block(block):
-            prompt = f"""You are an expert disigner. 
-Write a 150-word city block plan for the block of {block['block_id']}.
-The use for this block is: {block['use']}
-You should consider the coherence of the block plan by referring to the plan of the whole city:
-{example['block_plan']}
-
+    async def async_generate_block(model, example, semaphore, reuse=None, on_unit=None):
+        # Snapshot the plan before the fan-out: units are written back into
+        # example['block_plan'] as they finish, which would change sibling prompts.
+        plan = [dict(entry) for entry in example['block_plan']]
+        plan_context = await GenerationAgent._plan_context(
+            model, plan, example, semaphore,
+            "You should consider the coherence of the block plan by referring to the plan of the whole city")
+        # Shared context first (prefix-cacheable across blocks), the block last
+        shared_context = f"""You are an expert disigner. 
+You are designing a city, one 150-word plan per block.
+{plan_context}
 You should consider the user requirements: {example['prompt']}
 Check from the user requirements if there are any special requirement that should be included in the block plan. If there are, include them in the block plan. If there are no special events, write a general block plan.
+"""
+        await GenerationAgent._warm_prefix(model, shared_context, semaphore)
+        words, max_tokens = GenerationAgent._length_budget(model, 150)
+
+        async def process_block(index, block, text=None):
+            if text is None:
+                neighbours = GenerationAgent._neighbour_context(plan, index, index + 1, "blocks")
+                prompt = shared_context + f"""
+{neighbours}Write a {words}-word city block plan for the block of {block['block_id']}.
+The use for this block is: {block['use']}
 Return the block plan for the block of {block['block_id']} in the following json format:
 {{
     "block_id": "{block['block_id']}",
     "check": "reason and check if the user requirements are met",
-    "plan": "Your 150-word block plan here" 
+    "plan": "Your {words}-word block plan here" 
 }}
 """
-            logging.info(f"Generating initial block plan for block {block['block_id']}")
-
-            while True:
-                async with semaphore:
-                    response = await async_call_llm(model, prompt)
-
-                # repair the json string
-                response = repair_json(response)
-
-                print(response)
-
-                match = re.search(r"\{.*\}", response, re.DOTALL)
-                if match:
-                    response = match.group(0)
-
-                    try:
-                        block_plan = dict(json.loads(response))
-
-                        block['plan'] = block_plan['plan']
-                        block['length_requirement'] = 150
-                        logging.info(f"block plan word count: {count_words(block['plan'])}")
-                    except json.JSONDecodeError: 
-                        logging.error(f"Failed to parse response. Trying again.")
-                        continue
-
-                    break
-                else:
-                    logging.error(f"Failed to parse response. Trying again.")
-
-            # Refine the block plan
-            current_length = count_words(block['plan'])
-            required_length = block['length_requirement']
-
-            word_diff = abs(required_length - current_length)
-
-            while word_diff > (required_length * 0.1):
-                refinement_prompt = f"""You are an expert editor. The provided text need to be {"shorten" if current_length > required_length else "lengthen"} by {word_diff} words while maintaining the original meaning and coherence.
-                Text:
-                {block['plan']}
-                Return only the refined text."""
-
-                logging.info(f"Refining text for block {block['block_id']}")
-                async with semaphore:
-                    block['plan'] = await async_call_llm(model, refinement_prompt)
-                logging.info(f"Refined text: {block['plan']}")
-
-                current_length = count_words(block['plan'])
-                word_diff = abs(required_length - current_length)
-
+                logging.info(f"Generating initial block plan for block {block['block_id']}")
+
+                text = await GenerationAgent._generate_unit(model, prompt, semaphore, 'plan', block['block_id'], OutputSchemas.BLOCK_UNIT,
+                                                            (150, words), max_tokens=max_tokens)
+            block['plan'] = text
+            block['length_requirement'] = 150
+            block['plan'] = await GenerationAgent._refine_length(
+                model, semaphore, block['plan'], block['length_requirement'], block['block_id'])
             logging.info(f"Final block plan word count: {count_words(block['plan'])}")
             return block
 
         # Process all blocks concurrently
-        tasks = [process_block(block) for block in example['block_plan']]
-        example['block_plan'] = await asyncio.gather(*tasks)
+        async def generate_blocks(start, chunk):
+            neighbours = GenerationAgent._neighbour_context(plan, start, start + len(chunk), "blocks")
+            listing = "\n".join(f"- {block['block_id']}: {block['use']}" for block in chunk)
+            prompt = shared_context + f"""
+{neighbours}Write a {words}-word city block plan for each of the following {len(chunk)} blocks:
+{listing}
+Return the block plans in the following json format, one entry per block in the same order:
+{{
+    "units": [
+        {{
+            "block_id": "{chunk[0]['block_id']}",
+            "check": "reason and check if the user requirements are met",
+            "plan": "Your {words}-word block plan here"
+        }},
+        ...
+    ]
+}}
+"""
+            logging.info(f"Generating {len(chunk)} blocks from {chunk[0]['block_id']}")
+            return await GenerationAgent._generate_batch(
+                model, prompt, semaphore, [block['block_id'] for block in chunk], 'block_id', 'plan', OutputSchemas.BLOCK_UNIT,
+                (150, words), max_tokens * len(chunk))
+
+        units_per_call = GenerationAgent._units_per_call(model, shared_context, 150, len(plan))
+        example['block_plan'] = await GenerationAgent._fan_out(example['block_plan'], process_block, generate_blocks, units_per_call, reuse, on_unit)
 
         example['final_text'] = GenerationAgent.get_final_block_text(example['block_plan'])
 
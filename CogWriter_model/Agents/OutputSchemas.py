@@ -0,0 +1,107 @@
+"""
+JSON schemas of the responses PlanningAgent and GenerationAgent ask for.
+
+They are sent with each request so that backends supporting constrained
+decoding (OpenAI structured outputs, vLLM guided_json) can only produce
+parsable, complete objects, and are used to validate what comes back.
+Objects list every property as required and forbid extra ones, as OpenAI's
+strict mode demands. Validation enforces them everywhere except in the plan
+entries PlanningAgent requests, which it checks one by one, so one
+half-formed entry does not fail the whole plan.
+"""
+
+STRING = {"type": "string"}
+
+
+def _object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _array(items):
+    return {"type": "array", "items": items}
+
+
+# Plan entries (one per unit)
+WEEK = _object({"week_id": STRING, "events": STRING})
+MENU_WEEK = _object({"week_id": STRING, "dishes": STRING})
+FLOOR = _object({"floor_id": STRING, "purpose": STRING})
+BLOCK = _object({"block_id": STRING, "use": STRING})
+
+# Special units listed with a plan
+SPECIAL_EVENT = _object({"event_name": STRING, "week_numb": STRING})
+SPECIAL_DISH = _object({"dish_name": STRING, "week_numb": STRING})
+SPECIAL_FLOOR = _object({"special_purpose": STRING, "floor_number": STRING})
+SPECIAL_BLOCK = _object({"special_use": STRING, "block_number": STRING})
+
+# Plans and their revisions
+WEEK_PLAN = _object({
+    "analysis": STRING,
+    "special_events": _array(SPECIAL_EVENT),
+    "weekly_plan": _array(WEEK),
+})
+REVISED_WEEK_PLAN = _object({"analysis": STRING, "revised_weekly_plan": _array(WEEK)})
+
+MENU_PLAN = _object({
+    "analysis": STRING,
+    "special_dishes": _array(SPECIAL_DISH),
+    "weekly_plan": _array(MENU_WEEK),
+})
+REVISED_MENU_PLAN = _object({"analysis": STRING, "revised_weekly_plan": _array(MENU_WEEK)})
+
+FLOOR_PLAN = _object({
+    "analysis": STRING,
+    "special_floors": _array(SPECIAL_FLOOR),
+    "floor_plan": _array(FLOOR),
+})
+REVISED_FLOOR_PLAN = _object({"analysis": STRING, "revised_floor_plan": _array(FLOOR)})
+
+BLOCK_PLAN = _object({
+    "analysis": STRING,
+    "special_blocks": _array(SPECIAL_BLOCK),
+    "block_plan": _array(BLOCK),
+})
+REVISED_BLOCK_PLAN = _object({"analysis": STRING, "revised_block_plan": _array(BLOCK)})
+
+# Revisions that list only the changed entries
+WEEK_PLAN_PATCH = _object({"analysis": STRING, "changes": _array(WEEK)})
+MENU_PLAN_PATCH = _object({"analysis": STRING, "changes": _array(MENU_WEEK)})
+FLOOR_PLAN_PATCH = _object({"analysis": STRING, "changes": _array(FLOOR)})
+BLOCK_PLAN_PATCH = _object({"analysis": STRING, "changes": _array(BLOCK)})
+
+# Hierarchical planning: an outline of the whole plan, then one call per unit range
+PLAN_OUTLINES = {
+    "Week": _object({"analysis": STRING, "special_events": _array(SPECIAL_EVENT)}),
+    "Menu Week": _object({"analysis": STRING, "special_dishes": _array(SPECIAL_DISH)}),
+    "Floor": _object({"analysis": STRING, "special_floors": _array(SPECIAL_FLOOR)}),
+    "Block": _object({"analysis": STRING, "special_blocks": _array(SPECIAL_BLOCK)}),
+}
+PLAN_RANGES = {
+    "Week": _object({"range_plan": _array(WEEK)}),
+    "Menu Week": _object({"range_plan": _array(MENU_WEEK)}),
+    "Floor": _object({"range_plan": _array(FLOOR)}),
+    "Block": _object({"range_plan": _array(BLOCK)}),
+}
+
+# Entries requested to fill the gaps of a truncated or incomplete plan
+PLAN_GAPS = {
+    "Week": _object({"missing_entries": _array(WEEK)}),
+    "Menu Week": _object({"missing_entries": _array(MENU_WEEK)}),
+    "Floor": _object({"missing_entries": _array(FLOOR)}),
+    "Block": _object({"missing_entries": _array(BLOCK)}),
+}
+
+# Generated units
+DIARY_ENTRY = _object({"week_id": STRING, "check": STRING, "diary_entry": STRING})
+WEEK_MENU = _object({"week_id": STRING, "check": STRING, "week_menu": STRING})
+FLOOR_UNIT = _object({"floor_id": STRING, "check": STRING, "plan": STRING})
+BLOCK_UNIT = _object({"block_id": STRING, "check": STRING, "plan": STRING})
+
+
+def units_of(unit_schema):
+    """Schema of a response carrying several units, for multi-unit calls."""
+    return _object({"units": _array(unit_schema)})
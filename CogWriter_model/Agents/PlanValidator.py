@@ -0,0 +1,57 @@
+import re
+
+# Per example type: plan key, unit id key, entry text key, unit count, and the
+# special-entry list with its name and unit-number keys
+PLAN_SPECS = {
+    "Week": ("weekly_plan", "week_id", "events", 52, "special_events", "event_name", "week_numb"),
+    "Menu Week": ("weekly_plan", "week_id", "dishes", 52, "special_dishes", "dish_name", "week_numb"),
+    "Floor": ("floor_plan", "floor_id", "purpose", 100, "special_floors", "special_purpose", "floor_number"),
+    "Block": ("block_plan", "block_id", "use", 100, "special_blocks", "special_use", "block_number"),
+}
+
+UNIT_NUMBER = re.compile(r"(?:week|floor|block)\s*#?\s*(\d+)", re.IGNORECASE)
+
+
+def unit_number(text):
+    match = UNIT_NUMBER.search(str(text))
+    return int(match.group(1)) if match else None
+
+
+def _mentions(entry_text, name):
+    """True if every significant word of name occurs in entry_text (whole name for non-Latin text)."""
+    words = [word for word in re.findall(r"[a-z0-9]+", name.lower()) if len(word) >= 3]
+    if not words:
+        return name.strip().lower() in entry_text.lower()
+    entry_words = set(re.findall(r"[a-z0-9]+", entry_text.lower()))
+    return all(word in entry_words for word in words)
+
+
+class PlanValidator:
+
+    @staticmethod
+    def validate(example_type, response):
+        """
+        Check an initial plan response locally; return a list of problems (empty if it looks right).
+
+        The plan must have one entry per unit (52 weeks, 100 floors or blocks)
+        numbered 1..N in order without gaps or repeats, and every special entry
+        the model listed must appear in the plan entry of the unit it names.
+        """
+        plan_key, id_key, text_key, count, special_key, name_key, number_key = PLAN_SPECS[example_type]
+        plan = response.get(plan_key) or []
+        problems = []
+        if len(plan) != count:
+            problems.append(f"{len(plan)} {plan_key} entries, expected {count}")
+        numbers = [unit_number(entry.get(id_key, "")) for entry in plan]
+        if numbers != list(range(1, len(plan) + 1)):
+            problems.append(f"{id_key}s are not numbered 1..{len(plan)} in order")
+
+        entries = dict(zip(numbers, plan))
+        for special in response.get(special_key) or []:
+            name = str(special.get(name_key, ""))
+            number = unit_number(special.get(number_key, ""))
+            if number is None or number not in entries:
+                problems.append(f"{special_key} '{name}' names no unit of the plan ({special.get(number_key)})")
+            elif not _mentions(str(entries[number].get(text_key, "")), name):
+                problems.append(f"{special_key} '{name}' is missing from {entries[number].get(id_key)}")
+        return problems
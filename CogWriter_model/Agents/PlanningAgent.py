@@ -1,26 +1,325 @@
-import json
-import logging
-import re
-from llms.llms import async_call_llm
-from json_repair import repair_json
 import asyncio
+import logging
+from llms.llms import async_call_llm_json
+from llms.telemetry import call_context
+from CogWriter_model.Agents import OutputSchemas
+from CogWriter_model.Agents.PlanValidator import PLAN_SPECS, PlanValidator, unit_number
+
+# How the units of each example type are named in gap-filling and range prompts
+UNIT_NOUNS = {"Week": "week", "Menu Week": "week", "Floor": "floor", "Block": "block"}
+# Planner role and plan subject of each example type, for range planning
+PLAN_TASKS = {
+    "Week": ("expert writer", "a weekly plan containing 52 weeks"),
+    "Menu Week": ("expert chef", "a weekly menu plan containing 52 weeks"),
+    "Floor": ("expert architect", "a plan for constructing a skyscraper with 100 floors"),
+    "Block": ("expert designer", "a plan for designing a city with 10x10 block grid, numbered from 1 to 100"),
+}
 
 class PlanningAgent:
+    # Stream plan responses and stop reading once the JSON object closes
+    stream = False
+    # How revisions come back: "full" re-emits the whole plan, "patch" lists only
+    # the changed entries, which are merged locally (falling back to "full" when
+    # the patch does not fit the plan)
+    revision = "full"
+    revision_stats = {"patched": 0, "changed_entries": 0, "fallbacks": 0}
+    # Skip the revise call when the initial plan passes PlanValidator
+    validate_plans = False
+    validation_stats = {"checked": 0, "passed": 0}
+    # Plan in one call (0), or outline first and then plan ranges of this many
+    # units concurrently
+    range_size = 0
+    # Calls made to fill units missing from the final plan (0 disables gap filling)
+    gap_trials = 2
+    gap_stats = {"plans_with_gaps": 0, "filled": 0, "unfilled": 0}
+
     @staticmethod
-    async def async_create_hierarchy(model, example, semaphore):
+    async def async_create_hierarchy(model, example, semaphore, on_initial_plan=None, initial_plan=None):
+        """
+        Plan the example's units. on_initial_plan(example, response), if given,
+        is called with the initial plan in place and the initial plan response,
+        before the revision call is made. initial_plan, a response passed to an
+        earlier on_initial_plan, resumes planning from it without requesting a
+        new initial plan.
+        """
         if example["type"] == "Week":
-            example = await PlanningAgent.async_create_week_plan(model, example, semaphore)
+            example = await PlanningAgent.async_create_week_plan(model, example, semaphore, on_initial_plan, initial_plan)
         elif example["type"] == "Floor":
-            example = await PlanningAgent.async_create_floor_plan(model, example, semaphore)
+            example = await PlanningAgent.async_create_floor_plan(model, example, semaphore, on_initial_plan, initial_plan)
         elif example["type"] == "Menu Week":
-            example = await PlanningAgent.async_create_menu_plan(model, example, semaphore)
+            example = await PlanningAgent.async_create_menu_plan(model, example, semaphore, on_initial_plan, initial_plan)
         elif example["type"] == "Block":
-            example = await PlanningAgent.async_create_block_plan(model, example, semaphore)
+            example = await PlanningAgent.async_create_block_plan(model, example, semaphore, on_initial_plan, initial_plan)
+
+        if PlanningAgent.gap_trials > 0 and example["type"] in PLAN_SPECS:
+            example = await PlanningAgent._fill_gaps(model, example, semaphore)
+        return example
+
+    @staticmethod
+    async def _plan_by_ranges(model, example, semaphore):
+        """
+        Plan the example hierarchically: a short outline call extracts the
+        analysis and the special units, then the plan is written range_size
+        units at a time with the range calls running concurrently. Returns a
+        response shaped like the single-call plan (analysis, special units and
+        the merged plan), or None if the outline fails. Units a range call
+        fails to deliver are left to gap filling.
+        """
+        plan_key, id_key, text_key, count, special_key, name_key, number_key = PLAN_SPECS[example["type"]]
+        role, subject = PLAN_TASKS[example["type"]]
+        noun = UNIT_NOUNS[example["type"]]
+        outline_prompt = f"""
+You are an {role}, and your task is to prepare {subject}.
+User requirements:
+{example['prompt']}
+
+Think step by step. Analyse the user requirements to identify the overall constraints of the plan, and the special {noun}s with their exact {noun} number, and list them in "{special_key}". If a requirement is periodic, list each occurrence seperately by number. Do not write the {noun}-by-{noun} plan yet.
+Return your analysis in ONLY this exact JSON format:
+{{
+    "analysis": "",
+    "{special_key}": [
+        {{
+            "{name_key}": "{name_key.replace('_', ' ')}",
+            "{number_key}": "{noun.capitalize()} number"
+        }},
+        ...
+    ]
+}}"""
+        logging.debug(outline_prompt)
+        outline = await PlanningAgent._request_plan(model, outline_prompt, semaphore, special_key, "Outlining plan", "plan",
+                                                    OutputSchemas.PLAN_OUTLINES[example["type"]], full_response=True,
+                                                    entries=False)
+        if outline is None:
+            logging.warning("Plan outline failed; planning in a single call")
+            return None
+
+        async def plan_range(low, high):
+            range_prompt = f"""
+You are an {role}, and your task is to write part of {subject}.
+User requirements:
+{example['prompt']}
+
+Analysis of the whole plan:
+{outline.get('analysis', '')}
+
+Special {noun}s of the whole plan:
+{outline[special_key]}
+
+Plan {noun}s: {low}-{high}
+
+Think step by step. Write one entry for each {noun} from {low} to {high}, following the analysis and the user requirements. Strictly follow "{special_key}" for the {noun}s they name.
+Return the entries in ONLY this exact JSON format:
+{{
+    "range_plan": [
+        {{
+            "{id_key}": "{example['type']} {low}",
+            "{text_key}": ""
+        }},
+        ...
+    ]
+}}"""
+            entries = await PlanningAgent._request_plan(model, range_prompt, semaphore, "range_plan",
+                                                        f"Planning {noun}s {low}-{high}", "plan",
+                                                        OutputSchemas.PLAN_RANGES[example["type"]], max_trials=2)
+            usable = PlanningAgent._usable_entries(example["type"], entries or [])
+            return {number: entry for number, entry in usable.items() if low <= number <= high}
+
+        size = PlanningAgent.range_size
+        ranges = [(low, min(low + size - 1, count)) for low in range(1, count + 1, size)]
+        merged = {}
+        for entries in await asyncio.gather(*(plan_range(low, high) for low, high in ranges)):
+            merged.update(entries)
+        logging.info(f"Planned {len(merged)} of {count} {noun}s in {len(ranges)} concurrent range calls")
+        return {
+            "analysis": outline.get("analysis", ""),
+            special_key: outline[special_key],
+            plan_key: [merged[number] for number in sorted(merged)],
+        }
+
+    @staticmethod
+    def _usable_entries(example_type, plan):
+        """
+        Map unit number to plan entry for the well-formed entries of plan: a
+        dict with an id naming a unit in range and a non-empty text. The first
+        entry wins when a unit appears twice.
+        """
+        _, id_key, text_key, count = PLAN_SPECS[example_type][:4]
+        entries = {}
+        for entry in plan:
+            if not isinstance(entry, dict) or not str(entry.get(text_key) or "").strip():
+                continue
+            number = unit_number(entry.get(id_key, ""))
+            if number is not None and 1 <= number <= count and number not in entries:
+                entries[number] = entry
+        return entries
+
+    @staticmethod
+    def _ranges(numbers):
+        """Format sorted unit numbers as ranges, e.g. [5, 88, 89, 90] -> "5, 88-90"."""
+        runs = []
+        for number in numbers:
+            if runs and number == runs[-1][1] + 1:
+                runs[-1][1] = number
+            else:
+                runs.append([number, number])
+        return ", ".join(str(low) if low == high else f"{low}-{high}" for low, high in runs)
+
+    @staticmethod
+    async def _fill_gaps(model, example, semaphore):
+        """
+        Find the units missing from the example's plan (dropped, truncated away,
+        repeated or malformed) and ask for only those entries, instead of
+        re-emitting the whole plan. Filled entries are spliced in by unit number.
+        Gaps left after gap_trials calls stay missing and are logged.
+        """
+        plan_key, id_key, text_key, count = PLAN_SPECS[example["type"]][:4]
+        plan = example.get(plan_key)
+        if not isinstance(plan, list) or not plan:
+            # Planning failed outright; there is nothing to splice into
+            return example
+        entries = PlanningAgent._usable_entries(example["type"], plan)
+        missing = [number for number in range(1, count + 1) if number not in entries]
+        if not missing and len(plan) == count:
+            return example
+
+        stats = PlanningAgent.gap_stats
+        stats["plans_with_gaps"] += 1
+        noun = UNIT_NOUNS[example["type"]]
+        for trial in range(PlanningAgent.gap_trials):
+            if not missing:
+                break
+            ranges = PlanningAgent._ranges(missing)
+            logging.info(f"Plan is missing {len(missing)} of {count} {noun}s ({ranges}); requesting only those")
+            # The entries on either side of each gap, for continuity and id format
+            neighbours = [entries[number] for number in sorted(entries)
+                          if any(abs(number - gap) <= 2 for gap in missing)]
+            fill_prompt = f"""
+You are completing a plan with {count} {noun}s, numbered 1 to {count}. Some {noun}s are missing from it.
+User requirements:
+{example['prompt']}
+
+Existing entries around the missing {noun}s:
+{neighbours}
 
+Missing {noun}s: {ranges}
+
+Think step by step. Write one entry for each missing {noun}, following the user requirements and the style and id format of the existing entries. Do not repeat {noun}s that already exist.
+Return the missing entries in ONLY this exact JSON format:
+{{
+    "missing_entries": [
+        {{
+            "{id_key}": "{example['type']} {missing[0]}",
+            "{text_key}": ""
+        }},
+        ...
+    ]
+}}"""
+            filled = await PlanningAgent._request_plan(model, fill_prompt, semaphore, "missing_entries",
+                                                       "Filling plan gaps", "plan_gaps",
+                                                       OutputSchemas.PLAN_GAPS[example["type"]], max_trials=1)
+            for number, entry in PlanningAgent._usable_entries(example["type"], filled or []).items():
+                if number not in entries:
+                    entries[number] = dict(entry)
+                    stats["filled"] += 1
+            missing = [number for number in range(1, count + 1) if number not in entries]
+
+        if missing:
+            stats["unfilled"] += len(missing)
+            logging.warning(f"Plan is still missing {noun}s {PlanningAgent._ranges(missing)} "
+                            f"after {PlanningAgent.gap_trials} gap-filling calls")
+        example[plan_key] = [entries[number] for number in sorted(entries)]
         return example
 
     @staticmethod
-    async def async_create_week_plan(model, example, semaphore):
+    async def _request_plan(model, prompt, semaphore, key, label, stage, schema, max_trials=3, full_response=False,
+                            entries=True):
+        """
+        Request a plan matching schema and return response[key] (the whole
+        response with full_response), or None after max_trials failed attempts.
+        stage tags the calls in telemetry ("plan" or "revise"). With entries,
+        response[key] holds plan entries: half-formed ones (missing a key or
+        with an empty one) are dropped rather than failing the response, and
+        the units they leave out are requested by gap filling. Everything else
+        must match schema in full.
+        """
+        for trial in range(max_trials):
+            logging.info(label)
+            async with semaphore:
+                with call_context(stage=stage):
+                    response = await async_call_llm_json(model, prompt, schema=schema, schema_name=key,
+                                                         partial_keys=(key,) if entries else (),
+                                                         stream=PlanningAgent.stream)
+            print(response)
+
+            if response is not None and key in response:
+                kept = PlanningAgent._well_formed(response[key], schema["properties"][key]) if entries else response[key]
+                if kept or not response[key]:
+                    response[key] = kept
+                    return response if full_response else response[key]
+            logging.error(f"Response does not contain usable '{key}'. Trying again.")
+
+        logging.error(f"Failed to process example after {max_trials} attempts. Skipping.")
+        return None
+
+    @staticmethod
+    def _well_formed(entries, schema):
+        """The entries of a list that have every key of the schema's items, with a non-empty value."""
+        keys = schema.get("items", {}).get("required")
+        if not isinstance(entries, list) or not keys:
+            return entries
+        kept = [entry for entry in entries
+                if isinstance(entry, dict) and all(str(entry.get(key) or "").strip() for key in keys)]
+        if len(kept) < len(entries):
+            logging.warning(f"Dropped {len(entries) - len(kept)} half-formed of {len(entries)} entries")
+        return kept
+
+    @staticmethod
+    def _skip_revision(example, response):
+        """True if validate_plans is on and the initial plan response passes PlanValidator."""
+        if not PlanningAgent.validate_plans or response is None:
+            return False
+        problems = PlanValidator.validate(example["type"], response)
+        PlanningAgent.validation_stats["checked"] += 1
+        if problems:
+            logging.info(f"Initial plan needs revision: {'; '.join(problems[:3])}")
+            return False
+        PlanningAgent.validation_stats["passed"] += 1
+        logging.info("Initial plan passed validation; skipping the revise call")
+        return True
+
+    @staticmethod
+    async def _revise_by_patch(model, prompt, semaphore, plan, id_key, schema):
+        """
+        Request the changed entries of plan and return the patched plan, or None
+        if the patch is unusable (no response, unknown or repeated ids), in which
+        case the caller falls back to a full revision.
+        """
+        logging.debug(prompt)
+        changes = await PlanningAgent._request_plan(model, prompt, semaphore, "changes", "Revising plan (changes only)",
+                                                    "revise", schema, max_trials=1)
+        stats = PlanningAgent.revision_stats
+        if changes is None:
+            stats["fallbacks"] += 1
+            return None
+        positions = {entry.get(id_key): index for index, entry in enumerate(plan)}
+        ids = [change[id_key] for change in changes]
+        unknown = [unit_id for unit_id in ids if unit_id not in positions]
+        if unknown or len(set(ids)) != len(ids) or len(positions) != len(plan):
+            logging.warning(f"Plan patch does not fit the plan (unknown or repeated ids: {unknown or ids}); "
+                            f"requesting the full revised plan")
+            stats["fallbacks"] += 1
+            return None
+
+        patched = [dict(entry) for entry in plan]
+        for change in changes:
+            patched[positions[change[id_key]]] = dict(change)
+        stats["patched"] += 1
+        stats["changed_entries"] += len(changes)
+        logging.info(f"Plan patch changed {len(changes)} of {len(plan)} entries")
+        return patched
+
+    @staticmethod
+    async def async_create_week_plan(model, example, semaphore, on_initial_plan=None, initial_plan=None):
         plan_prompt = f"""
 You are an expert writer, and your task is to create a weekly plan containing 52 weeks.
 User requirements:
@@ -64,41 +363,20 @@ Return your analysis and plan in ONLY this exact json format:
     ]
 }}"""
         
-        print(plan_prompt)
-        trial = 0
-        while True:
-            logging.info(f"Creating initial plan")
-
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, plan_prompt)
-
-                # repair the json string
-                response = repair_json(response)    
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error(f"Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error(f"Trying again.")
-
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response = dict(json.loads(match.group(0)))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error(f"Failed to parse response. Trying again.")
-                    continue
-
-                example["weekly_plan"] = response["weekly_plan"]
-                break
-            else:
-                trial += 1
-                logging.error(f"Failed to parse response. Trying again.")
+        response = initial_plan
+        if response is None and PlanningAgent.range_size > 0:
+            response = await PlanningAgent._plan_by_ranges(model, example, semaphore)
+        if response is None:
+            print(plan_prompt)
+            response = await PlanningAgent._request_plan(model, plan_prompt, semaphore, "weekly_plan", "Creating initial plan", "plan", OutputSchemas.WEEK_PLAN,
+                                                         full_response=True)
+        plan = response["weekly_plan"] if response is not None else None
+        if plan is not None:
+            example["weekly_plan"] = plan
+            if on_initial_plan is not None:
+                on_initial_plan(example, response)
+        if PlanningAgent._skip_revision(example, response):
+            return example
 
         # Revise the plan
         revise_prompt = f"""
@@ -124,47 +402,43 @@ Return your analysis and revised plan in ONLY this exact json format:
     ]
 }}"""
 
-        print(revise_prompt)
-
-        trial = 0
-        while True:
-            logging.info(f"Revising plan")
-
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, revise_prompt)
-
-                # repair the json string
-                response = repair_json(response)
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error(f"Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error(f"Trying again.")
-
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response = dict(json.loads(match.group(0)))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error(f"Failed to parse response. Trying again.")
-                    continue
-
-                example["weekly_plan"] = response["revised_weekly_plan"]
-                break
-            else:
-                trial += 1
-                logging.error(f"Failed to parse response. Trying again.")
+        plan = None
+        if PlanningAgent.revision == "patch":
+            patch_prompt = f"""
+You are an expert writer, and your task is to revise a weekly plan containing 52 weeks.
+Current weekly plan:
+{example['weekly_plan']}
+
+User requirements:
+{example['prompt']}
+
+Think step by step. The current week plan may contain some wrong infomation. 
+Refer to the user requirements to identify special events and their exact date. If the event is periodic, consider each occurrence seperately.
+Then list ONLY the weeks whose entry has to change, with their corrected entry. Copy each week_id exactly as it appears in the current plan. If no week has to change, return an empty list.
+Return your analysis and changes in ONLY this exact json format:
+{{
+    "analysis": "",
+    "changes": [
+        {{
+            "week_id": "Week 19 (May 7th - May 13th)",
+            "events": "Brifly list special events of this week"
+        }},
+        ...
+    ]
+}}"""
+            plan = await PlanningAgent._revise_by_patch(model, patch_prompt, semaphore, example["weekly_plan"], "week_id",
+                                                        OutputSchemas.WEEK_PLAN_PATCH)
+        if plan is None:
+            print(revise_prompt)
+
+            plan = await PlanningAgent._request_plan(model, revise_prompt, semaphore, "revised_weekly_plan", "Revising plan", "revise", OutputSchemas.REVISED_WEEK_PLAN)
+        if plan is not None:
+            example["weekly_plan"] = plan
 
         return example
 
     @staticmethod
-    async def async_create_floor_plan(model, example, semaphore):
+    async def async_create_floor_plan(model, example, semaphore, on_initial_plan=None, initial_plan=None):
         plan_prompt = f"""
 You are an expert architect, and your task is to write a plan for constructing a skyscraper with 100 floors.
 User requirements:
@@ -210,53 +484,20 @@ Return your analysis and plan in ONLY the following exact JSON format:
     ]
 }}"""
 
-        print(plan_prompt)
-        trial = 0
-        while True:
-            logging.info("Creating initial floor plan")
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, plan_prompt)
-
-                # repair the json string
-                response = repair_json(response)
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error("Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error("Trying again.")
-                continue
-
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response_dict = json.loads(match.group(0))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error("Failed to parse response as JSON. Trying again.")
-                    if trial >= 3:
-                        break
-                    continue
-
-                if "floor_plan" in response_dict:
-                    example["floor_plan"] = response_dict["floor_plan"]
-                else:
-                    logging.error("JSON does not contain 'floor_plan'. Trying again.")
-                    trial += 1
-                    if trial >= 3:
-                        break
-                    continue
-
-                break
-            else:
-                trial += 1
-                logging.error("Failed to find JSON in the response. Trying again.")
-                if trial >= 3:
-                    break
+        response = initial_plan
+        if response is None and PlanningAgent.range_size > 0:
+            response = await PlanningAgent._plan_by_ranges(model, example, semaphore)
+        if response is None:
+            print(plan_prompt)
+            response = await PlanningAgent._request_plan(model, plan_prompt, semaphore, "floor_plan", "Creating initial floor plan", "plan", OutputSchemas.FLOOR_PLAN,
+                                                         full_response=True)
+        plan = response["floor_plan"] if response is not None else None
+        if plan is not None:
+            example["floor_plan"] = plan
+            if on_initial_plan is not None:
+                on_initial_plan(example, response)
+        if PlanningAgent._skip_revision(example, response):
+            return example
 
         revise_prompt = f"""
 You are an expert architect. You have a skyscraper floor plan as follows:
@@ -282,58 +523,44 @@ Return your analysis and the final revised plan in ONLY this exact JSON format:
 }}
 """
 
-        print(revise_prompt)
-        trial = 0
-        while True:
-            logging.info("Revising floor plan")
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, revise_prompt)
-
-                # repair the json string
-                response = repair_json(response)
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error("Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error("Trying again.")
-                continue
+        plan = None
+        if PlanningAgent.revision == "patch":
+            patch_prompt = f"""
+You are an expert architect. You have a skyscraper floor plan as follows:
+{example['floor_plan']}
 
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response_dict = json.loads(match.group(0))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error("Failed to parse response as JSON. Trying again.")
-                    if trial >= 3:
-                        break
-                    continue
-
-                if "revised_floor_plan" in response_dict:
-                    example["floor_plan"] = response_dict["revised_floor_plan"]
-                else:
-                    logging.error("JSON does not contain 'revised_floor_plan'. Trying again.")
-                    trial += 1
-                    if trial >= 3:
-                        break
-                    continue
+Now, please revise this floor plan based on the user's requirements again:
+{example['prompt']}
 
-                break
-            else:
-                trial += 1
-                logging.error("Failed to find JSON in the response. Trying again.")
-                if trial >= 3:
-                    break
+Think step by step:
+- If any details are incorrect, missing, or inconsistent, correct them.
+- Floor assignments should align strictly with the user's specification.
+
+List ONLY the floors whose entry has to change, with their corrected entry. Copy each floor_id exactly as it appears in the current plan. If no floor has to change, return an empty list.
+Return your analysis and changes in ONLY this exact JSON format:
+{{
+    "analysis": "",
+    "changes": [
+        {{
+            "floor_id": "Floor 1",
+            "purpose": "Briefly describe the purpose of this floor"
+        }},
+        ...
+    ]
+}}
+"""
+            plan = await PlanningAgent._revise_by_patch(model, patch_prompt, semaphore, example["floor_plan"], "floor_id",
+                                                        OutputSchemas.FLOOR_PLAN_PATCH)
+        if plan is None:
+            print(revise_prompt)
+            plan = await PlanningAgent._request_plan(model, revise_prompt, semaphore, "revised_floor_plan", "Revising floor plan", "revise", OutputSchemas.REVISED_FLOOR_PLAN)
+        if plan is not None:
+            example["floor_plan"] = plan
 
         return example
     
     @staticmethod
-    async def async_create_menu_plan(model, example, semaphore):
+    async def async_create_menu_plan(model, example, semaphore, on_initial_plan=None, initial_plan=None):
         plan_prompt = f"""
 You are an expert chef, and your task is to create a weekly menu plan containing 52 weeks.
 User requirements:
@@ -377,42 +604,20 @@ Return your analysis and plan in ONLY this exact json format:
     ]
 }}"""
         
-        print(f"Input Prompt: {plan_prompt}")
-        
-        trial = 0
-        while True:
-            logging.info(f"Creating initial plan")
-
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, plan_prompt)
-
-                # repair the json string
-                response = repair_json(response)    
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error(f"Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error(f"Trying again.")
-
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response = dict(json.loads(match.group(0)))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error(f"Failed to parse response. Trying again.")
-                    continue
-
-                example["weekly_plan"] = response["weekly_plan"]
-                break
-            else:
-                trial += 1
-                logging.error(f"Failed to parse response. Trying again.")
+        response = initial_plan
+        if response is None and PlanningAgent.range_size > 0:
+            response = await PlanningAgent._plan_by_ranges(model, example, semaphore)
+        if response is None:
+            print(f"Input Prompt: {plan_prompt}")
+            response = await PlanningAgent._request_plan(model, plan_prompt, semaphore, "weekly_plan", "Creating initial plan", "plan", OutputSchemas.MENU_PLAN,
+                                                         full_response=True)
+        plan = response["weekly_plan"] if response is not None else None
+        if plan is not None:
+            example["weekly_plan"] = plan
+            if on_initial_plan is not None:
+                on_initial_plan(example, response)
+        if PlanningAgent._skip_revision(example, response):
+            return example
 
         # Revise the plan
         revise_prompt = f"""
@@ -438,48 +643,44 @@ Return your analysis and revised plan in ONLY this exact json format:
     ]
 }}"""
 
-        print(f"Input Prompt: {revise_prompt}")
-
-        trial = 0
-        while True:
-            logging.info(f"Revising plan")
-
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, revise_prompt)
-
-                # repair the json string
-                response = repair_json(response)
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error(f"Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error(f"Trying again.")
-
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response = dict(json.loads(match.group(0)))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error(f"Failed to parse response. Trying again.")
-                    continue
-
-                example["weekly_plan"] = response["revised_weekly_plan"]
-                break
-            else:
-                trial += 1
-                logging.error(f"Failed to parse response. Trying again.")
+        plan = None
+        if PlanningAgent.revision == "patch":
+            patch_prompt = f"""
+You are an expert writer, and your task is to revise a weekly plan containing 52 weeks.
+Current weekly plan:
+{example['weekly_plan']}
+
+User requirements:
+{example['prompt']}
+
+Think step by step. The current week plan may contain some wrong infomation. 
+Refer to the user requirements to identify special dishes and their exact date. If the dish is periodic, consider each occurrence seperately.
+Then list ONLY the weeks whose entry has to change, with their corrected entry. Copy each week_id exactly as it appears in the current plan. If no week has to change, return an empty list.
+Return your analysis and changes in ONLY this exact json format:
+{{
+    "analysis": "",
+    "changes": [
+        {{
+            "week_id": "Menu Week 4 (January 22nd - January 28th)",
+            "dishes": "Australia Day BBQ featuring Lamb Chops"
+        }},
+        ...
+    ]
+}}"""
+            plan = await PlanningAgent._revise_by_patch(model, patch_prompt, semaphore, example["weekly_plan"], "week_id",
+                                                        OutputSchemas.MENU_PLAN_PATCH)
+        if plan is None:
+            print(f"Input Prompt: {revise_prompt}")
+
+            plan = await PlanningAgent._request_plan(model, revise_prompt, semaphore, "revised_weekly_plan", "Revising plan", "revise", OutputSchemas.REVISED_MENU_PLAN)
+        if plan is not None:
+            example["weekly_plan"] = plan
 
         return example
 
 
     @staticmethod
-    async def async_create_block_plan(model, example, semaphore):
+    async def async_create_block_plan(model, example, semaphore, on_initial_plan=None, initial_plan=None):
         plan_prompt = f"""
 You are an expert designer, and your task is to write a plan for designing a city with 10x10 block grid, numbered from 1 to 100.
 User requirements:
@@ -525,53 +726,20 @@ Return your analysis and plan in ONLY the following exact JSON format:
     ]
 }}"""
 
-        print(plan_prompt)
-        trial = 0
-        while True:
-            logging.info("Creating initial block plan")
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, plan_prompt)
-
-                # repair the json string
-                response = repair_json(response)
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error("Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error("Trying again.")
-                continue
-
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response_dict = json.loads(match.group(0))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error("Failed to parse response as JSON. Trying again.")
-                    if trial >= 3:
-                        break
-                    continue
-
-                if "block_plan" in response_dict:
-                    example["block_plan"] = response_dict["block_plan"]
-                else:
-                    logging.error("JSON does not contain 'block_plan'. Trying again.")
-                    trial += 1
-                    if trial >= 3:
-                        break
-                    continue
-
-                break
-            else:
-                trial += 1
-                logging.error("Failed to find JSON in the response. Trying again.")
-                if trial >= 3:
-                    break
+        response = initial_plan
+        if response is None and PlanningAgent.range_size > 0:
+            response = await PlanningAgent._plan_by_ranges(model, example, semaphore)
+        if response is None:
+            print(plan_prompt)
+            response = await PlanningAgent._request_plan(model, plan_prompt, semaphore, "block_plan", "Creating initial block plan", "plan", OutputSchemas.BLOCK_PLAN,
+                                                         full_response=True)
+        plan = response["block_plan"] if response is not None else None
+        if plan is not None:
+            example["block_plan"] = plan
+            if on_initial_plan is not None:
+                on_initial_plan(example, response)
+        if PlanningAgent._skip_revision(example, response):
+            return example
 
         revise_prompt = f"""
 You are an expert architect. You have a skyscraper block plan as follows:
@@ -597,53 +765,39 @@ Return your analysis and the final revised plan in ONLY this exact JSON format:
 }}
 """
 
-        print(revise_prompt)
-        trial = 0
-        while True:
-            logging.info("Revising block plan")
-            try:
-                async with semaphore:
-                    response = await async_call_llm(model, revise_prompt)
-
-                # repair the json string
-                response = repair_json(response)
-                print(response)
-            except Exception as e:
-                logging.error(f"Error processing example: {e}")
-                trial += 1
-                if trial >= 3:
-                    logging.error("Failed to process example after 3 attempts. Skipping.")
-                    break
-                await asyncio.sleep(1 * trial)  # Exponential backoff
-                logging.error("Trying again.")
-                continue
+        plan = None
+        if PlanningAgent.revision == "patch":
+            patch_prompt = f"""
+You are an expert architect. You have a skyscraper block plan as follows:
+{example['block_plan']}
 
-            match = re.search(r"\{.*\}", response, re.DOTALL)
-            if match:
-                try:
-                    response_dict = json.loads(match.group(0))
-                except json.JSONDecodeError:
-                    trial += 1
-                    logging.error("Failed to parse response as JSON. Trying again.")
-                    if trial >= 3:
-                        break
-                    continue
-
-                if "revised_block_plan" in response_dict:
-                    example["block_plan"] = response_dict["revised_block_plan"]
-                else:
-                    logging.error("JSON does not contain 'revised_block_plan'. Trying again.")
-                    trial += 1
-                    if trial >= 3:
-                        break
-                    continue
+Now, please revise this block plan based on the user's requirements again:
+{example['prompt']}
 
-                break
-            else:
-                trial += 1
-                logging.error("Failed to find JSON in the response. Trying again.")
-                if trial >= 3:
-                    break
+Think step by step:
+- If any details are incorrect, missing, or inconsistent, correct them.
+- block assignments should align strictly with the user's requirements.
+
+List ONLY the blocks whose entry has to change, with their corrected entry. Copy each block_id exactly as it appears in the current plan. If no block has to change, return an empty list.
+Return your analysis and changes in ONLY this exact JSON format:
+{{
+    "analysis": "your analysis",
+    "changes": [
+        {{
+            "block_id": "block_id",
+            "use": "use"
+        }},
+        ...
+    ]
+}}
+"""
+            plan = await PlanningAgent._revise_by_patch(model, patch_prompt, semaphore, example["block_plan"], "block_id",
+                                                        OutputSchemas.BLOCK_PLAN_PATCH)
+        if plan is None:
+            print(revise_prompt)
+            plan = await PlanningAgent._request_plan(model, revise_prompt, semaphore, "revised_block_plan", "Revising block plan", "revise", OutputSchemas.REVISED_BLOCK_PLAN)
+        if plan is not None:
+            example["block_plan"] = plan
 
         return example
     
\ No newline at end of file
@@ -1,15 +1,165 @@
+import asyncio
+import copy
+import logging
+
 from CogWriter_model.Agents.PlanningAgent import PlanningAgent
-from CogWriter_model.Agents.GenerationAgent import GenerationAgent
+from CogWriter_model.Agents.GenerationAgent import GenerationAgent, UNIT_KEYS
 from CogWriter_model.BaselineGen import BaselineGen
+from llms.telemetry import call_priority
+
+
+class ExampleProgress:
+    """
+    Intermediate state of one example in a checkpoint store: the initial plan
+    response, the final plan and the units finished against it (or, before
+    the final plan is known, the units drafted against the initial plan).
+    Every change is queued to the store at once, so a crash or a retry loses
+    at most the units in flight. Without a store, nothing is saved or resumed.
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        state = store.get(key) if store is not None and key in store else None
+        state = state or {}
+        self.initial_plan = state.get("initial_plan")
+        self.plan = state.get("plan")
+        self.units = state.get("units", {})
+
+    def _save(self):
+        if self.store is not None:
+            self.store.put(self.key, {"initial_plan": self.initial_plan, "plan": self.plan, "units": dict(self.units)})
+
+    def set_initial_plan(self, response):
+        if response != self.initial_plan:
+            # Drafted units belong to the initial plan they were written for
+            self.units = {}
+        self.initial_plan = copy.deepcopy(response)
+        self._save()
+
+    def set_plan(self, plan, units=None):
+        """Record the final plan, with the units already finished against it (index -> unit)."""
+        self.plan = copy.deepcopy(plan)
+        self.units = {str(index): dict(unit) for index, unit in (units or {}).items()}
+        self._save()
+
+    def add_unit(self, index, unit):
+        self.units[str(index)] = dict(unit)
+        self._save()
+
+    def reuse(self, plan=None):
+        """The finished units per entry of plan (the final plan by default), or None if there are none."""
+        if not self.units:
+            return None
+        return [self.units.get(str(index)) for index in range(len(plan if plan is not None else self.plan))]
+
+    def carry_over(self, plan_key, plan):
+        """
+        Record plan as the final plan, keeping the units drafted against the
+        initial plan whose entry it left unchanged; returns reuse().
+        """
+        initial = (self.initial_plan or {}).get(plan_key) or []
+        units = {index: unit for index, unit in ((int(index), unit) for index, unit in self.units.items())
+                 if index < len(initial) and index < len(plan) and initial[index] == plan[index]}
+        self.set_plan(plan, units)
+        return self.reuse()
+
+    def clear(self):
+        if self.store is not None:
+            self.store.delete(self.key)
 
 
 class CogWriter(BaselineGen):
+    # Start generating units from the initial plan while the revision call is in
+    # flight, then regenerate only the units whose plan entry the revision changed
+    speculative = False
+    speculation_stats = {"examples": 0, "reused": 0, "regenerated": 0}
+    # Checkpoint store (utils.checkpointStore.CheckpointStore) for the plans and
+    # finished units of examples in progress; None disables unit-level resume
+    checkpoints = None
+    resume_stats = {"initial_plans": 0, "plans": 0, "units": 0}
 
     @staticmethod
-    async def async_generate(model, example, semaphore):
+    async def async_generate(model, example, semaphore, checkpoint_key=None):
+        """
+        Plan and generate example. With CogWriter.checkpoints and the example's
+        checkpoint_key set, the initial plan, the final plan and each finished
+        unit are saved as they are produced, and a repeated call (a retry or a
+        restarted run) resumes from them: it skips the planning calls already
+        made and generates only the units that are not finished.
+        """
+        key = f"{checkpoint_key}/progress" if checkpoint_key is not None else None
+        progress = ExampleProgress(CogWriter.checkpoints if key is not None else None, key)
+        plan_key = UNIT_KEYS[example["type"]]
+        stats = CogWriter.resume_stats
+        if progress.plan is not None:
+            stats["plans"] += 1
+            stats["units"] += len(progress.units)
+            logging.info(f"Resuming from the saved plan with {len(progress.units)} of {len(progress.plan)} units finished")
+            example[plan_key] = copy.deepcopy(progress.plan)
+            example = await GenerationAgent.async_generate(model, example, semaphore, reuse=progress.reuse(),
+                                                           on_unit=progress.add_unit)
+            progress.clear()
+            return example
+        if progress.initial_plan is not None:
+            stats["initial_plans"] += 1
+            stats["units"] += len(progress.units)
+            logging.info(f"Resuming from the saved initial plan with {len(progress.units)} drafted units")
+
+        if CogWriter.speculative:
+            return await CogWriter._async_generate_speculative(model, example, semaphore, progress)
         # First create the hierarchy/plan
-        example = await PlanningAgent.async_create_hierarchy(model, example, semaphore)
+        example = await PlanningAgent.async_create_hierarchy(
+            model, example, semaphore, on_initial_plan=lambda initial, response: progress.set_initial_plan(response),
+            initial_plan=copy.deepcopy(progress.initial_plan))
+        # Units a speculative run drafted before it stopped are kept where the plan did not change
+        reuse = progress.carry_over(plan_key, example[plan_key]) if plan_key in example else None
         # Then generate the content
-        example = await GenerationAgent.async_generate(model, example, semaphore)
+        example = await GenerationAgent.async_generate(model, example, semaphore, reuse=reuse, on_unit=progress.add_unit)
+        progress.clear()
         return example
 
+    @staticmethod
+    async def _async_generate_speculative(model, example, semaphore, progress):
+        draft = {}
+
+        def start_draft(initial, response):
+            progress.set_initial_plan(response)
+            # The draft works on a copy; the revision still sees the bare plan
+            draft["plan"] = copy.deepcopy(initial[UNIT_KEYS[initial["type"]]])
+            # Drafted units are checkpointed as they finish (a resumed draft skips them), and
+            # queue behind other calls, so the example's own revision is not held up by them
+            with call_priority(-1):
+                draft["task"] = asyncio.create_task(GenerationAgent.async_generate(
+                    model, copy.deepcopy(initial), semaphore, reuse=progress.reuse(draft["plan"]),
+                    on_unit=progress.add_unit))
+
+        try:
+            example = await PlanningAgent.async_create_hierarchy(model, example, semaphore, on_initial_plan=start_draft,
+                                                                 initial_plan=copy.deepcopy(progress.initial_plan))
+        except BaseException:
+            if "task" in draft:
+                draft["task"].cancel()
+            raise
+        plan_key = UNIT_KEYS[example["type"]]
+        if "task" not in draft:
+            # No initial plan to speculate on
+            reuse = progress.carry_over(plan_key, example[plan_key]) if plan_key in example else None
+            example = await GenerationAgent.async_generate(model, example, semaphore, reuse=reuse,
+                                                           on_unit=progress.add_unit)
+            progress.clear()
+            return example
+
+        # Every drafted unit is in progress by now; keep those whose plan entry the revision left unchanged
+        await draft["task"]
+        revised = example[plan_key]
+        reuse = progress.carry_over(plan_key, revised) or [None] * len(revised)
+
+        stats = CogWriter.speculation_stats
+        stats["examples"] += 1
+        stats["reused"] += sum(unit is not None for unit in reuse)
+        stats["regenerated"] += reuse.count(None)
+        logging.info(f"Revision changed {reuse.count(None)} of {len(reuse)} plan entries; regenerating those units")
+        example = await GenerationAgent.async_generate(model, example, semaphore, reuse=reuse, on_unit=progress.add_unit)
+        progress.clear()
+        return example
@@ -0,0 +1,94 @@
+"""
+Compare per-example latency of serial length refinement and best-of-n unit candidates.
+
+Plans each example once, then generates its units with GenerationAgent.best_of
+set to each of --n (1 is the plain generate-then-refine chain) and reports,
+per setting, the wall time of each example's unit generation (p50 / p95 / max),
+the refinement calls made and the completion tokens spent. Length calibration
+starts empty for every setting so they see the same prompts.
+
+    python -m llms.mock_server --port 8001 --ttft 0.2 --tps 80 --length_bias 0.9
+    python -m benchmarks.best_of_n --model mock --dataset_dir datasets/mock.json --limit 4 --n 1 2 4
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import logging
+import time
+
+from CogWriter_model.Agents.GenerationAgent import GenerationAgent
+from CogWriter_model.Agents.PlanningAgent import PlanningAgent
+from llms.calibration import calibration
+from llms.llms import aclose_clients, configure_backends, configure_cache
+from llms.telemetry import MeteredSemaphore, call_context, telemetry
+
+
+async def timed_generate(model, example, semaphore):
+    start = time.perf_counter()
+    with call_context(example_id=example["id"]):
+        await GenerationAgent.async_generate(model, example, semaphore)
+    return time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    configure_backends(args.llm_config)
+    configure_cache(None)
+    semaphore = MeteredSemaphore(args.concurrency)
+    with open(args.dataset_dir, "r", encoding="utf-8") as f:
+        dataset = json.load(f)[:args.limit]
+
+    # The agents print every response; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        planned = []
+        for example in dataset:
+            with call_context(example_id=example["id"]):
+                planned.append(await PlanningAgent.async_create_hierarchy(args.model, copy.deepcopy(example), semaphore))
+        rows = []
+        for n in args.n:
+            GenerationAgent.best_of = n
+            calibration.configure(None)
+            start = len(telemetry.records)
+            latencies = await asyncio.gather(*(timed_generate(args.model, copy.deepcopy(example), semaphore)
+                                               for example in planned))
+            records = telemetry.records[start:]
+            rows.append({
+                "n": n,
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "max": max(latencies),
+                "refine": sum(record["stage"] == "refine" for record in records),
+                "completion": sum(record["completion_tokens"] or 0 for record in records),
+            })
+    await aclose_clients()
+
+    print(f"{'best_of':<9}{'example p50 s':>14}{'p95 s':>8}{'max s':>8}{'refine calls':>14}{'compl tok':>11}")
+    for row in rows:
+        print(f"{row['n']:<9}{row['p50']:>14.1f}{row['p95']:>8.1f}{row['max']:>8.1f}"
+              f"{row['refine']:>14}{row['completion']:>11,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-example latency of serial refinement vs best-of-n candidates.")
+    parser.add_argument("--model", type=str, default="mock")
+    parser.add_argument("--dataset_dir", type=str, required=True)
+    parser.add_argument("--limit", type=int, default=4, help="Number of examples to run")
+    parser.add_argument("--n", type=int, nargs="+", default=[1, 2, 4], help="best_of settings to compare")
+    parser.add_argument("--llm_config", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
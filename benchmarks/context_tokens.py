@@ -0,0 +1,92 @@
+"""
+Report prompt tokens per example for each GenerationAgent context strategy.
+
+Plans each example once, then generates its units under every strategy
+(full, window, summary) and sums the prompt tokens of the unit, summary and
+warm-up calls from the call telemetry. "prefill" counts the prompt tokens the
+server had to compute, i.e. without the ones served from its prefix cache.
+
+    python -m llms.mock_server --port 8001 --ttft 0.02 --tps 4000
+    python -m benchmarks.context_tokens --model mock --dataset_dir datasets/mock.json --limit 4
+
+Against the mock, token counts are estimated from prompt length; against a
+vLLM or OpenAI backend they are the server's own counts.
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import logging
+
+from CogWriter_model.Agents.GenerationAgent import GenerationAgent
+from CogWriter_model.Agents.PlanningAgent import PlanningAgent
+from llms.llms import aclose_clients, configure_backends, configure_cache
+from llms.telemetry import MeteredSemaphore, call_context, telemetry
+
+STRATEGIES = ("full", "window", "summary")
+STAGES = ("unit", "summary", "warm")
+
+
+async def generate(model, example, semaphore, plan_only=False):
+    with call_context(example_id=example["id"]):
+        if plan_only:
+            return await PlanningAgent.async_create_hierarchy(model, example, semaphore)
+        return await GenerationAgent.async_generate(model, example, semaphore)
+
+
+async def run(args):
+    configure_backends(args.llm_config)
+    configure_cache(None)
+    semaphore = MeteredSemaphore(args.concurrency)
+    with open(args.dataset_dir, "r", encoding="utf-8") as f:
+        dataset = json.load(f)[:args.limit]
+    types = {example["id"]: example["type"] for example in dataset}
+
+    # The agents print every response; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        planned = await asyncio.gather(*(generate(args.model, copy.deepcopy(example), semaphore, plan_only=True)
+                                         for example in dataset))
+        totals = {}
+        for strategy in STRATEGIES:
+            GenerationAgent.context_strategy = strategy
+            start = len(telemetry.records)
+            await asyncio.gather(*(generate(args.model, copy.deepcopy(example), semaphore) for example in planned))
+            for record in telemetry.records[start:]:
+                if record["stage"] not in STAGES:
+                    continue
+                row = totals.setdefault((strategy, types[record["example_id"]]), {"prompt": 0, "prefill": 0})
+                row["prompt"] += record["prompt_tokens"] or 0
+                row["prefill"] += (record["prompt_tokens"] or 0) - (record["cached_tokens"] or 0)
+    await aclose_clients()
+
+    counts = {t: sum(1 for example in dataset if example["type"] == t) for t in types.values()}
+    print(f"{'strategy':<10}{'type':<12}{'prompt tok/example':>20}{'vs full':>9}{'prefill tok/example':>21}{'vs full':>9}")
+    for (strategy, example_type), row in sorted(totals.items(), key=lambda item: (item[0][1], STRATEGIES.index(item[0][0]))):
+        full = totals[("full", example_type)]
+        n = counts[example_type]
+        prompt_change = row["prompt"] / full["prompt"] - 1 if full["prompt"] else 0.0
+        prefill_change = row["prefill"] / full["prefill"] - 1 if full["prefill"] else 0.0
+        print(f"{strategy:<10}{example_type:<12}{row['prompt'] / n:>20,.0f}{prompt_change:>9.0%}"
+              f"{row['prefill'] / n:>21,.0f}{prefill_change:>9.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt tokens per example for each context strategy.")
+    parser.add_argument("--model", type=str, default="mock")
+    parser.add_argument("--dataset_dir", type=str, required=True)
+    parser.add_argument("--limit", type=int, default=4, help="Number of examples to run")
+    parser.add_argument("--llm_config", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--context_window", type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    GenerationAgent.context_window = args.context_window
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
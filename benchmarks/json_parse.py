@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of JSON response parsing over recorded responses.
+
+Replays the responses stored in an LLM response cache (see --cache_path in
+main.py) through the old parse path (json_repair on every response, then a
+regex for the outermost braces) and utils.jsonParser.parse_json_object (strict
+json.loads, then brace extraction, then json_repair). Reports, for unit-sized
+and plan-sized responses, the time per response of each path and which tier
+parsed them.
+
+    python main.py --model mock --dataset_dir datasets/mock.json --output_dir out.json
+    python -m benchmarks.json_parse --cache_path longGenBench_output/mock/llm_cache.sqlite
+"""
+import argparse
+import json
+import re
+import sqlite3
+import time
+
+from json_repair import repair_json
+
+from utils.jsonParser import parse_json_object, parse_stats
+
+# Responses longer than this are counted as plans
+PLAN_CHARS = 4000
+
+
+def repair_first(text):
+    match = re.search(r"\{.*\}", repair_json(text), re.DOTALL)
+    if not match:
+        return None
+    try:
+        parsed = json.loads(match.group(0))
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def load_responses(cache_path, limit):
+    connection = sqlite3.connect(cache_path)
+    try:
+        rows = connection.execute("SELECT response FROM responses LIMIT ?", (limit,)).fetchall()
+    finally:
+        connection.close()
+    # Refinements and summaries are prose, not JSON; keep what the JSON parser sees
+    return [row[0] for row in rows if "{" in row[0]]
+
+
+def time_parser(parser, responses, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for response in responses:
+            parser(response)
+    return (time.perf_counter() - start) / (repeat * len(responses)) if responses else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time JSON parsing of recorded LLM responses.")
+    parser.add_argument("--cache_path", type=str, required=True, help="Response cache SQLite file")
+    parser.add_argument("--limit", type=int, default=5000, help="Responses to load")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    responses = load_responses(args.cache_path, args.limit)
+    groups = {
+        "unit": [r for r in responses if len(r) <= PLAN_CHARS],
+        "plan": [r for r in responses if len(r) > PLAN_CHARS],
+    }
+    print(f"{'size':<6}{'responses':>10}{'mean chars':>12}{'repair first ms':>17}{'tiered ms':>11}{'speedup':>9}"
+          f"   tiers (strict/extract/repair/failed)")
+    for name, group in groups.items():
+        if not group:
+            continue
+        for key in parse_stats:
+            parse_stats[key] = 0
+        for response in group:
+            parse_json_object(response)
+        tiers = "/".join(str(parse_stats[key]) for key in ("strict", "extract", "repair", "failed"))
+        old = time_parser(repair_first, group, args.repeat)
+        new = time_parser(parse_json_object, group, args.repeat)
+        mean_chars = sum(len(r) for r in group) / len(group)
+        print(f"{name:<6}{len(group):>10}{mean_chars:>12,.0f}{old * 1000:>17.3f}{new * 1000:>11.3f}"
+              f"{old / new if new else 0.0:>8.1f}x   {tiers}")
+
+
+if __name__ == "__main__":
+    main()
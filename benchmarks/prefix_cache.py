@@ -0,0 +1,93 @@
+"""
+Measure how per-unit prompt layout affects server-side prefix caching.
+
+Fans out one request per unit, the way GenerationAgent does, with three layouts:
+
+    unit_first      unit-specific text, then the shared plan and requirements (old layout)
+    shared_first    shared plan and requirements, then the unit-specific text
+    shared_warm     shared_first, after one warming request for the shared prefix
+
+and reports the prefix cache hit rate (cached / prompt tokens, from
+usage.prompt_tokens_details) and the per-request latency, which with
+max_tokens=1 is essentially prefill time, including the time spent queued
+behind the siblings' prefills. Run against the mock with prefill
+simulated, or a local vLLM started with --enable-prefix-caching and
+--enable-prompt-tokens-details:
+
+    python -m llms.mock_server --port 8001 --ttft 0.02 --prefill_tps 50000
+    python -m benchmarks.prefix_cache --base_url http://localhost:8001/v1 --model mock --units 52
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import uuid
+
+WORDS = "garden market river family dinner letter project window coffee music evening weekend rain summer".split()
+
+
+def build_prompts(units, layout, seed):
+    rng = random.Random(seed)
+    plan = [{"week_id": f"Week {i}", "events": " ".join(rng.choices(WORDS, k=12))} for i in range(1, units + 1)]
+    # The nonce keeps earlier runs (and other layouts) from warming this one's cache
+    shared = (f"Run {uuid.uuid4().hex}. You are an expert writer.\n"
+              f"You should consider the coherence of the diary entry referring to the plan of the whole year:\n"
+              f"{plan}\nYou should consider the user requirements: write a diary for the whole year.\n")
+    suffixes = [f"\nWrite a 200-word weekly diary entry for the week of {week['week_id']}.\n"
+                f"The events for this week are: {week['events']}\n" for week in plan]
+    if layout == "unit_first":
+        return shared, [suffix + shared for suffix in suffixes]
+    return shared, [shared + suffix for suffix in suffixes]
+
+
+async def timed_call(client, model, prompt):
+    start = time.perf_counter()
+    completion = await client.chat.completions.create(
+        model=model, messages=[{"role": "user", "content": prompt}], max_tokens=1)
+    elapsed = time.perf_counter() - start
+    details = getattr(completion.usage, "prompt_tokens_details", None)
+    return elapsed, completion.usage.prompt_tokens, getattr(details, "cached_tokens", None) or 0
+
+
+async def run_layout(client, model, units, layout, seed):
+    shared, prompts = build_prompts(units, "unit_first" if layout == "unit_first" else "shared_first", seed)
+    start = time.perf_counter()
+    if layout == "shared_warm":
+        await timed_call(client, model, shared)
+    results = await asyncio.gather(*(timed_call(client, model, prompt) for prompt in prompts))
+    wall = time.perf_counter() - start
+    latencies = sorted(r[0] for r in results)
+    prompt_tokens = sum(r[1] for r in results)
+    cached_tokens = sum(r[2] for r in results)
+    return {
+        "layout": layout,
+        "hit_rate": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+        "prefill_mean": statistics.fmean(latencies),
+        "prefill_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "wall": wall,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Prefix cache hit rate per prompt layout.")
+    parser.add_argument("--base_url", type=str, default="http://localhost:8001/v1")
+    parser.add_argument("--api_key", type=str, default="sk-mock")
+    parser.add_argument("--model", type=str, default="mock")
+    parser.add_argument("--units", type=int, default=52)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(base_url=args.base_url, api_key=args.api_key)
+    print(f"{'layout':<14}{'hit rate':>10}{'prefill mean s':>16}{'prefill p95 s':>15}{'wall s':>9}")
+    for layout in ("unit_first", "shared_first", "shared_warm"):
+        row = await run_layout(client, args.model, args.units, layout, args.seed)
+        print(f"{row['layout']:<14}{row['hit_rate']:>10.1%}{row['prefill_mean']:>16.3f}"
+              f"{row['prefill_p95']:>15.3f}{row['wall']:>9.2f}")
+    await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+"""
+Measure CLI startup: wall time of `python main.py --help` and which heavy
+libraries are already imported once main.py's module-level imports have run.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "transformers", "vllm", "openai", "httpx", "tenacity"]
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({{"import_main": elapsed, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def time_help(runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "main.py", "--help"], cwd=REPO_ROOT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def probe_imports():
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=REPO_ROOT,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure CLI startup time.")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    timings = time_help(args.runs)
+    probe = probe_imports()
+    print(f"python main.py --help: median {statistics.median(timings):.3f}s, "
+          f"min {min(timings):.3f}s, max {max(timings):.3f}s over {args.runs} runs")
+    print(f"import main: {probe['import_main']:.3f}s")
+    print(f"heavy modules loaded at startup: {', '.join(probe['loaded']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# batch.py
+"""
+Offline batch mode: cache misses are written to OpenAI Batch API JSONL files
+instead of being sent as chat calls.
+
+Calls that miss the response cache are queued and block. Once no new call
+has been queued for `idle` seconds, every example is waiting on the batch,
+so the queue is flushed to `<directory>/batch_NNNN.jsonl`. Then:
+
+- with a processor command (e.g. a script that submits the file to the Batch
+  API and downloads the results, or `python -m llms.mock_server --process_batch`),
+  the command is run as `<processor> <input> <output>`, its results are handed
+  back to the waiting calls and the pipeline moves on to the next stage;
+- without one, the waiting calls raise BatchPending and their examples stop.
+  Submit the file yourself and rerun with the results file: ingest() loads it
+  into the response cache, the finished stages replay from the cache and the
+  next stage is queued.
+
+Each request's custom_id is its response cache slot, so results always land
+on the call that asked for them.
+"""
+import asyncio
+import json
+import logging
+import os
+import shlex
+
+logger = logging.getLogger(__name__)
+
+
+class BatchPending(BaseException):
+    """
+    The call was queued in a batch file and has no result yet.
+
+    A BaseException, like asyncio.CancelledError, so the agents' generic
+    retry loops do not catch it and queue the same call again.
+    """
+
+
+def make_custom_id(slot):
+    digest, occurrence = slot
+    return f"{digest}-{occurrence}"
+
+
+def parse_custom_id(custom_id):
+    digest, occurrence = custom_id.rsplit("-", 1)
+    return digest, int(occurrence)
+
+
+def parse_result(line):
+    """Return (custom_id, model, content) for an output line; content is None for failed requests."""
+    result = json.loads(line)
+    response = result.get("response") or {}
+    body = response.get("body") or {}
+    if result.get("error") or response.get("status_code") != 200 or not body.get("choices"):
+        return result["custom_id"], None, None
+    if len(body["choices"]) > 1:
+        # Requests with n > 1, encoded like the live provider does
+        content = json.dumps([choice["message"]["content"] or "" for choice in body["choices"]], ensure_ascii=False)
+        return result["custom_id"], body.get("model"), content
+    return result["custom_id"], body.get("model"), body["choices"][0]["message"]["content"]
+
+
+def ingest(path, cache):
+    """Store the responses of a batch output file in the response cache; return (stored, failed)."""
+    stored = failed = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            custom_id, model, content = parse_result(line)
+            if not content:
+                failed += 1
+                continue
+            cache.set(parse_custom_id(custom_id), model, content)
+            stored += 1
+    logger.info(f"Ingested {stored} batch results from {path} ({failed} failed)")
+    return stored, failed
+
+
+class BatchCollector:
+    """
+    Args:
+        directory (str): Where batch input (and processor output) files are written
+        processor (str): Command run as `<processor> <input> <output>`; None to stop at pending calls
+        idle (float): Seconds without new calls after which the queue is flushed
+    """
+
+    def __init__(self, directory, processor=None, idle=2.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.processor = processor
+        self.idle = idle
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+        self.stats = {"files": 0, "queued": 0, "completed": 0, "failed": 0, "pending": 0}
+
+    def _next_path(self):
+        index = 1
+        while os.path.exists(os.path.join(self.directory, f"batch_{index:04d}.jsonl")):
+            index += 1
+        return os.path.join(self.directory, f"batch_{index:04d}.jsonl")
+
+    async def submit(self, slot, model, messages, params):
+        """Queue a request and wait for its batch result (raises BatchPending without a processor)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        body = {"model": model, "messages": messages,
+                **{k: v for k, v in params.items() if k not in ("stream", "extra_body")},
+                # The SDK merges extra_body into the request body; do the same in the file
+                **params.get("extra_body", {})}
+        self._pending.append((make_custom_id(slot), body, future))
+        self.stats["queued"] += 1
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_later(self.idle, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        self._timer = None
+        task = asyncio.get_running_loop().create_task(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        input_path = self._next_path()
+        with open(input_path, "w", encoding="utf-8") as f:
+            for custom_id, body, _ in pending:
+                line = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.stats["files"] += 1
+        logger.info(f"Wrote {len(pending)} requests to {input_path}")
+
+        results = {}
+        if self.processor:
+            output_path = os.path.join(self.directory, os.path.basename(input_path).replace("batch_", "results_"))
+            results = await self._process(input_path, output_path)
+
+        for custom_id, _, future in pending:
+            if future.done():
+                continue
+            if not self.processor:
+                self.stats["pending"] += 1
+                future.set_exception(BatchPending(custom_id))
+            elif results.get(custom_id):
+                self.stats["completed"] += 1
+                future.set_result(results[custom_id])
+            else:
+                # A failed request behaves like a failed API call: the caller retries
+                self.stats["failed"] += 1
+                future.set_result("")
+
+    async def _process(self, input_path, output_path):
+        command = shlex.split(self.processor) + [input_path, output_path]
+        process = await asyncio.create_subprocess_exec(*command)
+        if await process.wait() != 0 or not os.path.exists(output_path):
+            logger.error(f"Batch processor failed on {input_path}")
+            return {}
+        results = {}
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    custom_id, _, content = parse_result(line)
+                    results[custom_id] = content
+        return results
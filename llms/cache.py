@@ -0,0 +1,144 @@
+# cache.py
+"""
+Persistent, content-addressed cache for LLM responses.
+
+Entries are keyed by a digest of (model, messages, sampling params) plus an
+occurrence index: the n-th identical request of a run maps to the n-th stored
+response. Re-running a dataset therefore replays the previous run call for
+call (including the retries that followed an unparsable answer) instead of
+handing the same bad response back to a retry loop forever. max_tokens is
+left out of the digest: it is a bound derived from length calibration, which
+would otherwise move every key whenever the calibration does.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ("use", "refresh", "bypass")
+
+
+def make_request_key(model, messages, params):
+    """Stable digest of everything that determines the response, except the max_tokens bound."""
+    params = {key: value for key, value in params.items() if key != "max_tokens"}
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with size and TTL eviction.
+
+    Args:
+        path (str): Database file
+        max_bytes (int): Evict least recently used entries beyond this size (None for no limit)
+        ttl (float): Entries older than this many seconds are ignored and evicted (None for no expiry)
+    """
+
+    _EVICT_EVERY = 200
+
+    def __init__(self, path, max_bytes=None, ttl=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._occurrences = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT NOT NULL,
+                occurrence INTEGER NOT NULL,
+                model TEXT,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (key, occurrence)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses (accessed_at)")
+        self.evict()
+
+    def next_key(self, model, messages, params):
+        """Return the (digest, occurrence) slot for the next request with these inputs."""
+        digest = make_request_key(model, messages, params)
+        occurrence = self._occurrences.get(digest, 0)
+        self._occurrences[digest] = occurrence + 1
+        return digest, occurrence
+
+    def get(self, slot):
+        digest, occurrence = slot
+        row = self._conn.execute(
+            "SELECT response, created_at FROM responses WHERE key = ? AND occurrence = ?",
+            (digest, occurrence),
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self._conn.execute(
+            "UPDATE responses SET accessed_at = ? WHERE key = ? AND occurrence = ?",
+            (now, digest, occurrence),
+        )
+        self.hits += 1
+        return row[0]
+
+    def set(self, slot, model, response):
+        digest, occurrence = slot
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (digest, occurrence, model, response, len(response.encode("utf-8")), now, now),
+        )
+        self.writes += 1
+        if self.writes % self._EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under max_bytes."""
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        if self.max_bytes is None:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, occurrence, size FROM responses ORDER BY accessed_at ASC"
+        ).fetchall()
+        doomed = []
+        for key, occurrence, size in rows:
+            if total <= self.max_bytes:
+                break
+            doomed.append((key, occurrence))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ? AND occurrence = ?", doomed)
+        logger.info(f"Evicted {len(doomed)} cached responses")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,129 @@
+# calibration.py
+"""
+Per-model length calibration, learned from completed calls and kept across runs.
+
+Two ratios are tracked for each model:
+
+    words_per_token    count_words(response) / completion_tokens, over upstream
+                       responses with server-reported usage. Turns a word
+                       target into a max_tokens bound.
+    length_bias        words written / words asked for, over first drafts of
+                       units. Models that habitually undershoot (or overshoot)
+                       are asked for target / length_bias words, so the draft
+                       lands inside the refinement tolerance more often.
+
+Until a ratio has MIN_SAMPLES observations its default is used. The sums are
+stored in a small JSON file, which later runs load.
+
+The word hints are part of the prompts, and so of the response cache keys.
+They are therefore computed from the snapshot loaded at configure() and
+rounded to RATIO_STEP, and the file is only rewritten when calibration is
+configured with update=True: a rerun of a dataset sends the same prompts, so
+it replays from the cache, unless new observations were asked for.
+"""
+import copy
+import json
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORDS_PER_TOKEN = 0.75
+MIN_SAMPLES = 20
+# Bias corrections beyond this range are more likely a bad prompt than a habit
+MIN_LENGTH_BIAS, MAX_LENGTH_BIAS = 0.67, 1.5
+# Ratios are applied in steps this coarse, so small drift between runs keeps the requests (and cache keys) the same
+RATIO_STEP = 0.05
+
+
+class LengthCalibrator:
+    """Words-per-token and length-bias observations per model; configure() a file to keep them across runs."""
+
+    def __init__(self):
+        self.path = None
+        self.models = {}
+        # Observations as loaded by configure(); the ratios in use this run come from these
+        self.frozen = {}
+        self.update = False
+
+    def configure(self, path=None, update=False):
+        """Load observations from path; with update, save() adds this run's observations to it."""
+        self.path = path
+        self.update = update
+        self.models = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.models = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"Ignoring unreadable length calibration file {path}")
+        self.frozen = copy.deepcopy(self.models)
+
+    def _entry(self, model):
+        return self.models.setdefault(model, {"words": 0, "tokens": 0, "responses": 0,
+                                              "requested": 0, "produced": 0, "drafts": 0})
+
+    def observe_tokens(self, model, words, completion_tokens):
+        if words <= 0 or not completion_tokens:
+            return
+        entry = self._entry(model)
+        entry["words"] += words
+        entry["tokens"] += completion_tokens
+        entry["responses"] += 1
+
+    def observe_length(self, model, requested, produced):
+        if requested <= 0 or produced <= 0:
+            return
+        entry = self._entry(model)
+        entry["requested"] += requested
+        entry["produced"] += produced
+        entry["drafts"] += 1
+
+    @staticmethod
+    def _words_per_token(entry):
+        if entry is None or entry["responses"] < MIN_SAMPLES:
+            return DEFAULT_WORDS_PER_TOKEN
+        return entry["words"] / entry["tokens"]
+
+    @staticmethod
+    def _length_bias(entry):
+        if entry is None or entry["drafts"] < MIN_SAMPLES:
+            return 1.0
+        return min(MAX_LENGTH_BIAS, max(MIN_LENGTH_BIAS, entry["produced"] / entry["requested"]))
+
+    def words_per_token(self, model):
+        """The words per token in use this run: the loaded snapshot's, rounded to RATIO_STEP."""
+        return max(RATIO_STEP, round(self._words_per_token(self.frozen.get(model)) / RATIO_STEP) * RATIO_STEP)
+
+    def length_bias(self, model):
+        """The length bias in use this run: the loaded snapshot's, rounded to RATIO_STEP."""
+        return round(self._length_bias(self.frozen.get(model)) / RATIO_STEP) * RATIO_STEP
+
+    def length_hint(self, model, words):
+        """Words to ask for so that the model writes about `words`."""
+        return max(1, round(words / self.length_bias(model)))
+
+    def max_tokens(self, model, words, headroom=1.5):
+        """Completion tokens for a response of about `words` words, with headroom before it is cut."""
+        return math.ceil(words * headroom / self.words_per_token(model))
+
+    def save(self):
+        if not self.path or not self.update:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.models, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        """The ratios learned so far, including this run's observations (applied from the next run)."""
+        return {model: {"words_per_token": self._words_per_token(entry), "length_bias": self._length_bias(entry),
+                        "responses": entry["responses"], "drafts": entry["drafts"]}
+                for model, entry in self.models.items()}
+
+
+calibration = LengthCalibrator()
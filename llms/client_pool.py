@@ -0,0 +1,133 @@
+# client_pool.py
+"""
+AsyncOpenAI clients pooled per (event loop, base_url, api_key).
+
+An httpx client is bound to the event loop it first ran on, so a client cached
+in a module global breaks as soon as a second loop uses it (e.g. call_llm
+running asyncio.run per call). Keying by loop gives every loop its own
+clients; aclose() shuts down the ones belonging to the running loop.
+
+Connection limits are sized to the concurrency level so requests do not queue
+inside httpx or churn connections at high fan-out. HTTP/2 multiplexing is used
+when requested and the optional `h2` package is installed. httpx is imported
+on first use so configuring the pool at startup stays cheap.
+"""
+import asyncio
+import importlib.util
+import logging
+from contextlib import asynccontextmanager
+
+from llms.telemetry import mark_first_byte
+
+logger = logging.getLogger(__name__)
+
+
+async def _on_response(response):
+    mark_first_byte()
+
+
+class _Usage:
+    def __init__(self):
+        self.clients = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0
+
+
+class ClientPool:
+    """
+    Args:
+        max_connections (int): Connection limit per client, normally the run's concurrency
+        http2 (bool): Multiplex requests over HTTP/2 connections (needs the `h2` package)
+        timeout (float): Request timeout in seconds
+    """
+
+    def __init__(self, max_connections=100, http2=False, timeout=900):
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.timeout = timeout
+        # (id(loop), base_url, api_key) -> (loop, client)
+        self._clients = {}
+        # base_url -> _Usage; outlives the clients so stats survive aclose()
+        self._usage = {}
+
+    def configure(self, max_connections=None, http2=None):
+        """Change limits for clients created from now on."""
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if http2 is not None:
+            if http2 and importlib.util.find_spec("h2") is None:
+                logger.warning("HTTP/2 requested but the 'h2' package is not installed; using HTTP/1.1")
+                http2 = False
+            self.http2 = http2
+
+    def _create(self, factory, base_url, api_key):
+        import httpx
+
+        http_client = httpx.AsyncClient(
+            timeout=self.timeout,
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            # Runs when the response headers arrive, inside the calling task
+            event_hooks={"response": [_on_response]},
+        )
+        return factory(base_url=base_url, api_key=api_key, http_client=http_client)
+
+    def _prune(self):
+        for key in [k for k, (loop, _) in self._clients.items() if loop.is_closed()]:
+            del self._clients[key]
+
+    @asynccontextmanager
+    async def lease(self, factory, base_url, api_key):
+        """Yield the running loop's client for base_url/api_key, creating it with factory if needed."""
+        loop = asyncio.get_running_loop()
+        key = (id(loop), base_url, api_key)
+        usage = self._usage.setdefault(base_url, _Usage())
+        entry = self._clients.get(key)
+        if entry is None or entry[0] is not loop:
+            self._prune()
+            entry = (loop, self._create(factory, base_url, api_key))
+            self._clients[key] = entry
+            usage.clients += 1
+
+        usage.requests += 1
+        if usage.in_flight >= self.max_connections:
+            # No free connection: this request waits inside httpx for one
+            usage.saturated += 1
+        usage.in_flight += 1
+        usage.peak_in_flight = max(usage.peak_in_flight, usage.in_flight)
+        try:
+            yield entry[1]
+        finally:
+            usage.in_flight -= 1
+
+    async def aclose(self):
+        """Close the clients owned by the running loop."""
+        loop = asyncio.get_running_loop()
+        for key in [k for k, (owner, _) in self._clients.items() if owner is loop]:
+            _, client = self._clients.pop(key)
+            await client.close()
+        self._prune()
+
+    def stats(self):
+        return [
+            {
+                "base_url": base_url,
+                "max_connections": self.max_connections,
+                "http2": self.http2,
+                "clients": usage.clients,
+                "in_flight": usage.in_flight,
+                "peak_in_flight": usage.peak_in_flight,
+                "requests": usage.requests,
+                "saturated": usage.saturated,
+            }
+            for base_url, usage in self._usage.items()
+        ]
+
+
+# Shared by every HTTP provider; configured from main.py via llms.configure_clients
+client_pool = ClientPool()
@@ -0,0 +1,188 @@
+# endpoint_pool.py
+"""
+Routing across several OpenAI-compatible replicas (e.g. vLLM servers) that
+serve the same model.
+
+Requests go to the replica with the fewest outstanding requests
+("least_outstanding") or the lowest expected wait ("latency": outstanding
+requests weighted by the replica's smoothed latency). Replicas that fail
+repeatedly, fail a health probe or become much slower than their peers are
+ejected for a while; a passing probe brings them back early. Slowness is
+judged per kind of call (e.g. the pipeline stage), so a replica that served
+a run of long planning calls is not compared with peers serving short ones.
+"""
+import asyncio
+import logging
+import statistics
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+ROUTING_STRATEGIES = ("least_outstanding", "latency")
+
+
+class Endpoint:
+    def __init__(self, base_url, api_key):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.outstanding = 0
+        self.latency = None  # EWMA of request latency in seconds
+        self.kind_latency = {}  # kind -> EWMA of that kind's latency
+        self.kind_requests = {}  # kind -> successful requests of that kind
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejected_for = None  # "failures", "probe" or "slow"
+        self.requests = 0
+        self.failures = 0
+
+    def healthy(self, now):
+        return now >= self.ejected_until
+
+    def record(self, latency, ok, kind=None, alpha=0.2):
+        self.requests += 1
+        if ok:
+            self.consecutive_failures = 0
+            self.latency = latency if self.latency is None else (1 - alpha) * self.latency + alpha * latency
+            previous = self.kind_latency.get(kind)
+            self.kind_latency[kind] = latency if previous is None else (1 - alpha) * previous + alpha * latency
+            self.kind_requests[kind] = self.kind_requests.get(kind, 0) + 1
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+
+class EndpointPool:
+    """
+    Args:
+        endpoints (list): (base_url, api_key) pairs
+        strategy (str): "least_outstanding" or "latency"
+        probe_interval (float): Seconds between health probes (None disables probing)
+        eject_after (int): Consecutive failures before a replica is ejected
+        eject_seconds (float): How long an ejected replica is skipped
+        slow_factor (float): Eject replicas whose latency exceeds this multiple of the median
+        ignored_errors (tuple): Exception types that do not count as replica failures (e.g. 429s)
+    """
+
+    def __init__(self, endpoints, strategy="least_outstanding", probe_interval=10.0,
+                 eject_after=3, eject_seconds=30.0, slow_factor=3.0, ignored_errors=()):
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy}, expected one of {ROUTING_STRATEGIES}")
+        self.endpoints = [Endpoint(base_url, api_key) for base_url, api_key in endpoints]
+        if not self.endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.strategy = strategy
+        self.probe_interval = probe_interval
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.slow_factor = slow_factor
+        self.ignored_errors = tuple(ignored_errors)
+        self._probe_task = None
+
+    def _score(self, endpoint):
+        if self.strategy == "latency":
+            # Expected wait: queue length times typical latency (unknown latency = optimistic)
+            return ((endpoint.outstanding + 1) * (endpoint.latency or 0.0), endpoint.outstanding)
+        return (endpoint.outstanding, endpoint.latency or 0.0)
+
+    def pick(self):
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e.healthy(now)]
+        if not candidates:
+            # Everything is ejected: use the replica that comes back first rather than failing
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        return min(candidates, key=self._score)
+
+    def eject(self, endpoint, kind, reason):
+        if len(self.endpoints) == 1:
+            return
+        now = time.monotonic()
+        if endpoint.healthy(now):
+            logger.warning(f"Ejecting {endpoint.base_url} for {self.eject_seconds:.0f}s: {reason}")
+        endpoint.ejected_until = now + self.eject_seconds
+        endpoint.ejected_for = kind
+
+    def _check_slow(self, endpoint, kind):
+        # Only calls of the same kind are comparable: a plan call takes many times longer than a unit call
+        latencies = [e.kind_latency[kind] for e in self.endpoints if kind in e.kind_latency and e is not endpoint]
+        latency = endpoint.kind_latency.get(kind)
+        if not latencies or latency is None or endpoint.kind_requests[kind] < 5:
+            return
+        median = statistics.median(latencies)
+        if median > 0 and latency > self.slow_factor * median:
+            label = f" for {kind} calls" if kind is not None else ""
+            self.eject(endpoint, "slow", f"latency {latency:.2f}s vs median {median:.2f}s{label}")
+            # Start from the median again so it is not ejected straight away when it returns
+            endpoint.kind_latency[kind] = median
+
+    @asynccontextmanager
+    async def acquire(self, kind=None):
+        """
+        Route one request: yields the chosen Endpoint and records the outcome.
+        kind groups calls of similar cost (e.g. the pipeline stage) for the
+        slow-replica check; calls without one are compared with each other.
+        """
+        self._ensure_prober()
+        endpoint = self.pick()
+        endpoint.outstanding += 1
+        start = time.monotonic()
+        try:
+            yield endpoint
+        except self.ignored_errors:
+            raise
+        except Exception:
+            endpoint.record(time.monotonic() - start, ok=False)
+            if endpoint.consecutive_failures >= self.eject_after:
+                self.eject(endpoint, "failures", f"{endpoint.consecutive_failures} consecutive failures")
+            raise
+        else:
+            endpoint.record(time.monotonic() - start, ok=True, kind=kind)
+            self._check_slow(endpoint, kind)
+        finally:
+            endpoint.outstanding -= 1
+
+    def _ensure_prober(self):
+        if self.probe_interval is None or len(self.endpoints) == 1:
+            return
+        loop = asyncio.get_running_loop()
+        if self._probe_task is None or self._probe_task.done() or self._probe_task.get_loop() is not loop:
+            self._probe_task = loop.create_task(self._probe_loop())
+
+    async def _probe_loop(self):
+        async with httpx.AsyncClient(timeout=5) as client:
+            while True:
+                await asyncio.gather(*(self._probe(client, e) for e in self.endpoints))
+                await asyncio.sleep(self.probe_interval)
+
+    async def _probe(self, client, endpoint):
+        try:
+            response = await client.get(
+                f"{endpoint.base_url}/models",
+                headers={"Authorization": f"Bearer {endpoint.api_key}"},
+            )
+            response.raise_for_status()
+        except Exception as e:
+            self.eject(endpoint, "probe", f"health probe failed ({e})")
+            return
+        # A slow replica stays out until its time is up; a broken one that answers again comes back now
+        if not endpoint.healthy(time.monotonic()) and endpoint.ejected_for in ("failures", "probe"):
+            endpoint.consecutive_failures = 0
+            endpoint.ejected_until = 0.0
+            endpoint.ejected_for = None
+            logger.info(f"Restoring {endpoint.base_url} after a passing health probe")
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {
+                "base_url": e.base_url,
+                "healthy": e.healthy(now),
+                "outstanding": e.outstanding,
+                "latency": e.latency,
+                "requests": e.requests,
+                "failures": e.failures,
+            }
+            for e in self.endpoints
+        ]
@@ -1,109 +1,292 @@
 # api.py
 import logging
-from openai import OpenAI, AsyncOpenAI
-from transformers import pipeline
 # from vllm import LLM, SamplingParams
-import torch
 import asyncio
-import httpx
-from contextlib import asynccontextmanager
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_exponential,
-    retry_if_exception_type
-)
-import openai
 import logging
+import json
+from utils.jsonParser import parse_json_object, parse_stats, validate_json
+from llms.cache import ResponseCache, CACHE_MODES, make_request_key
+from llms.registry import load_backends, get_backend, get_backends
+from llms.client_pool import client_pool
+from llms.batch import BatchCollector, BatchPending, ingest
+from llms.telemetry import telemetry, current_record
+from llms.calibration import calibration
+from utils.wordCounter import count_words
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-_clients = {}
+def configure_backends(path=None):
+    """Load the backend registry from a JSON config file (default: llms/backends.json)."""
+    return load_backends(path)
 
-@asynccontextmanager
-async def get_client(base_url, api_key):
-    """Get or create an AsyncOpenAI client."""
-    client_key = f"{base_url}:{api_key}"
-    if client_key not in _clients:
-        long_timeout_async_client = httpx.AsyncClient(timeout=900)
-        _clients[client_key] = AsyncOpenAI(
-            base_url=base_url,
-            api_key=api_key,
-            http_client=long_timeout_async_client
-        )
+def configure_rate_limit(model, rpm=None, tpm=None):
+    """Set the RPM/TPM budget for a model (None disables that budget)."""
+    backend = get_backend(model)
+    if backend is None:
+        raise ValueError(f"Unknown model {model}")
+    backend.rpm = rpm
+    backend.tpm = tpm
+    backend.state.pop("limiter", None)
+
+def configure_endpoints(model, base_urls=None, api_key=None, strategy=None):
+    """Set the replicas serving a model and/or how requests are routed across them."""
+    backend = get_backend(model)
+    if backend is None:
+        raise ValueError(f"Unknown model {model}")
+    if strategy is not None:
+        backend.routing = strategy
+    if base_urls:
+        if api_key is None:
+            api_key = backend.endpoints[0][1] if backend.endpoints else "EMPTY"
+        backend.endpoints = [(url, api_key) for url in base_urls]
+    backend.state.pop("pool", None)
+
+def get_rate_limiter_stats():
+    return {name: backend.state["limiter"].stats()
+            for name, backend in get_backends().items() if "limiter" in backend.state}
+
+def get_endpoint_stats():
+    return {name: backend.state["pool"].stats()
+            for name, backend in get_backends().items() if "pool" in backend.state}
+
+def configure_clients(max_connections=None, http2=None):
+    """Size HTTP connection pools to the run's concurrency and optionally enable HTTP/2."""
+    client_pool.configure(max_connections=max_connections, http2=http2)
+
+def get_client_stats():
+    return client_pool.stats()
+
+async def aclose_clients():
+    """Close the HTTP clients of the running event loop; call before the loop shuts down."""
+    await client_pool.aclose()
+
+def call_llm(model, prompt, **params):
+    async def _call():
+        try:
+            return await async_call_llm(model, prompt, **params)
+        finally:
+            await aclose_clients()
+    return asyncio.run(_call())
+
+_cache = None
+_cache_mode = "use"
+
+def configure_cache(path, mode="use", max_bytes=None, ttl=None):
+    """
+    Enable the on-disk response cache for this run.
+
+    mode: "use" serves hits and stores misses, "refresh" skips lookups but stores
+    fresh responses, "bypass" neither reads nor writes.
+    """
+    global _cache, _cache_mode
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode {mode}, expected one of {CACHE_MODES}")
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(path, max_bytes=max_bytes, ttl=ttl) if path else None
+    _cache_mode = mode
+    return _cache
+
+def get_cache_stats():
+    return _cache.stats() if _cache is not None else None
+
+_batch = None
+
+def configure_batch(directory, processor=None, results=None, idle=2.0):
+    """
+    Queue cache misses into OpenAI Batch JSONL files under directory instead of calling the API.
+
+    results: batch output files to load into the response cache first.
+    Requires the response cache in "use" mode, which is how results reach later runs.
+    """
+    global _batch
+    if _cache is None or _cache_mode != "use":
+        raise ValueError("Batch mode needs the response cache in 'use' mode")
+    for path in results or []:
+        ingest(path, _cache)
+    _batch = BatchCollector(directory, processor=processor, idle=idle)
+    return _batch
+
+def configure_telemetry(metrics_file=None):
+    """Append one JSON line per LLM call to metrics_file (records are always kept for the run summary)."""
+    telemetry.configure(metrics_file)
+
+async def serve_metrics(port, host="127.0.0.1"):
+    """Expose Prometheus metrics at http://host:port/metrics on the running loop."""
+    await telemetry.serve(port, host)
+
+async def close_telemetry():
+    """Stop the metrics endpoint and close the metrics file."""
+    await telemetry.close()
+
+def get_telemetry_summary():
+    return telemetry.format_summary()
+
+def configure_calibration(path=None, update=False):
+    """Load per-model words per token and length bias from path; with update, learn from this run and save them there."""
+    calibration.configure(path, update)
+
+def save_calibration():
+    calibration.save()
+
+def get_calibration_stats():
+    return calibration.stats()
+
+def get_parse_stats():
+    return dict(parse_stats)
+
+def get_batch_stats():
+    return dict(_batch.stats) if _batch is not None else None
+
+# Single-flight: identical requests in flight at the same time share one upstream call
+_inflight = {}
+_singleflight_stats = {"upstream": 0, "merged": 0}
+
+def get_singleflight_stats():
+    return dict(_singleflight_stats)
+
+async def _single_flight(model, messages, **params):
+    loop = asyncio.get_running_loop()
+    key = (id(loop), make_request_key(model, messages, params))
+    task = _inflight.get(key)
+    if task is None:
+        _singleflight_stats["upstream"] += 1
+        task = loop.create_task(_call_backend(model, messages, **params))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        _singleflight_stats["merged"] += 1
+        # The leader's record carries the upstream timings and usage
+        record = current_record()
+        if record is not None:
+            record["source"] = "merged"
+        logging.info(f"{model} request merged with an identical one in flight")
+    # Shielded so a cancelled waiter does not cancel the call for the others
+    return await asyncio.shield(task)
+
+async def async_call_llm(model, prompt, **params):
+    messages = [{"role": "user", "content": prompt}]
+
+    with telemetry.track(model) as record:
+        slot = None
+        if _cache is not None and _cache_mode != "bypass":
+            slot = _cache.next_key(model, messages, params)
+            if _cache_mode == "use":
+                cached = _cache.get(slot)
+                if cached is not None:
+                    logging.info(f"{model} cache hit")
+                    record["source"] = "cache"
+                    record["ok"] = True
+                    return cached
+
+        if _batch is not None:
+            record["source"] = "batch"
+            backend = get_backend(model)
+            response = await _batch.submit(slot, backend.model, messages, {**backend.params, **params})
+        else:
+            response = await _single_flight(model, messages, **params)
+        record["ok"] = bool(response)
+        if response and record["source"] == "upstream" and not record["usage_estimated"]:
+            calibration.observe_tokens(model, count_words(response), record["completion_tokens"])
+
+        if slot is not None and response:
+            _cache.set(slot, model, response)
+        return response
+
+def _structured_output_params(model, schema, name):
+    """Request params that make the backend decode only JSON matching schema."""
+    backend = get_backend(model)
+    mode = backend.options.get("structured_output") if backend is not None else None
+    if mode == "response_format":
+        return {"response_format": {"type": "json_schema",
+                                    "json_schema": {"name": name, "schema": schema, "strict": True}}}
+    if mode == "guided_json":
+        return {"extra_body": {"guided_json": schema}}
+    return {}
+
+async def async_call_llm_json(model, prompt, schema=None, schema_name="response", partial_keys=(), **params):
+    """
+    Call the model and return the first JSON object of the response as a dict.
+
+    With a JSON schema, the backend is asked to decode only matching objects
+    (see "structured_output" in the llm config) and responses that do not
+    match it are rejected; the entries of the arrays under partial_keys may
+    lack keys, for callers that check each entry themselves. With stream=True
+    the stream is cut as soon as the object closes. Returns None if no
+    (valid) object can be parsed.
+    """
+    if schema is not None:
+        params.update(_structured_output_params(model, schema, schema_name))
+    response = await async_call_llm(model, prompt, **params)
+    return _parse_json(model, response, schema, schema_name, partial_keys)
+
+async def async_call_llm_candidates(model, prompt, n, **params):
+    """
+    Sample n responses to one prompt in a single request (the n parameter;
+    parallel sampling on vLLM) and return them as a list of strings.
+
+    The provider returns several choices as a JSON-encoded list, which is what
+    the response cache stores; backends that ignore n yield one candidate.
+    """
+    if n <= 1:
+        return [await async_call_llm(model, prompt, **params)]
+    # Streaming stops at the first complete object, which only works for one choice
+    params.pop("stream", None)
+    response = await async_call_llm(model, prompt, n=n, **params)
     try:
-        yield _clients[client_key]
-    finally:
-        # Don't close the client here, it will be reused
-        pass
-
-def create_retry_decorator(max_retries=8, min_wait=1, max_wait=60):
-    return retry(
-        stop=stop_after_attempt(max_retries),
-        wait=wait_exponential(multiplier=min_wait, max=max_wait),
-        retry=retry_if_exception_type((
-            openai.RateLimitError,  # Rate limit error
-            openai.APITimeoutError,  # Timeout error
-            openai.APIConnectionError,  # Connection error
-            openai.APIError,  # Generic API error
-            asyncio.TimeoutError,  # Async timeout
-            TimeoutError,  # General timeout
-            ConnectionError,  # Connection issues
-        )),
-        before_sleep=lambda retry_state: logger.warning(
-            f"API call failed with {retry_state.outcome.exception()}, "
-            f"retrying in {retry_state.next_action.sleep} seconds..."
-        )
-    )
-
-@create_retry_decorator()
-async def _make_api_call(client, **kwargs):
-    """Helper function to make API calls with retry logic"""
-    return await client.chat.completions.create(**kwargs)
-
-def call_llm(model, prompt):
-    return asyncio.run(async_call_llm(model, prompt))
-
-async def async_call_llm(model, prompt):
+        candidates = json.loads(response)
+    except ValueError:
+        return [response]
+    if isinstance(candidates, list) and all(isinstance(c, str) for c in candidates):
+        return candidates
+    return [response]
+
+async def async_call_llm_json_candidates(model, prompt, n, schema=None, schema_name="response", **params):
+    """Like async_call_llm_json for n candidates in one request; returns a list of dicts or None."""
+    if schema is not None:
+        params.update(_structured_output_params(model, schema, schema_name))
+    responses = await async_call_llm_candidates(model, prompt, n, **params)
+    return [_parse_json(model, response, schema, schema_name) for response in responses]
+
+def _parse_json(model, response, schema=None, schema_name="response", partial_keys=()):
+    parsed = parse_json_object(response)
+    if parsed is None:
+        return None
+    if schema is not None and not validate_json(parsed, schema, partial_keys):
+        logging.error(f"{model} response does not match the {schema_name} schema")
+        return None
+    return parsed
+
+def get_model_limits(model):
+    """Return (context_tokens, max_output_tokens) of the backend, from the llm config."""
+    backend = get_backend(model)
+    options = backend.options if backend is not None else {}
+    return options.get("context_tokens", 32768), options.get("max_output_tokens", 4096)
+
+async def warm_prefix(model, prefix):
+    """
+    Prefill prefix on the server ahead of a fan-out of prompts that start with it,
+    so they hit its prefix (KV) cache. Only backends with "warm_prefix": true in
+    the llm config are warmed; the call bypasses the response cache and batching.
+    """
+    backend = get_backend(model)
+    if backend is None or not backend.options.get("warm_prefix") or _batch is not None:
+        return
+    with telemetry.track(model) as record:
+        response = await _call_backend(model, [{"role": "user", "content": prefix}], max_tokens=1)
+        record["ok"] = bool(response)
+
+async def _call_backend(model, messages, **params):
+    backend = get_backend(model)
+    if backend is None:
+        logging.error("Unsupported model")
+        return ""
+
     try:
-        if model in ["gpt-4o-mini", "gpt-4o"]:
-            api_key = "key-1234567890"
-            base_url = "https://api.openai.com/v1"
-            
-            async with get_client(base_url, api_key) as client:
-                completion = await _make_api_call(
-                    client,
-                    model=model,
-                    store=True,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                logging.info(f"{model} API Call Successful")
-                return completion.choices[0].message.content
-   
-        elif model in ["Llama33-70b", "Qwen2.5-14B-Instruct"]:
-            async with get_client("http://localhost:8000/v1", "sk-Hello-World") as client:
-                model_dict = {
-                    "Llama33-70b": "meta-llama/Llama-3.3-70B-Instruct",
-                    "Qwen2.5-14B-Instruct": "Qwen/Qwen2.5-14B-Instruct"
-                }
-
-                response = await _make_api_call(
-                    client,
-                    model=model_dict[model],
-                    messages=[
-                        {"role": "user", "content": prompt},
-                    ],
-                    stream=False
-                )
-                logging.info(f"{model} API Call Successful")
-                return response.choices[0].message.content
-            
-        else:
-            logging.error("Unsupported model")
-            return ""
+        response = await backend.complete(messages, **params)
+        logging.info(f"{model} API Call Successful")
+        return response
             
     except Exception as e:
         logging.error(f"API Call Failed after retries: {e}")
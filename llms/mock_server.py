@@ -0,0 +1,633 @@
+# mock_server.py
+"""
+OpenAI-compatible stand-in for api.openai.com / vLLM, used to load-test the
+CogWriter orchestration without a real model behind it.
+
+Start it with e.g.
+
+    python -m llms.mock_server --port 8001 --ttft 0.2 --tps 80 --error_rate 0.01
+
+and run main.py with `--model mock` (the base url can be overridden with the
+MOCK_LLM_BASE_URL environment variable). It also stands in for the OpenAI
+Batch API when main.py runs with --batch:
+
+    python -m llms.mock_server --process_batch batch_0001.jsonl results_0001.jsonl
+
+Responses are canned bodies shaped like the ones PlanningAgent and
+GenerationAgent ask for (weekly_plan, floor_plan, block_plan, diary_entry,
+plan, week_menu, refinements). They are derived deterministically from the
+prompt so identical requests return identical bodies. Prompt prefixes are run
+through a simulated prefix cache; with --prefill_tps the uncached part of a
+prompt is prefilled at that (shared) throughput before the first token, and
+/stats reports the hit rate.
+"""
+import argparse
+import ast
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "morning light garden market quiet river walk family dinner letter "
+    "project meeting window city train coffee friend music evening plan "
+    "weekend book rain summer winter notes office lobby terrace studio "
+    "gallery hall stair view street park corner lunch recipe herbs bread "
+    "soup roast salad season harvest festival visit journey memory"
+).split()
+
+WEEK_COUNT = 52
+UNIT_COUNT = 100
+# Prompt characters per KV block of the simulated prefix cache (16 tokens)
+PREFIX_BLOCK_CHARS = 64
+
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token), good enough for pacing."""
+    return max(1, len(text) // 4)
+
+
+def _rng_for(prompt, seed, index=0):
+    digest = hashlib.sha256(f"{seed}:{index}:{prompt}".encode("utf-8")).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+
+def make_text(rng, n_words):
+    words = []
+    while len(words) < n_words:
+        sentence_len = min(rng.randint(8, 16), n_words - len(words))
+        sentence = [rng.choice(WORDS) for _ in range(sentence_len)]
+        sentence[0] = sentence[0].capitalize()
+        words.extend(sentence[:-1])
+        words.append(sentence[-1] + ".")
+    return " ".join(words)
+
+
+def _target_words(prompt, default):
+    # The last "N-word" is the unit instruction; earlier ones describe the whole task
+    matches = re.findall(r"(\d+)-word", prompt)
+    return int(matches[-1]) if matches else default
+
+
+def _jittered(rng, target, jitter):
+    return max(1, int(round(target * (1 + rng.gauss(0, jitter)))))
+
+
+def _quoted_value(prompt, key):
+    match = re.search(rf'"{key}":\s*"([^"]*)"', prompt)
+    return match.group(1) if match else None
+
+
+def week_id(i, prefix="Week"):
+    return f"{prefix} {i}"
+
+
+def floor_id(i):
+    return f"Floor {i}"
+
+
+def block_id(i):
+    return f"Block {i} ({(i - 1) % 10}, {(i - 1) // 10})"
+
+
+# ---------------------------------------------------------------------------
+# Canned bodies
+# ---------------------------------------------------------------------------
+
+def weekly_plan_body(rng, key, revised=False, consistent=True):
+    plan = [{"week_id": week_id(i), "events": make_text(rng, 8)} for i in range(1, WEEK_COUNT + 1)]
+    body = {"analysis": make_text(rng, 30)}
+    if not revised:
+        body["special_events"] = [{"event_name": "Birthday", "week_numb": "Week 19"}]
+        if consistent:
+            plan[18]["events"] += " Birthday"
+    body[key] = plan
+    return body
+
+
+def menu_plan_body(rng, key, revised=False, consistent=True):
+    plan = [{"week_id": week_id(i, "Menu Week"), "dishes": make_text(rng, 8)} for i in range(1, WEEK_COUNT + 1)]
+    body = {"analysis": make_text(rng, 30)}
+    if not revised:
+        body["special_dishes"] = [{"dish_name": "Venison Stew", "week_numb": "Week 19"}]
+        if consistent:
+            plan[18]["dishes"] += " Venison Stew"
+    body[key] = plan
+    return body
+
+
+def floor_plan_body(rng, key, revised=False, consistent=True):
+    plan = [{"floor_id": floor_id(i), "purpose": make_text(rng, 8)} for i in range(1, UNIT_COUNT + 1)]
+    body = {"analysis": make_text(rng, 30)}
+    if not revised:
+        body["special_floors"] = [{"special_purpose": "Design studio", "floor_number": "Floor 51"}]
+        if consistent:
+            plan[50]["purpose"] += " Design studio"
+    body[key] = plan
+    return body
+
+
+def block_plan_body(rng, key, revised=False, consistent=True):
+    plan = [{"block_id": block_id(i), "use": make_text(rng, 8)} for i in range(1, UNIT_COUNT + 1)]
+    body = {"analysis": make_text(rng, 30)}
+    if not revised:
+        body["special_blocks"] = [{"special_use": "Library", "block_number": "Block 10 (9, 0)"}]
+        if consistent:
+            plan[9]["use"] += " Library"
+    body[key] = plan
+    return body
+
+
+def _initial_plan(rng, builder, key, settings):
+    # A plan_error_rate fraction of initial plans leave their special entry
+    # out of the unit it names, so a plan validator has something to catch
+    body = builder(rng, key, consistent=rng.random() >= settings.plan_error_rate)
+    body[key] = _break_entry(rng, _drop_range(rng, body[key], settings.plan_gap_rate), settings.plan_entry_error_rate)
+    return body
+
+
+def _drop_range(rng, plan, gap_rate):
+    # A gap_rate fraction of full plans lose a run of entries, as they do when
+    # a model skips units or its output is cut off
+    if rng.random() >= gap_rate:
+        return plan
+    length = rng.randint(5, 15)
+    start = rng.randint(0, len(plan) - length)
+    return plan[:start] + plan[start + length:]
+
+
+def _break_entry(rng, plan, error_rate):
+    # An error_rate fraction of full plans carry one half-formed entry: the last
+    # one cut down to its id, as when the output runs out of tokens and is
+    # repaired, or one in the middle without its text
+    if rng.random() >= error_rate or not plan:
+        return plan
+    plan = [dict(entry) for entry in plan]
+    id_key, text_key = list(plan[0])[:2]
+    if rng.random() < 0.5:
+        plan[-1] = {id_key: plan[-1][id_key]}
+    else:
+        del plan[rng.randrange(len(plan))][text_key]
+    return plan
+
+
+def _plan_builder(prompt):
+    if '"floor_id"' in prompt:
+        return floor_plan_body
+    if '"block_id"' in prompt:
+        return block_plan_body
+    if '"dishes"' in prompt:
+        return menu_plan_body
+    return weekly_plan_body
+
+
+def _quoted_plan(prompt):
+    """The plan (a list of dicts) quoted on its own line in a revise prompt, or None."""
+    match = re.search(r"^(\[\{.*\}\])$", prompt, re.MULTILINE)
+    if not match:
+        return None
+    try:
+        current = ast.literal_eval(match.group(1))
+    except (ValueError, SyntaxError):
+        return None
+    if not isinstance(current, list) or not all(isinstance(entry, dict) for entry in current):
+        return None
+    return current
+
+
+def revise_entries(rng, prompt, plan, revise_rate):
+    """
+    Revise the plan quoted in a revise prompt the way models do: keep most
+    entries and rewrite a revise_rate fraction. Falls back to plan (a fresh
+    one) if the prompt carries no readable plan.
+    """
+    current = _quoted_plan(prompt)
+    if current is None:
+        return plan
+    revised = []
+    for entry, fresh in zip(current, plan):
+        revised.append(dict(fresh) if rng.random() < revise_rate else dict(entry))
+    return revised
+
+
+def unit_body(rng, prompt, id_key, text_key, jitter, bias=1.0):
+    target = _target_words(prompt, 150) * bias
+    return {
+        id_key: _quoted_value(prompt, id_key) or "",
+        "check": make_text(rng, 12),
+        text_key: make_text(rng, _jittered(rng, target, jitter)),
+    }
+
+
+def refinement_text(rng, prompt):
+    match = re.search(r"need to be (shorten|lengthen) by (\d+) words", prompt)
+    text = prompt.split("Text:", 1)[-1].rsplit("Return only the refined text.", 1)[0]
+    current = len(text.split())
+    if not match:
+        return make_text(rng, current or 100)
+    delta = int(match.group(2))
+    target = current - delta if match.group(1) == "shorten" else current + delta
+    return make_text(rng, max(1, target))
+
+
+def build_content(prompt, settings, index=0):
+    """Return (content, is_json) for a prompt."""
+    rng = _rng_for(prompt, settings.seed, index)
+    jitter = settings.length_jitter
+
+    if "You are an expert editor" in prompt:
+        return refinement_text(rng, prompt), False
+
+    if '"units"' in prompt and '"check"' in prompt:
+        # Multi-unit request: one unit per "- <id>: ..." line of the listing
+        listing = prompt.split("for each of the following", 1)[-1]
+        ids = re.findall(r"^- (.+?): ", listing, re.MULTILINE)
+        for marker, id_key, text_key in (('"diary_entry"', "week_id", "diary_entry"), ('"week_menu"', "week_id", "week_menu"),
+                                         ('"floor_id"', "floor_id", "plan"), ('"block_id"', "block_id", "plan")):
+            if marker in prompt:
+                units = [unit_body(rng, prompt, id_key, text_key, jitter, settings.length_bias) for _ in ids]
+                for unit, unit_id in zip(units, ids):
+                    unit[id_key] = unit_id
+                return {"units": units}, True
+
+    if '"check"' in prompt:
+        if '"diary_entry"' in prompt:
+            return unit_body(rng, prompt, "week_id", "diary_entry", jitter, settings.length_bias), True
+        if '"week_menu"' in prompt:
+            return unit_body(rng, prompt, "week_id", "week_menu", jitter, settings.length_bias), True
+        if '"floor_id"' in prompt:
+            return unit_body(rng, prompt, "floor_id", "plan", jitter, settings.length_bias), True
+        if '"block_id"' in prompt:
+            return unit_body(rng, prompt, "block_id", "plan", jitter, settings.length_bias), True
+
+    if '"missing_entries"' in prompt or '"range_plan"' in prompt:
+        # Gap filling ("Missing <unit>s: 5, 88-100") or range planning
+        # ("Plan <unit>s: 21-40"): one entry for each listed unit
+        key = "missing_entries" if '"missing_entries"' in prompt else "range_plan"
+        match = re.search(r"^(?:Missing|Plan) \w+s: (.*)$", prompt, re.MULTILINE)
+        numbers = set()
+        for part in match.group(1).split(",") if match else []:
+            low, _, high = part.strip().partition("-")
+            numbers.update(range(int(low), int(high or low) + 1))
+        consistent = key == "missing_entries" or rng.random() >= settings.plan_error_rate
+        fresh = _plan_builder(prompt)(rng, "plan", consistent=consistent)["plan"]
+        return {key: [entry for number, entry in enumerate(fresh, 1) if number in numbers]}, True
+
+    if '"changes"' in prompt:
+        # Patch-style revision: only the entries that differ from the quoted plan
+        current = _quoted_plan(prompt) or []
+        fresh = _plan_builder(prompt)(rng, "plan")["plan"]
+        revised = revise_entries(rng, prompt, fresh, settings.revise_rate)
+        changes = [entry for entry, old in zip(revised, current) if entry != old]
+        return {"analysis": make_text(rng, 30), "changes": changes}, True
+
+    for key, builder in (
+        ("revised_floor_plan", floor_plan_body),
+        ("revised_block_plan", block_plan_body),
+        ("floor_plan", floor_plan_body),
+        ("block_plan", block_plan_body),
+    ):
+        if f'"{key}"' in prompt:
+            if not key.startswith("revised"):
+                return _initial_plan(rng, builder, key, settings), True
+            body = builder(rng, key, revised=True)
+            body[key] = _break_entry(rng, _drop_range(rng, revise_entries(rng, prompt, body[key], settings.revise_rate),
+                                                      settings.plan_gap_rate), settings.plan_entry_error_rate)
+            return body, True
+
+    for key in ("revised_weekly_plan", "weekly_plan"):
+        if f'"{key}"' in prompt:
+            builder = menu_plan_body if '"dishes"' in prompt else weekly_plan_body
+            if not key.startswith("revised"):
+                return _initial_plan(rng, builder, key, settings), True
+            body = builder(rng, key, revised=True)
+            body[key] = _break_entry(rng, _drop_range(rng, revise_entries(rng, prompt, body[key], settings.revise_rate),
+                                                      settings.plan_gap_rate), settings.plan_entry_error_rate)
+            return body, True
+
+    for key, builder in (
+        ("special_floors", floor_plan_body),
+        ("special_blocks", block_plan_body),
+        ("special_dishes", menu_plan_body),
+        ("special_events", weekly_plan_body),
+    ):
+        if f'"{key}"' in prompt:
+            # Plan outline: the analysis and special units, without the plan
+            body = builder(rng, "plan")
+            del body["plan"]
+            return body, True
+
+    return make_text(rng, 100), False
+
+
+def render_content(body, is_json, rng, settings):
+    """Serialise a canned body, optionally with the noise real models add."""
+    if not is_json:
+        return body
+    text = json.dumps(body, ensure_ascii=False, indent=2)
+    if rng.random() < settings.malformed_rate:
+        # Truncated object, as if the model stopped half way
+        text = text[: max(1, int(len(text) * rng.uniform(0.5, 0.95)))]
+    elif rng.random() < settings.chatter_rate:
+        text = "Here is the requested JSON:\n```json\n" + text + "\n```\n" + make_text(rng, 60)
+    return text
+
+
+def generate_choices(payload, settings, rng):
+    """Return (prompt, contents, finish_reasons) for a chat completion request."""
+    prompt = "\n".join(str(m.get("content", "")) for m in payload.get("messages", []))
+    # Constrained decoding (guided_json / json_schema response_format) never emits prose or broken JSON
+    constrained = "guided_json" in payload or (payload.get("response_format") or {}).get("type") == "json_schema"
+    n = int(payload.get("n") or 1)
+    max_tokens = payload.get("max_tokens") or payload.get("max_completion_tokens")
+
+    contents = []
+    finish_reasons = []
+    for index in range(n):
+        body, is_json = build_content(prompt, settings, index)
+        # Noise is drawn per request so a retry of a garbled answer can succeed
+        text = json.dumps(body, ensure_ascii=False) if constrained and is_json else render_content(body, is_json, rng, settings)
+        finish = "stop"
+        if max_tokens and estimate_tokens(text) > max_tokens:
+            text = text[: int(max_tokens) * 4]
+            finish = "length"
+        contents.append(text)
+        finish_reasons.append(finish)
+    return prompt, contents, finish_reasons
+
+
+def completion_body(completion_id, created, model, prompt, contents, finish_reasons, cached_tokens=0):
+    prompt_tokens = estimate_tokens(prompt)
+    completion_tokens = sum(estimate_tokens(c) for c in contents)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": finish_reasons[index],
+            }
+            for index, text in enumerate(contents)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+class PrefixCache:
+    """
+    Simulated automatic prefix caching (as in vLLM): prompts are split into
+    fixed-size blocks identified by a hash of everything up to and including
+    the block, and the longest run of already cached leading blocks is reused.
+    Blocks become reusable only once their request has finished prefill, so
+    siblings sent at the same moment all miss, as on a real server.
+    """
+
+    def __init__(self, capacity_blocks):
+        self.capacity_blocks = capacity_blocks
+        self._blocks = OrderedDict()
+
+    def match(self, prompt):
+        """Return (cached prompt tokens, block keys to insert after prefill)."""
+        digest = hashlib.blake2b(digest_size=16)
+        keys = []
+        cached_chars = 0
+        reusing = True
+        for start in range(0, len(prompt) - PREFIX_BLOCK_CHARS + 1, PREFIX_BLOCK_CHARS):
+            digest.update(prompt[start:start + PREFIX_BLOCK_CHARS].encode("utf-8"))
+            key = digest.copy().hexdigest()
+            if reusing and key in self._blocks:
+                self._blocks.move_to_end(key)
+                cached_chars += PREFIX_BLOCK_CHARS
+            else:
+                reusing = False
+                keys.append(key)
+        return cached_chars // 4, keys
+
+    def insert(self, keys):
+        for key in keys:
+            self._blocks[key] = True
+        while len(self._blocks) > self.capacity_blocks:
+            self._blocks.popitem(last=False)
+
+
+# ---------------------------------------------------------------------------
+# HTTP app
+# ---------------------------------------------------------------------------
+
+def create_app(settings):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI(title="CogWriter mock LLM")
+    stats = {"requests": 0, "errors": 0, "rate_limited": 0, "completion_tokens": 0,
+             "prompt_tokens": 0, "cached_prompt_tokens": 0, "prefill_seconds": 0.0}
+    app.state.stats = stats
+    prefix_cache = PrefixCache(settings.prefix_cache_blocks)
+    prefill_state = {"busy_until": 0.0}
+
+    def error(status, message, err_type, headers=None):
+        return JSONResponse(
+            status_code=status,
+            content={"error": {"message": message, "type": err_type, "code": status}},
+            headers=headers,
+        )
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": settings.model_name, "object": "model"}]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        stats["requests"] += 1
+        request_rng = random.Random()
+
+        if request_rng.random() < settings.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return error(429, "Rate limit reached (mock)", "rate_limit_error",
+                         headers={"retry-after": str(settings.retry_after)})
+        if request_rng.random() < settings.error_rate:
+            stats["errors"] += 1
+            return error(500, "Internal server error (mock)", "server_error")
+
+        prompt, contents, finish_reasons = generate_choices(payload, settings, request_rng)
+        model = payload.get("model", settings.model_name)
+        completion_tokens = sum(estimate_tokens(c) for c in contents)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        prompt_tokens = estimate_tokens(prompt)
+        cached_tokens, new_blocks = prefix_cache.match(prompt)
+        prefill = (prompt_tokens - cached_tokens) / settings.prefill_tps if settings.prefill_tps else 0.0
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_prompt_tokens"] += cached_tokens
+        stats["prefill_seconds"] += prefill
+        # Prefill is compute bound: concurrent prompts queue for the same prefill throughput
+        now = time.monotonic()
+        prefill_done = max(now, prefill_state["busy_until"]) + prefill
+        prefill_state["busy_until"] = prefill_done
+        ttft = max(0.0, settings.ttft * (1 + request_rng.gauss(0, settings.latency_jitter))) + (prefill_done - now)
+
+        if payload.get("stream"):
+            async def event_stream():
+                await asyncio.sleep(ttft)
+                prefix_cache.insert(new_blocks)
+                for index, text in enumerate(contents):
+                    pieces = re.findall(r".{1,%d}" % (4 * settings.chunk_tokens), text, re.DOTALL)
+                    for piece in pieces:
+                        chunk = {
+                            "id": completion_id, "object": "chat.completion.chunk",
+                            "created": created, "model": model,
+                            "choices": [{"index": index, "delta": {"content": piece}, "finish_reason": None}],
+                        }
+                        yield f"data: {json.dumps(chunk)}\n\n"
+                        # Only count what was sent: clients may close the stream early
+                        stats["completion_tokens"] += estimate_tokens(piece)
+                        await asyncio.sleep(estimate_tokens(piece) / settings.tps)
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk",
+                        "created": created, "model": model,
+                        "choices": [{"index": index, "delta": {}, "finish_reason": finish_reasons[index]}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+        stats["completion_tokens"] += completion_tokens
+        # Choices are decoded in parallel, so the slowest one sets the pace
+        decode = max(estimate_tokens(c) for c in contents) / settings.tps
+        await asyncio.sleep(ttft)
+        prefix_cache.insert(new_blocks)
+        await asyncio.sleep(decode)
+        return completion_body(completion_id, created, model, prompt, contents, finish_reasons, cached_tokens)
+
+    return app
+
+
+def write_dataset(path, examples):
+    """Write a synthetic dataset covering all four task types."""
+    types = [("Week", WEEK_COUNT), ("Floor", UNIT_COUNT), ("Menu Week", WEEK_COUNT), ("Block", UNIT_COUNT)]
+    dataset = []
+    for i in range(examples):
+        example_type, number = types[i % len(types)]
+        dataset.append({
+            "id": f"mock-{i}",
+            "type": example_type,
+            "number": number,
+            "prompt": f"Mock request {i}: write a {example_type.lower()} plan with {number} units.",
+            "checks_once": {}, "checks_range": {}, "checks_periodic": {},
+        })
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dataset, f, indent=2)
+
+
+def process_batch(input_path, output_path, settings):
+    """
+    Answer an OpenAI Batch input file the way the Batch API would: one output
+    line per request, matched by custom_id, with failed requests reported
+    through status codes instead of HTTP errors.
+    """
+    rng = random.Random()
+    batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+    failed = 0
+    with open(input_path, "r", encoding="utf-8") as src, open(output_path, "w", encoding="utf-8") as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            payload = request["body"]
+            request_id = f"req_{uuid.uuid4().hex[:24]}"
+            if rng.random() < settings.error_rate:
+                failed += 1
+                response = {"status_code": 500, "request_id": request_id,
+                            "body": {"error": {"message": "Internal server error (mock)", "type": "server_error"}}}
+            else:
+                prompt, contents, finish_reasons = generate_choices(payload, settings, rng)
+                body = completion_body(f"chatcmpl-{uuid.uuid4().hex[:24]}", int(time.time()),
+                                       payload.get("model", settings.model_name), prompt, contents, finish_reasons)
+                response = {"status_code": 200, "request_id": request_id, "body": body}
+            result = {"id": f"{batch_id}_{request_id}", "custom_id": request["custom_id"],
+                      "response": response, "error": None}
+            dst.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock LLM server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--model_name", type=str, default="mock")
+    parser.add_argument("--ttft", type=float, default=0.2, help="Time to first token in seconds")
+    parser.add_argument("--tps", type=float, default=80.0, help="Decode speed in tokens per second")
+    parser.add_argument("--latency_jitter", type=float, default=0.1, help="Relative std-dev of the TTFT")
+    parser.add_argument("--prefill_tps", type=float, default=0.0,
+                        help="Prefill speed in tokens per second for prompt tokens missing the prefix cache (0: free)")
+    parser.add_argument("--prefix_cache_blocks", type=int, default=50000,
+                        help="Capacity of the simulated prefix cache in 16-token blocks")
+    parser.add_argument("--chunk_tokens", type=int, default=4, help="Tokens per streamed chunk")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After header sent with 429s")
+    parser.add_argument("--chatter_rate", type=float, default=0.0, help="Fraction of JSON bodies wrapped in extra prose")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="Fraction of JSON bodies truncated")
+    parser.add_argument("--length_jitter", type=float, default=0.15, help="Relative std-dev of unit text lengths")
+    parser.add_argument("--revise_rate", type=float, default=0.1,
+                        help="Fraction of plan entries a revision rewrites; the rest are kept as they are")
+    parser.add_argument("--plan_error_rate", type=float, default=0.3,
+                        help="Fraction of initial plans whose special entry is missing from the unit it names")
+    parser.add_argument("--plan_gap_rate", type=float, default=0.0,
+                        help="Fraction of full plans (initial or revised) missing a run of 5-15 entries")
+    parser.add_argument("--plan_entry_error_rate", type=float, default=0.0,
+                        help="Fraction of full plans (initial or revised) with one half-formed entry (cut short or without its text)")
+    parser.add_argument("--length_bias", type=float, default=1.0,
+                        help="Unit text length relative to the requested word count (e.g. 0.8 for a model that undershoots)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write_dataset", type=str, default=None,
+                        help="Write a synthetic dataset to this path and exit")
+    parser.add_argument("--examples", type=int, default=8, help="Number of examples for --write_dataset")
+    parser.add_argument("--process_batch", type=str, nargs=2, default=None, metavar=("INPUT", "OUTPUT"),
+                        help="Answer an OpenAI Batch JSONL input file offline and exit")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.write_dataset:
+        write_dataset(args.write_dataset, args.examples)
+        print(f"Wrote {args.examples} examples to {args.write_dataset}")
+        return
+    if args.process_batch:
+        input_path, output_path = args.process_batch
+        failed = process_batch(input_path, output_path, args)
+        print(f"Processed {input_path} -> {output_path} ({failed} failed)")
+        return
+
+    import uvicorn
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
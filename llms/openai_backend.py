@@ -0,0 +1,172 @@
+# openai_backend.py
+"""
+Provider for OpenAI-compatible HTTP APIs (api.openai.com, vLLM, the mock
+server). Imported lazily by the registry the first time such a backend is used.
+"""
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+
+import openai
+from openai import AsyncOpenAI
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    wait_exponential,
+    retry_if_exception_type
+)
+
+from llms.client_pool import client_pool
+from llms.endpoint_pool import EndpointPool
+from llms.rate_limiter import RateLimiter, estimate_tokens
+from llms.telemetry import count_retry, current_record, record_usage
+from utils.jsonParser import JSONBoundaryDetector
+
+logger = logging.getLogger(__name__)
+
+# Completion size assumed for budgeting when a call sets no max_tokens
+DEFAULT_COMPLETION_TOKENS = 1000
+
+def _new_client(base_url, api_key, http_client):
+    return AsyncOpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        http_client=http_client,
+        # Retries are handled by create_retry_decorator, which also feeds 429s to the rate limiter
+        max_retries=0
+    )
+
+@asynccontextmanager
+async def get_client(base_url, api_key):
+    """Get or create the running loop's AsyncOpenAI client for base_url/api_key."""
+    async with client_pool.lease(_new_client, base_url, api_key) as client:
+        yield client
+
+def _before_retry_sleep(retry_state):
+    count_retry()
+    logger.warning(
+        f"API call failed with {retry_state.outcome.exception()}, "
+        f"retrying in {retry_state.next_action.sleep} seconds..."
+    )
+
+def create_retry_decorator(max_retries=8, min_wait=1, max_wait=60):
+    return retry(
+        stop=stop_after_attempt(max_retries),
+        wait=wait_exponential(multiplier=min_wait, max=max_wait),
+        retry=retry_if_exception_type((
+            openai.RateLimitError,  # Rate limit error
+            openai.APITimeoutError,  # Timeout error
+            openai.APIConnectionError,  # Connection error
+            openai.APIError,  # Generic API error
+            asyncio.TimeoutError,  # Async timeout
+            TimeoutError,  # General timeout
+            ConnectionError,  # Connection issues
+        )),
+        before_sleep=_before_retry_sleep
+    )
+
+def get_rate_limiter(backend):
+    """The backend's RPM/TPM limiter, or None if it has no limits."""
+    if not (backend.rpm or backend.tpm):
+        return None
+    if "limiter" not in backend.state:
+        backend.state["limiter"] = RateLimiter(rpm=backend.rpm, tpm=backend.tpm)
+    return backend.state["limiter"]
+
+def get_endpoint_pool(backend):
+    if "pool" not in backend.state:
+        backend.state["pool"] = EndpointPool(
+            backend.endpoints,
+            strategy=backend.routing,
+            # Throttling is the rate limiter's business, not a sign of a broken replica
+            ignored_errors=(openai.RateLimitError,),
+        )
+    return backend.state["pool"]
+
+def _estimate_request_tokens(kwargs):
+    prompt_tokens = sum(estimate_tokens(str(m["content"])) for m in kwargs.get("messages", []))
+    completion_tokens = kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion_tokens * (kwargs.get("n") or 1)
+
+@asynccontextmanager
+async def _rate_limited(limiter, estimated):
+    """
+    Wait for budget before a call; pause the backend if it still answers 429.
+    A failed attempt gives its token reservation back before it is retried.
+    """
+    if limiter is None:
+        yield
+        return
+    await limiter.acquire(estimated)
+    try:
+        yield
+    except openai.RateLimitError as e:
+        limiter.release(estimated)
+        retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        limiter.penalize(retry_after)
+        raise
+    except BaseException:
+        limiter.release(estimated)
+        raise
+
+def _call_kind():
+    """The stage label of the call in progress, so replicas are compared on calls of similar length"""
+    record = current_record()
+    return record["stage"] if record is not None else None
+
+@create_retry_decorator()
+async def _make_api_call(pool, limiter=None, **kwargs):
+    """Helper function to make API calls with retry logic; every attempt is routed afresh"""
+    estimated = _estimate_request_tokens(kwargs)
+    async with _rate_limited(limiter, estimated), pool.acquire(_call_kind()) as endpoint:
+        async with get_client(endpoint.base_url, endpoint.api_key) as client:
+            completion = await client.chat.completions.create(**kwargs)
+    if completion.usage is not None:
+        details = getattr(completion.usage, "prompt_tokens_details", None)
+        record_usage(completion.usage.prompt_tokens, completion.usage.completion_tokens,
+                     cached_tokens=getattr(details, "cached_tokens", None))
+        if limiter is not None:
+            limiter.reconcile(estimated, completion.usage.total_tokens)
+    return completion
+
+@create_retry_decorator()
+async def _make_streaming_call(pool, limiter=None, **kwargs):
+    """Stream a completion and stop reading as soon as the first JSON object closes"""
+    detector = JSONBoundaryDetector()
+    estimated = _estimate_request_tokens(kwargs)
+    async with _rate_limited(limiter, estimated), pool.acquire(_call_kind()) as endpoint:
+        async with get_client(endpoint.base_url, endpoint.api_key) as client:
+            stream = await client.chat.completions.create(**kwargs)
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if detector.feed(chunk.choices[0].delta.content):
+                            break
+            finally:
+                # Closing the stream drops the connection, so the server stops decoding
+                await stream.close()
+    text = detector.text if detector.complete else detector.raw
+    # Cut streams never see a usage chunk
+    prompt_tokens = sum(estimate_tokens(str(m["content"])) for m in kwargs["messages"])
+    completion_tokens = estimate_tokens(detector.raw)
+    record_usage(prompt_tokens, completion_tokens, estimated=True)
+    if limiter is not None:
+        limiter.reconcile(estimated, prompt_tokens + completion_tokens)
+    return text
+
+async def complete(backend, messages, **params):
+    """Return the text of a (streamed or regular) completion"""
+    pool = get_endpoint_pool(backend)
+    limiter = get_rate_limiter(backend)
+    if params.get("stream"):
+        return await _make_streaming_call(pool, limiter, model=backend.model, messages=messages, **params)
+    completion = await _make_api_call(pool, limiter, model=backend.model, messages=messages, **params)
+    if (params.get("n") or 1) > 1:
+        # Several choices travel (and are cached) as one JSON-encoded list
+        return json.dumps([choice.message.content or "" for choice in completion.choices], ensure_ascii=False)
+    return completion.choices[0].message.content
@@ -0,0 +1,103 @@
+# rate_limiter.py
+"""
+Token-bucket rate limiting with requests-per-minute and tokens-per-minute
+budgets, so calls are spread out just under the provider limits instead of
+bursting into 429s and tenacity back-off.
+
+Budgets are reserved up front (the bucket may go negative) and the caller
+sleeps until its reservation is covered. Reservations happen without awaiting,
+so they are atomic on the event loop and served in FIFO order without a lock
+bound to a particular loop.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token)."""
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount, now):
+        """Take amount from the bucket and return the seconds until it is covered."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    RPM/TPM budget for one backend.
+
+    Args:
+        rpm (int): Requests per minute allowed by the provider (None for no limit)
+        tpm (int): Tokens per minute allowed by the provider (None for no limit)
+        headroom (float): Fraction of the limits to actually use
+        burst_seconds (float): How many seconds of budget may be spent at once
+    """
+
+    def __init__(self, rpm=None, tpm=None, headroom=0.9, burst_seconds=5.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = TokenBucket(rpm * headroom, burst_seconds) if rpm else None
+        self._tokens = TokenBucket(tpm * headroom, burst_seconds) if tpm else None
+        self._paused_until = 0.0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.rate_limited = 0
+
+    async def acquire(self, tokens):
+        """Wait until a request of the estimated size fits the budget."""
+        now = time.monotonic()
+        delay = max(0.0, self._paused_until - now)
+        if self._requests is not None:
+            delay = max(delay, self._requests.reserve(1, now))
+        if self._tokens is not None:
+            delay = max(delay, self._tokens.reserve(tokens, now))
+        if delay > 0:
+            self.waits += 1
+            self.wait_time += delay
+            await asyncio.sleep(delay)
+
+    def reconcile(self, estimated, actual):
+        """Correct the token budget once the real usage of a call is known."""
+        if self._tokens is not None and actual is not None:
+            self._tokens.refund(min(estimated, self._tokens.capacity) - actual)
+
+    def release(self, estimated):
+        """Give back the token reservation of an attempt that failed, so its retry does not pay twice."""
+        if self._tokens is not None:
+            self._tokens.refund(min(estimated, self._tokens.capacity))
+
+    def penalize(self, retry_after=None):
+        """The provider answered 429 anyway: pause everyone for retry_after seconds."""
+        self.rate_limited += 1
+        pause = retry_after if retry_after is not None else 1.0
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        logger.warning(f"Rate limited by provider, pausing requests for {pause:.1f}s")
+
+    def stats(self):
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "rate_limited": self.rate_limited,
+        }
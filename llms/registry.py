@@ -0,0 +1,103 @@
+# registry.py
+"""
+Backend registry loaded from a JSON config file (llms/backends.json by default,
+or the file named by COGWRITER_LLM_CONFIG / main.py --llm_config).
+
+Each entry maps the model name used on the command line to a provider and its
+settings, e.g.
+
+    "Llama33-70b": {
+        "provider": "openai",                      # OpenAI-compatible HTTP API (OpenAI, vLLM, mock)
+        "model": "meta-llama/Llama-3.3-70B-Instruct",
+        "endpoints": [{"base_url": "http://localhost:8000/v1", "api_key": "sk-Hello-World"}],
+        "endpoints_env": "VLLM_ENDPOINTS",         # optional comma-separated override
+        "rpm": null, "tpm": null,                  # optional rate limits
+        "routing": "least_outstanding",            # optional replica routing strategy
+        "params": {},                              # extra request params sent on every call
+        "context_tokens": 131072,                  # context window and output limit, used to size
+        "max_output_tokens": 8192,                 # multi-unit calls (defaults 32768 and 4096)
+        "warm_prefix": true,                       # prefill shared prompt prefixes before fan-outs
+        "structured_output": "guided_json"         # how JSON schemas are sent: "response_format" (OpenAI),
+                                                   # "guided_json" (vLLM) or omitted
+    }
+
+Provider modules are imported only when a backend using them is first called,
+so heavy libraries (openai, transformers/torch) never load on paths that do
+not need them.
+"""
+import importlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backends.json")
+
+PROVIDERS = {
+    "openai": "llms.openai_backend",
+    "transformers": "llms.transformers_backend",
+}
+
+
+class Backend:
+    def __init__(self, name, provider, model=None, endpoints=None, endpoints_env=None,
+                 rpm=None, tpm=None, routing="least_outstanding", params=None, **options):
+        if provider not in PROVIDERS:
+            raise ValueError(f"Backend {name}: unknown provider {provider}, expected one of {list(PROVIDERS)}")
+        self.name = name
+        self.provider = provider
+        self.model = model or name
+        self.endpoints = self._resolve_endpoints(endpoints or [], endpoints_env)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.routing = routing
+        self.params = params or {}
+        self.options = options
+        # Per-backend runtime state owned by the provider module (client pools, limiters, pipelines)
+        self.state = {}
+
+    @staticmethod
+    def _resolve_endpoints(endpoints, endpoints_env):
+        resolved = []
+        for endpoint in endpoints:
+            api_key = endpoint.get("api_key", "EMPTY")
+            if endpoint.get("api_key_env"):
+                api_key = os.environ.get(endpoint["api_key_env"], api_key)
+            resolved.append((endpoint["base_url"], api_key))
+        if endpoints_env and os.environ.get(endpoints_env):
+            api_key = resolved[0][1] if resolved else "EMPTY"
+            resolved = [(url.strip(), api_key) for url in os.environ[endpoints_env].split(",") if url.strip()]
+        return resolved
+
+    @property
+    def module(self):
+        return importlib.import_module(PROVIDERS[self.provider])
+
+    async def complete(self, messages, **params):
+        """Return the completion text for messages."""
+        return await self.module.complete(self, messages, **{**self.params, **params})
+
+
+_backends = None
+
+
+def load_backends(path=None):
+    """(Re)load the registry from a JSON config file."""
+    global _backends
+    path = path or os.environ.get("COGWRITER_LLM_CONFIG") or DEFAULT_CONFIG
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    _backends = {name: Backend(name, **settings) for name, settings in config.items()}
+    logger.info(f"Loaded {len(_backends)} LLM backends from {path}")
+    return _backends
+
+
+def get_backends():
+    if _backends is None:
+        load_backends()
+    return _backends
+
+
+def get_backend(name):
+    return get_backends().get(name)
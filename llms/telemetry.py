@@ -0,0 +1,285 @@
+# telemetry.py
+"""
+Per-call LLM telemetry.
+
+Every async_call_llm call produces one record tagged with the labels of the
+surrounding call_context() blocks (stage, example_id, unit_id) and holding:
+
+    queue_wait         seconds blocked on the MeteredSemaphore before the call
+    ttfb               seconds until the response headers arrived (upstream calls only)
+    latency            total seconds spent in async_call_llm
+    prompt_tokens      from the API usage block (estimated for streamed calls)
+    cached_tokens      prompt tokens served from the server's prefix cache, when reported
+    completion_tokens
+    retries            attempts retried by the provider's retry decorator
+    source             "upstream", "cache", "merged" (single-flight follower) or "batch"
+
+Labels live in context variables, so asyncio tasks spawned inside a block
+(the per-unit gather fan-out) inherit them; so does call_priority(), which
+orders the calls waiting on the MeteredSemaphore. Records are appended to a JSONL
+file, aggregated for a Prometheus text endpoint and summarised per stage at
+the end of a run.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import statistics
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LABELS = ("stage", "example_id", "unit_id")
+
+_labels = contextvars.ContextVar("llm_call_labels", default={})
+_queue_wait = contextvars.ContextVar("llm_queue_wait", default=0.0)
+_record = contextvars.ContextVar("llm_call_record", default=None)
+_priority = contextvars.ContextVar("llm_call_priority", default=0)
+
+
+@contextmanager
+def call_context(**labels):
+    """Tag the LLM calls made inside the block (and in tasks it spawns)."""
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextmanager
+def call_priority(priority):
+    """
+    Queue the calls made inside the block (and in tasks it spawns) at this
+    priority on a MeteredSemaphore: a freed slot goes to the highest priority
+    waiting, first come first served among equals. Calls default to 0.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class MeteredSemaphore:
+    """
+    Semaphore that remembers how long the current task waited to acquire it,
+    and hands freed slots to waiters by call_priority().
+    """
+
+    def __init__(self, value=1):
+        self._value = value
+        self._waiters = []  # heap of (-priority, arrival, future)
+        self._arrivals = itertools.count()
+
+    def locked(self):
+        return self._value == 0
+
+    async def acquire(self):
+        start = time.perf_counter()
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (-_priority.get(), next(self._arrivals), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Cancelled after release() handed this task the slot: pass it on
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        _queue_wait.set(time.perf_counter() - start)
+        return True
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self._value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def current_record():
+    """The record of the call in progress in this context, or None."""
+    return _record.get()
+
+
+def mark_first_byte():
+    record = _record.get()
+    if record is not None and record["ttfb"] is None:
+        record["ttfb"] = time.perf_counter() - record["_start"]
+
+
+def count_retry():
+    record = _record.get()
+    if record is not None:
+        record["retries"] += 1
+
+
+def record_usage(prompt_tokens, completion_tokens, estimated=False, cached_tokens=None):
+    record = _record.get()
+    if record is not None:
+        record["prompt_tokens"] = prompt_tokens
+        record["cached_tokens"] = cached_tokens
+        record["completion_tokens"] = completion_tokens
+        record["usage_estimated"] = estimated
+
+
+class Telemetry:
+    """Collects call records; optionally streams them to a JSONL file and serves Prometheus metrics."""
+
+    def __init__(self):
+        self.records = []
+        self._file = None
+        self._server = None
+
+    def configure(self, metrics_file=None):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(metrics_file, "a", encoding="utf-8") if metrics_file else None
+
+    @contextmanager
+    def track(self, model):
+        """Open a record for one call; the provider fills it in through the module helpers."""
+        record = {
+            "model": model,
+            **{label: _labels.get().get(label) for label in LABELS},
+            "source": "upstream",
+            "queue_wait": _queue_wait.get(),
+            "ttfb": None,
+            "latency": None,
+            "prompt_tokens": None,
+            "cached_tokens": None,
+            "completion_tokens": None,
+            "usage_estimated": False,
+            "retries": 0,
+            "ok": False,
+            "_start": time.perf_counter(),
+        }
+        # The wait belongs to this call only
+        _queue_wait.set(0.0)
+        token = _record.set(record)
+        try:
+            yield record
+        finally:
+            _record.reset(token)
+            record["latency"] = time.perf_counter() - record.pop("_start")
+            record["timestamp"] = time.time()
+            self.records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        """Per-stage aggregates, in first-seen stage order."""
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record["stage"] or "-", []).append(record)
+        rows = []
+        for stage, records in stages.items():
+            latencies = sorted(r["latency"] for r in records)
+            ttfbs = [r["ttfb"] for r in records if r["ttfb"] is not None]
+            rows.append({
+                "stage": stage,
+                "calls": len(records),
+                "upstream": sum(r["source"] == "upstream" for r in records),
+                "failed": sum(not r["ok"] for r in records),
+                "queue_wait": sum(r["queue_wait"] for r in records),
+                "ttfb_mean": statistics.fmean(ttfbs) if ttfbs else None,
+                "latency_p50": latencies[len(latencies) // 2],
+                "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in records),
+                "cached_tokens": sum(r["cached_tokens"] or 0 for r in records),
+                "completion_tokens": sum(r["completion_tokens"] or 0 for r in records),
+                "retries": sum(r["retries"] for r in records),
+            })
+        return rows
+
+    def format_summary(self):
+        header = (f"{'stage':<10}{'calls':>7}{'upstream':>10}{'failed':>8}{'queue s':>10}{'ttfb s':>8}"
+                  f"{'p50 s':>8}{'p95 s':>8}{'prompt tok':>12}{'cached tok':>12}{'compl tok':>11}{'retries':>9}")
+        lines = [header, "-" * len(header)]
+        for row in self.summary():
+            ttfb = f"{row['ttfb_mean']:.2f}" if row["ttfb_mean"] is not None else "-"
+            lines.append(
+                f"{row['stage']:<10}{row['calls']:>7}{row['upstream']:>10}{row['failed']:>8}"
+                f"{row['queue_wait']:>10.1f}{ttfb:>8}{row['latency_p50']:>8.2f}{row['latency_p95']:>8.2f}"
+                f"{row['prompt_tokens']:>12}{row['cached_tokens']:>12}{row['completion_tokens']:>11}{row['retries']:>9}"
+            )
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Current metrics in the Prometheus text exposition format."""
+        counters = {}
+        for record in self.records:
+            key = (record["model"], record["stage"] or "", record["source"])
+            c = counters.setdefault(key, {"calls": 0, "failed": 0, "latency": 0.0, "queue_wait": 0.0,
+                                          "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                                          "retries": 0})
+            c["calls"] += 1
+            c["failed"] += not record["ok"]
+            c["latency"] += record["latency"]
+            c["queue_wait"] += record["queue_wait"]
+            c["prompt_tokens"] += record["prompt_tokens"] or 0
+            c["cached_tokens"] += record["cached_tokens"] or 0
+            c["completion_tokens"] += record["completion_tokens"] or 0
+            c["retries"] += record["retries"]
+
+        metrics = [
+            ("llm_calls_total", "calls", "counter", "LLM calls"),
+            ("llm_call_failures_total", "failed", "counter", "LLM calls that returned no response"),
+            ("llm_call_latency_seconds_total", "latency", "counter", "Total time spent in LLM calls"),
+            ("llm_queue_wait_seconds_total", "queue_wait", "counter", "Total time blocked on the concurrency semaphore"),
+            ("llm_prompt_tokens_total", "prompt_tokens", "counter", "Prompt tokens"),
+            ("llm_cached_prompt_tokens_total", "cached_tokens", "counter", "Prompt tokens served from the prefix cache"),
+            ("llm_completion_tokens_total", "completion_tokens", "counter", "Completion tokens"),
+            ("llm_retries_total", "retries", "counter", "Retried attempts"),
+        ]
+        lines = []
+        for name, field, kind, help_text in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (model, stage, source), c in counters.items():
+                lines.append(f'{name}{{model="{model}",stage="{stage}",source="{source}"}} {c[field]}')
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Serve GET /metrics on the running loop until close()."""
+        async def handle(reader, writer):
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                status, body = "200 OK", self.prometheus()
+            else:
+                status, body = "404 Not Found", "not found\n"
+            payload = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("ascii") + payload)
+            await writer.drain()
+            writer.close()
+
+        self._server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Serving LLM metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+telemetry = Telemetry()
@@ -0,0 +1,47 @@
+# transformers_backend.py
+"""
+Provider running a local Hugging Face text-generation pipeline, e.g.
+
+    "qwen-local": {"provider": "transformers", "model": "Qwen/Qwen2.5-0.5B-Instruct",
+                   "device_map": "auto", "params": {"max_tokens": 1024}}
+
+transformers and torch are imported only when such a backend is first called.
+Generation runs in a worker thread so the event loop keeps serving other calls.
+Streaming and n > 1 are not supported; those params are ignored.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_NEW_TOKENS = 2048
+
+
+def _get_pipeline(backend):
+    if "pipeline" not in backend.state:
+        from transformers import pipeline
+
+        logger.info(f"Loading local model {backend.model}")
+        backend.state["pipeline"] = pipeline(
+            "text-generation",
+            model=backend.model,
+            device_map=backend.options.get("device_map", "auto"),
+            torch_dtype=backend.options.get("torch_dtype", "auto"),
+        )
+        # One generation at a time per pipeline; the GPU is the bottleneck anyway
+        backend.state["lock"] = asyncio.Lock()
+    return backend.state["pipeline"]
+
+
+async def complete(backend, messages, max_tokens=None, temperature=None, **params):
+    generator = _get_pipeline(backend)
+    kwargs = {"max_new_tokens": max_tokens or DEFAULT_MAX_NEW_TOKENS, "return_full_text": False}
+    if temperature:
+        kwargs.update(do_sample=True, temperature=temperature)
+    async with backend.state["lock"]:
+        outputs = await asyncio.to_thread(generator, messages, **kwargs)
+    generated = outputs[0]["generated_text"]
+    # Chat pipelines return the assistant message, plain ones a string
+    if isinstance(generated, list):
+        return generated[-1]["content"]
+    return generated
@@ -2,21 +2,57 @@ import argparse
 import logging
 from CogWriter_model.CogWriter import CogWriter
 from CogWriter_model.BaselineGen import BaselineGen
+from CogWriter_model.Agents.PlanningAgent import PlanningAgent
+from CogWriter_model.Agents.GenerationAgent import GenerationAgent
 import json
 import asyncio
 import os
+import sys
 from tqdm.asyncio import tqdm
+from llms.telemetry import MeteredSemaphore, call_context
+from utils.checkpointStore import CheckpointStore, make_checkpoint_key
+from llms.llms import (
+    BatchPending,
+    aclose_clients,
+    close_telemetry,
+    configure_batch,
+    configure_backends,
+    configure_cache,
+    configure_calibration,
+    configure_clients,
+    configure_telemetry,
+    configure_endpoints,
+    configure_rate_limit,
+    get_batch_stats,
+    get_cache_stats,
+    get_calibration_stats,
+    get_client_stats,
+    get_endpoint_stats,
+    get_parse_stats,
+    get_rate_limiter_stats,
+    get_singleflight_stats,
+    get_telemetry_summary,
+    save_calibration,
+    serve_metrics,
+)
 
-async def process_example(model, example, semaphore, checkpoint_dir, generator_type="cogwriter"):
+# Finished examples taken from the checkpoint store instead of being generated
+resumed_examples = {"count": 0}
+
+
+async def process_example(model, example, semaphore, checkpoints, generator_type="cogwriter"):
     # Create a unique identifier for this example
     example_id = example.get('id', str(example))
-    checkpoint_file = os.path.join(checkpoint_dir, f'checkpoint_{str(hash(example_id))}.json')
+    # Keyed by content before generation adds to the example, so the key is the same on every run
+    checkpoint_key = make_checkpoint_key(example)
     
     # Check if checkpoint exists
-    if os.path.exists(checkpoint_file):
+    if checkpoint_key in checkpoints:
         try:
-            with open(checkpoint_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            checkpoint = checkpoints.get(checkpoint_key)
+            if checkpoint is not None:
+                resumed_examples["count"] += 1
+                return checkpoint
         except Exception as e:
             logging.error(f"Error loading checkpoint for {example_id}: {e}")
 
@@ -27,19 +63,24 @@ async def process_example(model, example, semaphore, checkpoint_dir, generator_t
     while retry_count < max_retries:
         try:
             # Generate text using the specified generator
-            if generator_type == "cogwriter":
-                processed_example = await CogWriter.async_generate(model, example, semaphore)
-            else:
-                processed_example = await BaselineGen.async_generate(model, example, semaphore)
+            with call_context(example_id=example_id):
+                if generator_type == "cogwriter":
+                    processed_example = await CogWriter.async_generate(model, example, semaphore, checkpoint_key)
+                else:
+                    processed_example = await BaselineGen.async_generate(model, example, semaphore)
             
-            # Save checkpoint
+            # Save checkpoint (written in batches off the event loop)
             try:
-                with open(checkpoint_file, 'w', encoding='utf-8') as f:
-                    json.dump(processed_example, f)
+                checkpoints.put(checkpoint_key, processed_example)
             except Exception as e:
                 logging.error(f"Error saving checkpoint for {example_id}: {e}")
             
             return processed_example
+
+        except BatchPending:
+            # Waiting on an offline batch; resumes from the cache once its results are ingested
+            logging.info(f"Example {example_id} is waiting on batch results")
+            return None
             
         except Exception as e:
             retry_count += 1
@@ -59,12 +100,98 @@ async def main():
     parser.add_argument("--output_dir", type=str, help="Specify the output directory", required=True)
     parser.add_argument("--generator", type=str, choices=["cogwriter", "baseline"], default="cogwriter",
                       help="Specify the generator type: 'cogwriter' for CogWriter or 'baseline' for BaselineGen (default: cogwriter)")
+    parser.add_argument("--cache_path", type=str, default=None,
+                      help="SQLite file for the LLM response cache (default: longGenBench_output/<model>/llm_cache.sqlite)")
+    parser.add_argument("--cache_mode", type=str, choices=["use", "refresh", "bypass"], default="use",
+                      help="'use' serves cached responses, 'refresh' re-queries and overwrites them, 'bypass' disables the cache (default: use)")
+    parser.add_argument("--cache_max_mb", type=float, default=None, help="Evict least recently used cache entries beyond this size")
+    parser.add_argument("--cache_ttl", type=float, default=None, help="Expire cache entries older than this many hours")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute budget for the model (overrides the llm config)")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute budget for the model (overrides the llm config)")
+    parser.add_argument("--llm_config", type=str, default=None,
+                      help="JSON file defining the model backends (default: llms/backends.json or $COGWRITER_LLM_CONFIG)")
+    parser.add_argument("--endpoints", type=str, default=None,
+                      help="Comma-separated base urls of the replicas serving the model (e.g. several vLLM servers)")
+    parser.add_argument("--routing", type=str, choices=["least_outstanding", "latency"], default=None,
+                      help="How requests are spread across replicas (default: from the llm config, else least_outstanding)")
+    parser.add_argument("--concurrency", type=int, default=100,
+                      help="Maximum concurrent LLM calls; also sizes the HTTP connection pool (default: 100)")
+    parser.add_argument("--http2", action="store_true",
+                      help="Multiplex LLM calls over HTTP/2 connections (requires the 'h2' package)")
+    parser.add_argument("--batch", action="store_true",
+                      help="Write LLM calls to OpenAI Batch JSONL files instead of calling the API (needs the response cache)")
+    parser.add_argument("--batch_dir", type=str, default=None,
+                      help="Directory for batch input/output files (default: longGenBench_output/<model>/batches)")
+    parser.add_argument("--batch_processor", type=str, default=None,
+                      help="Command run as '<command> <input.jsonl> <output.jsonl>' to complete each batch in-process; "
+                           "without it the run stops at the first batch and is resumed with --batch_results")
+    parser.add_argument("--batch_results", type=str, nargs="*", default=[],
+                      help="Batch output files to load into the response cache before running")
+    parser.add_argument("--batch_idle", type=float, default=2.0,
+                      help="Seconds without new LLM calls after which the pending batch is written (default: 2)")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                      help="Append one JSON line per LLM call (stage, example, unit, latency, tokens, retries) to this file")
+    parser.add_argument("--metrics_port", type=int, default=None,
+                      help="Serve Prometheus metrics for the LLM calls at http://127.0.0.1:<port>/metrics during the run")
+    parser.add_argument("--context_strategy", type=str, choices=["full", "window", "summary"], default="full",
+                      help="Plan context in unit prompts: the full plan, the --context_window neighbouring units, "
+                           "or a per-example plan summary plus the neighbours (default: full)")
+    parser.add_argument("--context_window", type=int, default=2,
+                      help="Neighbouring units on each side included by the window and summary strategies (default: 2)")
+    parser.add_argument("--units_per_call", type=int, default=1,
+                      help="Consecutive units (weeks, floors, blocks) generated per LLM call; 0 sizes it from the "
+                           "model's context and output limits (default: 1)")
+    parser.add_argument("--plan_revision", type=str, choices=["full", "patch"], default="full",
+                      help="Have plan revisions re-emit the whole plan, or list only the changed entries to merge "
+                           "locally, falling back to a full revision if the patch does not fit (default: full)")
+    parser.add_argument("--plan_range_size", type=int, default=0,
+                        help="Plan hierarchically: outline the constraints and special units first, then plan ranges "
+                             "of this many units concurrently and merge them; 0 plans in a single call (default: 0)")
+    parser.add_argument("--plan_gap_trials", type=int, default=2,
+                        help="Calls made to fill units missing from a plan (skipped, truncated or malformed entries) "
+                             "by requesting only the missing id ranges; 0 disables gap filling (default: 2)")
+    parser.add_argument("--validate_plans", action="store_true",
+                        help="Check the initial plan locally (unit count, ids, special entries) and skip the revise "
+                             "call when it passes")
+    parser.add_argument("--speculative", action="store_true",
+                      help="Generate units from the initial plan while it is being revised; afterwards only units "
+                           "whose plan entry changed are regenerated")
+    parser.add_argument("--best_of", type=int, default=1,
+                      help="Candidates sampled per unit call (the n parameter); the one closest to the length "
+                           "requirement is kept (default: 1)")
+    parser.add_argument("--max_refinements", type=int, default=3,
+                      help="Editor passes allowed to bring a unit within 10%% of its word target (default: 3)")
+    parser.add_argument("--calibration_file", type=str, default=None,
+                      help="JSON file of per-model words per token and length bias learned across runs "
+                           "(default: longGenBench_output/<model>/length_calibration.json)")
+    parser.add_argument("--update_calibration", action="store_true",
+                      help="Add this run's observations to --calibration_file; without it the file is only read, "
+                           "so reruns send the same prompts and replay from the response cache")
+    parser.add_argument("--stream", action="store_true",
+                      help="Stream plan and unit responses and stop reading once the JSON object is complete")
     
     # Parse the command-line arguments
     args = parser.parse_args()
     model = args.model
     dataset_dir = args.dataset_dir
     generator_type = args.generator
+    backends = configure_backends(args.llm_config)
+    if model not in backends:
+        parser.error(f"Unknown model {model}; available: {', '.join(backends)}")
+    if (args.batch or args.batch_results) and args.cache_mode != "use":
+        parser.error("--batch replays finished stages from the response cache; use --cache_mode use")
+    PlanningAgent.stream = args.stream
+    GenerationAgent.stream = args.stream
+    GenerationAgent.context_strategy = args.context_strategy
+    GenerationAgent.context_window = args.context_window
+    GenerationAgent.units_per_call = args.units_per_call
+    GenerationAgent.max_refinements = args.max_refinements
+    GenerationAgent.best_of = args.best_of
+    CogWriter.speculative = args.speculative
+    PlanningAgent.revision = args.plan_revision
+    PlanningAgent.validate_plans = args.validate_plans
+    PlanningAgent.gap_trials = args.plan_gap_trials
+    PlanningAgent.range_size = args.plan_range_size
     
     # Load the dataset
     dataset = []
@@ -74,23 +201,131 @@ async def main():
 
     print(len(dataset))
     
-    # Create checkpoint directory based on model name, generator type and dataset
+    # Checkpoint store based on model name, generator type and dataset
     model_name = os.path.basename(model)
     dataset_name = os.path.splitext(os.path.basename(dataset_dir))[0]
-    checkpoint_dir = os.path.join("longGenBench_output", model_name, f"{generator_type}_checkpoints_{dataset_name}")
-    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoints = CheckpointStore(os.path.join("longGenBench_output", model_name,
+                                               f"{generator_type}_checkpoints_{dataset_name}.sqlite"))
+    # Plans and finished units of examples in progress go to the same store
+    CogWriter.checkpoints = checkpoints
+
+    # Response cache shared by all runs of this model
+    cache_path = args.cache_path or os.path.join("longGenBench_output", model_name, "llm_cache.sqlite")
+    configure_cache(
+        cache_path,
+        mode=args.cache_mode,
+        max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None,
+        ttl=args.cache_ttl * 3600 if args.cache_ttl else None,
+    )
+    configure_calibration(args.calibration_file or os.path.join("longGenBench_output", model_name, "length_calibration.json"),
+                          update=args.update_calibration)
+    
+    configure_endpoints(
+        model,
+        base_urls=[url.strip() for url in args.endpoints.split(",") if url.strip()] if args.endpoints else None,
+        strategy=args.routing,
+    )
+    if args.rpm or args.tpm:
+        configure_rate_limit(model, rpm=args.rpm, tpm=args.tpm)
+    if args.batch or args.batch_results:
+        configure_batch(
+            args.batch_dir or os.path.join("longGenBench_output", model_name, "batches"),
+            processor=args.batch_processor,
+            results=args.batch_results,
+            idle=args.batch_idle,
+        )
     
-    # Create semaphore to limit concurrent tasks
-    semaphore = asyncio.Semaphore(100)
+    # Create semaphore to limit concurrent tasks; connection pools match it so calls never queue for a socket.
+    # Batched calls wait for the whole batch, so every call must be able to join it.
+    semaphore = MeteredSemaphore(sys.maxsize if args.batch else args.concurrency)
+    configure_clients(max_connections=args.concurrency, http2=args.http2)
+    configure_telemetry(args.metrics_file)
+    if args.metrics_port:
+        await serve_metrics(args.metrics_port)
     
     # Process examples concurrently
-    tasks = [process_example(model, example, semaphore, checkpoint_dir, generator_type) for example in dataset]
-    final_outputs = await tqdm.gather(*tasks, desc=f"Processing {dataset_name}")
+    tasks = [process_example(model, example, semaphore, checkpoints, generator_type) for example in dataset]
+    try:
+        final_outputs = await tqdm.gather(*tasks, desc=f"Processing {dataset_name}")
+    finally:
+        await checkpoints.close()
+        await aclose_clients()
+        await close_telemetry()
+        save_calibration()
     
     # Check for exceptions and raise if any found
     for output in final_outputs:
         if isinstance(output, Exception):
             raise output
+    pending = sum(output is None for output in final_outputs)
+    final_outputs = [output for output in final_outputs if output is not None]
+
+    logging.info(f"Checkpoints: {resumed_examples['count']} finished examples resumed, {checkpoints.stats['reads']} "
+                 f"reads, {checkpoints.stats['writes']} written in {checkpoints.stats['flushes']} batches")
+    resume_stats = CogWriter.resume_stats
+    if any(resume_stats.values()):
+        logging.info(f"Resumed in progress: {resume_stats['plans']} examples from their saved plan, "
+                     f"{resume_stats['initial_plans']} from their saved initial plan ({resume_stats['units']} "
+                     f"finished or drafted units found)")
+    cache_stats = get_cache_stats()
+    if cache_stats:
+        logging.info(f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                     f"{cache_stats['writes']} writes (hit rate {cache_stats['hit_rate']:.1%})")
+    flight_stats = get_singleflight_stats()
+    logging.info(f"LLM single-flight: {flight_stats['upstream']} upstream calls, "
+                 f"{flight_stats['merged']} duplicate in-flight calls saved")
+    for limited_model, limiter_stats in get_rate_limiter_stats().items():
+        logging.info(f"Rate limiter {limited_model}: waited {limiter_stats['waits']} times "
+                     f"({limiter_stats['wait_time']:.1f}s total), {limiter_stats['rate_limited']} 429s")
+    for routed_model, endpoints in get_endpoint_stats().items():
+        for endpoint in endpoints:
+            logging.info(f"Endpoint {routed_model} {endpoint['base_url']}: {endpoint['requests']} requests, "
+                         f"{endpoint['failures']} failures, healthy={endpoint['healthy']}")
+    batch_stats = get_batch_stats()
+    if batch_stats:
+        logging.info(f"Batch: {batch_stats['queued']} requests in {batch_stats['files']} files, "
+                     f"{batch_stats['completed']} completed, {batch_stats['failed']} failed, {batch_stats['pending']} pending")
+    unit_batches = GenerationAgent.batch_stats
+    if unit_batches["calls"]:
+        logging.info(f"Multi-unit calls: {unit_batches['units']} units in {unit_batches['calls']} calls, "
+                     f"{unit_batches['fallbacks']} regenerated one by one")
+    parse_stats = get_parse_stats()
+    if any(parse_stats.values()):
+        logging.info(f"JSON responses: {parse_stats['strict']} parsed directly, {parse_stats['extract']} extracted "
+                     f"from surrounding text, {parse_stats['repair']} repaired, {parse_stats['failed']} unparsable")
+    revision_stats = PlanningAgent.revision_stats
+    if revision_stats["patched"] or revision_stats["fallbacks"]:
+        logging.info(f"Plan patches: {revision_stats['patched']} applied ({revision_stats['changed_entries']} entries "
+                     f"changed), {revision_stats['fallbacks']} fell back to a full revision")
+    gap_stats = PlanningAgent.gap_stats
+    if gap_stats["plans_with_gaps"]:
+        logging.info(f"Plan gaps: {gap_stats['plans_with_gaps']} plans had missing units, {gap_stats['filled']} "
+                     f"entries filled, {gap_stats['unfilled']} still missing")
+    validation_stats = PlanningAgent.validation_stats
+    if validation_stats["checked"]:
+        logging.info(f"Plan validation: {validation_stats['passed']} of {validation_stats['checked']} initial plans "
+                     f"passed; revise calls skipped for those")
+    speculation_stats = CogWriter.speculation_stats
+    if speculation_stats["examples"]:
+        logging.info(f"Speculative generation: {speculation_stats['reused']} units kept from the initial plan, "
+                     f"{speculation_stats['regenerated']} regenerated after revision")
+    refine_stats = GenerationAgent.refine_stats
+    if refine_stats["units"]:
+        logging.info(f"Unit lengths: {refine_stats['in_range']}/{refine_stats['units']} first drafts within 10% of "
+                     f"the target, {refine_stats['trimmed']} trimmed locally, {refine_stats['refinements']} refinement calls, "
+                     f"{refine_stats['capped']} units kept after --max_refinements passes")
+    for calibrated_model, calibrated in get_calibration_stats().items() if args.update_calibration else ():
+        logging.info(f"Length calibration {calibrated_model} for the next run: {calibrated['words_per_token']:.2f} words/token "
+                     f"({calibrated['responses']} responses), length bias {calibrated['length_bias']:.2f} "
+                     f"({calibrated['drafts']} drafts)")
+    if pending:
+        logging.info(f"{pending} examples are waiting on batch results; submit the files in the batch directory "
+                     f"and rerun with --batch --batch_results <output files>")
+    logging.info("LLM calls by stage:\n" + get_telemetry_summary())
+    for client in get_client_stats():
+        logging.info(f"HTTP client {client['base_url']}: {client['requests']} requests, "
+                     f"peak {client['peak_in_flight']}/{client['max_connections']} connections in use, "
+                     f"{client['saturated']} waited for a free connection (http2={client['http2']})")
     
     # Write the output list to a json file
     logging.info(f"Writing output to {args.output_dir}")
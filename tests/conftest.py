@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The repository root holds the top-level packages (CogWriter_model, llms, utils)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from CogWriter_model.Agents import GenerationAgent as generation_module
+from CogWriter_model.Agents.GenerationAgent import GenerationAgent
+
+
+def words(n):
+    return " ".join(["word"] * n) + "."
+
+
+@pytest.fixture
+def refine(monkeypatch):
+    monkeypatch.setattr(GenerationAgent, "max_refinements", 3)
+    monkeypatch.setattr(GenerationAgent, "refine_stats",
+                        {"units": 0, "in_range": 0, "trimmed": 0, "refinements": 0, "capped": 0})
+
+    def run(draft, responses, required_length=200):
+        responses = list(responses)
+        prompts = []
+
+        async def fake_call_llm(model, prompt, **params):
+            prompts.append(prompt)
+            return responses.pop(0)
+
+        monkeypatch.setattr(generation_module, "async_call_llm", fake_call_llm)
+        text = asyncio.run(GenerationAgent._refine_length("mock", asyncio.Semaphore(1), draft, required_length, "Week 1"))
+        return text, prompts
+
+    return run
+
+
+def test_empty_refinements_keep_the_draft(refine):
+    draft = words(100)
+    text, prompts = refine(draft, ["", "   ", ""])
+    assert text == draft
+    assert len(prompts) == 3
+    # Every pass edits the draft, never an empty text
+    assert all(draft in prompt for prompt in prompts)
+
+
+def test_refinement_after_an_empty_response(refine):
+    draft = words(100)
+    text, prompts = refine(draft, ["", words(195)])
+    assert text == words(195)
+    assert len(prompts) == 2 and draft in prompts[1]
+    assert GenerationAgent.refine_stats["capped"] == 0
+
+
+def test_batch_units_match_by_unit_number(monkeypatch):
+    unit_ids = ["Week 3 (January 15th - January 21st)", "Week 4 (January 22nd - January 28th)", "Week 5"]
+
+    async def fake_candidates(model, prompt, n, **params):
+        # The model shortens and reformats the ids, and leaves out week 5
+        return [{"units": [{"week_id": "Week 03", "check": "", "diary_entry": words(200)},
+                           {"week_id": "week 4", "check": "", "diary_entry": words(190)}]}]
+
+    monkeypatch.setattr(generation_module, "async_call_llm_json_candidates", fake_candidates)
+    monkeypatch.setattr(GenerationAgent, "batch_stats", {"calls": 0, "units": 0, "fallbacks": 0})
+    texts = asyncio.run(GenerationAgent._generate_batch("mock", "prompt", asyncio.Semaphore(1), unit_ids, "week_id",
+                                                        "diary_entry", None, (200, 200), 1000))
+    assert texts == [words(200), words(190), None]
+    assert GenerationAgent.batch_stats["fallbacks"] == 1
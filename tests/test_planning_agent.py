@@ -0,0 +1,108 @@
+import asyncio
+import re
+
+import pytest
+
+from CogWriter_model.Agents import OutputSchemas
+from CogWriter_model.Agents import PlanningAgent as planning_module
+from CogWriter_model.Agents.PlanningAgent import PlanningAgent
+from utils.jsonParser import validate_json
+
+
+def week_plan(weeks=52, birthday_week=19, birthday_events="Husband's birthday dinner"):
+    plan = [{"week_id": f"Week {number}", "events": "Work and a weekend walk"} for number in range(1, weeks + 1)]
+    if birthday_week <= weeks:
+        plan[birthday_week - 1]["events"] = birthday_events
+    return {
+        "analysis": "",
+        "special_events": [{"event_name": "Husband's Birthday", "week_numb": f"May 13th, Week {birthday_week}"}],
+        "weekly_plan": plan,
+    }
+
+
+class FakeLLM:
+    """Stands in for async_call_llm_json: answers by schema name and counts the calls."""
+
+    def __init__(self, initial_plan, revised_plan=None):
+        self.initial_plan = initial_plan
+        self.revised_plan = revised_plan or week_plan()["weekly_plan"]
+        self.calls = []
+        self.missing = []
+
+    async def __call__(self, model, prompt, schema=None, schema_name=None, partial_keys=(), stream=False):
+        self.calls.append(schema_name)
+        if schema_name == "weekly_plan":
+            return self.initial_plan
+        if schema_name == "revised_weekly_plan":
+            return {"analysis": "", "revised_weekly_plan": self.revised_plan}
+        if schema_name == "missing_entries":
+            self.missing.append(re.search(r"^Missing weeks: (.*)$", prompt, re.MULTILINE).group(1))
+            numbers = [int(number) for number in re.findall(r"\d+", self.missing[-1])]
+            return {"missing_entries": [{"week_id": f"Week {number}", "events": "Filled in"} for number in numbers]}
+        raise AssertionError(f"Unexpected call {schema_name}")
+
+
+@pytest.fixture
+def planner(monkeypatch):
+    monkeypatch.setattr(PlanningAgent, "validate_plans", True)
+    monkeypatch.setattr(PlanningAgent, "revision", "full")
+    monkeypatch.setattr(PlanningAgent, "range_size", 0)
+    monkeypatch.setattr(PlanningAgent, "validation_stats", {"checked": 0, "passed": 0})
+
+    def plan(initial_plan, revised_plan=None):
+        llm = FakeLLM(initial_plan, revised_plan)
+        monkeypatch.setattr(planning_module, "async_call_llm_json", llm)
+        example = {"type": "Week", "prompt": "Write a diary; my husband's birthday is on May 13th."}
+        example = asyncio.run(PlanningAgent.async_create_hierarchy("mock", example, asyncio.Semaphore(1)))
+        return example, llm
+
+    return plan
+
+
+def test_valid_initial_plan_skips_revision(planner):
+    example, llm = planner(week_plan())
+    assert llm.calls == ["weekly_plan"]
+    assert len(example["weekly_plan"]) == 52
+    assert PlanningAgent.validation_stats == {"checked": 1, "passed": 1}
+
+
+def test_invalid_initial_plan_is_revised(planner):
+    # The birthday is listed as a special event but missing from its week
+    example, llm = planner(week_plan(birthday_events="Work and a weekend walk"))
+    assert llm.calls == ["weekly_plan", "revised_weekly_plan"]
+    assert "birthday" in example["weekly_plan"][18]["events"]
+    assert PlanningAgent.validation_stats == {"checked": 1, "passed": 0}
+
+
+def test_incomplete_initial_plan_is_revised(planner):
+    example, llm = planner(week_plan(weeks=50))
+    assert llm.calls == ["weekly_plan", "revised_weekly_plan"]
+    assert len(example["weekly_plan"]) == 52
+
+
+def test_half_formed_entries_are_gap_filled(planner):
+    revised = week_plan()["weekly_plan"]
+    # A cut-off last entry (repaired to its id alone) and an entry without its text
+    revised[-1] = {"week_id": "Week 52"}
+    del revised[9]["events"]
+    response = {"analysis": "", "revised_weekly_plan": revised}
+    assert validate_json(response, OutputSchemas.REVISED_WEEK_PLAN, partial_keys=("revised_weekly_plan",))
+    assert not validate_json(response, OutputSchemas.REVISED_WEEK_PLAN)
+
+    example, llm = planner(week_plan(weeks=50), revised)
+    assert llm.calls == ["weekly_plan", "revised_weekly_plan", "missing_entries"]
+    assert llm.missing == ["10, 52"]
+    assert [entry["week_id"] for entry in example["weekly_plan"]] == [f"Week {number}" for number in range(1, 53)]
+    assert example["weekly_plan"][9]["events"] == "Filled in"
+
+
+def test_only_plan_entries_may_be_half_formed():
+    partial = ("weekly_plan",)
+    assert not validate_json({"analysis": ""}, OutputSchemas.WEEK_PLAN, partial_keys=partial)
+    assert not validate_json({"week_id": "Week 1", "diary_entry": "Text"}, OutputSchemas.DIARY_ENTRY)
+    # Special events and multi-unit lists keep their required keys
+    plan = week_plan()
+    plan["special_events"] = [{"event_name": "Husband's Birthday"}]
+    assert not validate_json(plan, OutputSchemas.WEEK_PLAN, partial_keys=partial)
+    units = {"units": [{"week_id": "Week 1", "check": ""}]}
+    assert not validate_json(units, OutputSchemas.units_of(OutputSchemas.DIARY_ENTRY))
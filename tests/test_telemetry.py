@@ -0,0 +1,42 @@
+import asyncio
+
+from llms.telemetry import MeteredSemaphore, call_priority
+
+
+def test_freed_slots_go_to_the_highest_priority():
+    async def main():
+        semaphore = MeteredSemaphore(1)
+        order = []
+
+        async def call(name, priority):
+            with call_priority(priority):
+                async with semaphore:
+                    order.append(name)
+                    await asyncio.sleep(0)
+
+        await semaphore.acquire()
+        tasks = [asyncio.create_task(call("draft 1", -1)), asyncio.create_task(call("draft 2", -1))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(call("revise", 0)))
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["revise", "draft 1", "draft 2"]
+
+
+def test_cancelled_waiters_do_not_keep_a_slot():
+    async def main():
+        semaphore = MeteredSemaphore(1)
+        await semaphore.acquire()
+        waiter = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        # The slot is handed to the waiter, which is cancelled before it runs
+        semaphore.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert not semaphore.locked()
+        await asyncio.wait_for(semaphore.acquire(), 1)
+
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def make_checkpoint_key(example):
+    """
+    Stable digest of a dataset example, used as its checkpoint key.
+
+    Unlike hash(), which is salted per process, the digest is the same on
+    every run, so a restarted run finds the checkpoints of the previous one.
+    Compute it before generation, which adds fields to the example.
+
+    Args:
+        example (dict): Example as loaded from the dataset
+    Returns:
+        str: Hex digest of the example's content
+    """
+    payload = json.dumps(example, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore:
+    """
+    Single-file SQLite store of processed examples, keyed by make_checkpoint_key.
+
+    The keys present are held in memory, so resume checks are O(1) lookups.
+    put() only queues the example. Queued examples are serialised and written
+    in one transaction on a worker thread once batch_size are waiting or
+    flush_interval seconds have passed, so the event loop waits on neither
+    JSON encoding nor the disk. get() also sees examples that are queued but
+    not yet written.
+
+    Args:
+        path (str): Database file
+        batch_size (int): Queued rows that trigger a flush
+        flush_interval (float): Seconds after the first queued row at which a flush starts
+    """
+
+    def __init__(self, path, batch_size=32, flush_interval=1.0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {"reads": 0, "writes": 0, "flushes": 0}
+        self._pending = {}
+        # Rows handed to a flush that has not committed yet
+        self._writing = {}
+        self._timer = None
+        # A flush task is queued or running; further triggers wait for it to finish
+        self._flush_scheduled = False
+        self._flushes = set()
+        # Flushes run one after another, so a key's later version is never overwritten by an earlier one
+        self._flush_lock = asyncio.Lock()
+        # The worker thread and get() share the connection
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS checkpoints (
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._index = {row[0] for row in self._conn.execute("SELECT key FROM checkpoints")}
+        logger.info(f"Loaded {len(self._index)} checkpoints from {path}")
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        """Return the checkpointed example for key, or None."""
+        if key not in self._index:
+            return None
+        example = self._pending.get(key) or self._writing.get(key)
+        if example is None:
+            with self._lock:
+                row = self._conn.execute("SELECT data FROM checkpoints WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            example = json.loads(row[0])
+        self.stats["reads"] += 1
+        return example
+
+    def put(self, key, example):
+        """
+        Queue example to be written under key. It is serialised later on a
+        worker thread, so the caller must not change it afterwards (pass a copy
+        of anything still being worked on).
+        """
+        self._pending[key] = example
+        self._index.add(key)
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def delete(self, key):
+        """Queue the removal of key's checkpoint."""
+        self._index.discard(key)
+        self._pending[key] = None
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        task = asyncio.get_running_loop().create_task(self._scheduled_flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _scheduled_flush(self):
+        try:
+            await self.flush()
+        finally:
+            self._flush_scheduled = False
+        # Rows queued while it ran, whose triggers were skipped
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._pending and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    async def flush(self):
+        """Write the queued rows in one transaction on a worker thread."""
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            self._writing = pending
+            try:
+                await asyncio.to_thread(self._write, pending)
+            finally:
+                self._writing = {}
+
+    def _write(self, pending):
+        now = time.time()
+        rows = [(key, json.dumps(example, ensure_ascii=False), now)
+                for key, example in pending.items() if example is not None]
+        deleted = [(key,) for key, example in pending.items() if example is None]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", rows)
+                self._conn.executemany("DELETE FROM checkpoints WHERE key = ?", deleted)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.stats["writes"] += len(rows)
+        self.stats["flushes"] += 1
+
+    async def close(self):
+        """Write everything still queued and close the database."""
+        # A finishing flush may schedule the next one
+        while self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        self._conn.close()
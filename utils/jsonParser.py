@@ -0,0 +1,189 @@
+import json
+import re
+
+from json_repair import repair_json
+
+
+class JSONBoundaryDetector:
+    """
+    Incrementally find where the first top-level JSON object in a stream ends.
+
+    Text before the first '{' (e.g. "Here is the JSON:" or a ```json fence) is
+    skipped. Braces and brackets inside strings, including escaped quotes, are
+    ignored.
+
+    Usage:
+        detector = JSONBoundaryDetector()
+        for chunk in stream:
+            if detector.feed(chunk):
+                break
+        detector.text  # the complete object, once detector.complete is True
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._length = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self.start = None
+        self.end = None
+
+    @property
+    def complete(self):
+        return self.end is not None
+
+    @property
+    def raw(self):
+        """Everything fed so far."""
+        return "".join(self._buffer)
+
+    @property
+    def text(self):
+        """The object once complete, otherwise everything from its opening brace."""
+        raw = self.raw
+        if self.start is None:
+            return raw
+        return raw[self.start:self.end]
+
+    def feed(self, chunk):
+        """Consume a chunk; return True once the top-level object has closed."""
+        if self.complete or not chunk:
+            return self.complete
+
+        offset = self._length
+        self._buffer.append(chunk)
+        self._length += len(chunk)
+
+        for i, char in enumerate(chunk):
+            if self.start is None:
+                if char == "{":
+                    self.start = offset + i
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = offset + i + 1
+                    return True
+        return False
+
+
+def extract_json_object(text, max_chars=None):
+    """Return the first balanced top-level JSON object in text (scanning at most max_chars), or None."""
+    detector = JSONBoundaryDetector()
+    if detector.feed(text if max_chars is None else text[:max_chars]):
+        return detector.text
+    return None
+
+
+# Responses parsed by each tier of parse_json_object
+parse_stats = {"strict": 0, "extract": 0, "repair": 0, "failed": 0}
+
+# Longest text the brace extractor scans; plans are well below this
+MAX_EXTRACT_CHARS = 1_000_000
+
+
+def parse_json_object(text):
+    """
+    Parse the first JSON object in a model response, cheapest tier first.
+
+    1. strict:  json.loads on the stripped text, for bare objects (constrained
+       decoding, cut-off streams, well-behaved models)
+    2. extract: json.loads on the first balanced {...}, for objects wrapped in
+       prose or a ```json fence
+    3. repair:  json_repair, for truncated or malformed objects
+
+    Each tier only runs if the cheaper ones fail, so the repair pass, which is
+    by far the slowest on large plans, is kept for responses that need it.
+    parse_stats counts the tier that succeeded.
+
+    Returns:
+        dict: The parsed object, or None if no tier yields one
+    """
+    if not text:
+        parse_stats["failed"] += 1
+        return None
+
+    try:
+        parsed = json.loads(text.strip())
+        if isinstance(parsed, dict):
+            parse_stats["strict"] += 1
+            return parsed
+    except ValueError:
+        pass
+
+    candidate = extract_json_object(text, MAX_EXTRACT_CHARS)
+    if candidate is not None:
+        try:
+            parsed = json.loads(candidate)
+            if isinstance(parsed, dict):
+                parse_stats["extract"] += 1
+                return parsed
+        except ValueError:
+            pass
+
+    repaired = repair_json(text)
+    match = re.search(r"\{.*\}", repaired, re.DOTALL)
+    if match:
+        try:
+            parsed = json.loads(match.group(0))
+            if isinstance(parsed, dict):
+                parse_stats["repair"] += 1
+                return parsed
+        except ValueError:
+            pass
+    parse_stats["failed"] += 1
+    return None
+
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+}
+
+
+def validate_json(value, schema, partial_keys=(), required=True):
+    """
+    Return True if value matches schema.
+
+    Checks the subset of JSON Schema the agents' schemas use (type, properties,
+    required, items). Extra properties are tolerated: models without
+    constrained decoding sometimes add a key, which does no harm. The items
+    of the arrays under partial_keys (top-level keys) are checked for type
+    only, not for required keys: a plan with one half-formed entry (cut
+    short, or missing its text) still validates, and the caller keeps its
+    well-formed entries instead of requesting the whole plan again.
+    """
+    expected = schema.get("type")
+    if expected is not None:
+        if not isinstance(value, _JSON_TYPES[expected]):
+            return False
+        # bool is an int subclass, but not a JSON number
+        if expected in ("number", "integer") and isinstance(value, bool):
+            return False
+    if isinstance(value, dict):
+        if required and any(key not in value for key in schema.get("required", ())):
+            return False
+        properties = schema.get("properties", {})
+        return all(validate_json(value[key], sub, required=key not in partial_keys)
+                   for key, sub in properties.items() if key in value)
+    if isinstance(value, list) and "items" in schema:
+        return all(validate_json(item, schema["items"], required=required) for item in value)
+    return True
@@ -0,0 +1,66 @@
+import re
+
+from utils.wordCounter import count_words
+
+# A sentence ends at Chinese end punctuation, or at English end punctuation
+# followed by whitespace; closing quotes and brackets stay with their sentence.
+# Paragraph breaks end a sentence too.
+SENTENCE_END = re.compile(r'[。！？；…]+[”’」』）)"\']*|[.!?]+[”’"\')\]]*(?=\s)|\n\s*\n')
+# Abbreviations whose period does not end a sentence
+ABBREVIATION = re.compile(r'\b(?:Mr|Mrs|Ms|Dr|Prof|St|Jr|Sr|vs|etc|e\.g|i\.e)$', re.IGNORECASE)
+
+
+def split_sentences(text):
+    """
+    Split text into sentences, keeping each sentence's end punctuation.
+
+    Joining the returned pieces gives back the original text.
+
+    Args:
+        text (str): Input text containing both Chinese and English
+    Returns:
+        list: Sentences in order, each with its trailing punctuation
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if match.group().startswith(".") and ABBREVIATION.search(text, 0, match.start()):
+            continue
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+def trim_to_length(text, required_length, tolerance=0.1):
+    """
+    Cut overlong text at a sentence boundary so that its length lands within
+    tolerance of required_length.
+
+    Words are counted with count_words, so Chinese characters and English
+    words are measured the same way as the length check that triggered the
+    trim. Among the sentence boundaries in range, the one closest to
+    required_length wins.
+
+    Args:
+        text (str): Text longer than required_length
+        required_length (int): Target word count
+        tolerance (float): Allowed relative deviation from required_length
+    Returns:
+        str: The trimmed text, or None if no sentence boundary lands in range
+    """
+    low = required_length * (1 - tolerance)
+    high = required_length * (1 + tolerance)
+    best = None
+    best_diff = None
+    prefix = ""
+    for sentence in split_sentences(text):
+        prefix += sentence
+        length = count_words(prefix)
+        if length > high:
+            break
+        if length >= low and (best_diff is None or abs(length - required_length) < best_diff):
+            best = prefix
+            best_diff = abs(length - required_length)
+    return best.rstrip() if best is not None else None